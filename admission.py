@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Admission control of control connections.
+
+Both servers ask 'admit(ip)' right after accept. Connections over the
+limits (sessions in total, sessions per client IP) are answered at once
+with '421' and closed, instead of queueing behind busy sessions or
+starting more threads: under overload, the clients that get in are served
+as usual and the rest know to retry.
+
+The threaded server runs its sessions on a WorkerPool of as many threads
+as sessions are admitted, reused from one session to the next.
+"""
+
+import collections, logging, multiprocessing, queue, threading, zlib
+
+import metrics
+
+log = logging.getLogger('ftp.server')
+
+REJECTED = metrics.REGISTRY.counter('ftp_connections_rejected_total',
+                                    'Control connections refused with 421, by reason',
+                                    ('reason',))
+
+BUSY_MSG = b'421 Too many users, try again later.\r\n'
+PER_IP_MSG = b'421 Too many connections from your address.\r\n'
+
+
+class Admission:
+    DEFAULT_MAX_SESSIONS = 256
+    DEFAULT_MAX_PER_IP = 32
+
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, max_per_ip=DEFAULT_MAX_PER_IP):
+        """
+        'max_per_ip' None means no limit per IP.
+        """
+        self.max_sessions = max_sessions
+        self.max_per_ip = max_per_ip
+        self.sessions = 0
+        self._per_ip = collections.Counter()
+        self._lock = threading.Lock()
+
+    def admit(self, ip):
+        """
+        Takes a session slot for 'ip'. Returns None if admitted, otherwise
+        the 421 reply to send; 'release(ip)' must follow an admission.
+        """
+        with self._lock:
+            if self.sessions >= self.max_sessions:
+                REJECTED.inc(labels=('busy',))
+                return BUSY_MSG
+            if self.max_per_ip is not None and self._per_ip[ip] >= self.max_per_ip:
+                REJECTED.inc(labels=('per_ip',))
+                return PER_IP_MSG
+            self.sessions += 1
+            self._per_ip[ip] += 1
+            return None
+
+    def release(self, ip):
+        with self._lock:
+            self.sessions -= 1
+            self._per_ip[ip] -= 1
+            if not self._per_ip[ip]:
+                del self._per_ip[ip]
+
+
+class SharedAdmission(Admission):
+    """
+    Admission shared by the worker processes of a prefork server, with its
+    counters in shared memory: a row per worker, so the slots held by a
+    worker that dies can be given back ('clear'). Client IPs are hashed into
+    BUCKETS counters; two IPs may share a per-IP count, which only makes
+    their limit stricter. Create it before starting the workers, and set
+    'worker' in each of them.
+    """
+    BUCKETS = 1024
+
+    def __init__(self, workers, max_sessions=Admission.DEFAULT_MAX_SESSIONS,
+                 max_per_ip=Admission.DEFAULT_MAX_PER_IP, context=multiprocessing):
+        self.workers = workers
+        self.worker = 0
+        self.max_sessions = max_sessions
+        self.max_per_ip = max_per_ip
+        self._lock = context.Lock()
+        self._sessions = context.RawArray('i', workers)
+        self._per_ip = context.RawArray('i', workers * self.BUCKETS)
+
+    @property
+    def sessions(self):
+        return sum(self._sessions)
+
+    def _bucket(self, ip):
+        # Not hash(): it's salted differently in every process
+        return zlib.crc32(ip.encode()) % self.BUCKETS
+
+    def admit(self, ip):
+        bucket = self._bucket(ip)
+        with self._lock:
+            if sum(self._sessions) >= self.max_sessions:
+                REJECTED.inc(labels=('busy',))
+                return BUSY_MSG
+            if self.max_per_ip is not None and \
+                    sum(self._per_ip[bucket::self.BUCKETS]) >= self.max_per_ip:
+                REJECTED.inc(labels=('per_ip',))
+                return PER_IP_MSG
+            self._sessions[self.worker] += 1
+            self._per_ip[self.worker * self.BUCKETS + bucket] += 1
+            return None
+
+    def release(self, ip):
+        with self._lock:
+            self._sessions[self.worker] -= 1
+            self._per_ip[self.worker * self.BUCKETS + self._bucket(ip)] -= 1
+
+    def clear(self, worker):
+        """
+        Gives back every slot held by 'worker' (after it exited).
+        """
+        row = worker * self.BUCKETS
+        with self._lock:
+            self._sessions[worker] = 0
+            self._per_ip[row:row + self.BUCKETS] = [0] * self.BUCKETS
+
+
+def refuse(sock, reply):
+    """
+    Sends the 421 reply without waiting on the client, and closes.
+    """
+    try:
+        sock.setblocking(False)
+        sock.send(reply)
+    except OSError:
+        pass
+    sock.close()
+
+
+class WorkerPool:
+    """
+    Runs the submitted calls on up to 'max_workers' threads, started as
+    needed and kept for the next calls. Unlike ThreadPoolExecutor the threads
+    are daemon ones, so open sessions don't hold the interpreter at exit.
+    """
+
+    def __init__(self, max_workers, name='ftp-session'):
+        self.max_workers = max_workers
+        self.name = name
+        self.workers = 0
+        self._jobs = queue.SimpleQueue()
+        self._idle = threading.Semaphore(0)     # Released by a worker waiting for a job
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        self._jobs.put((fn, args))
+        if self._idle.acquire(blocking=False):
+            return
+        with self._lock:
+            if self.workers < self.max_workers:
+                self.workers += 1
+                threading.Thread(target=self._work, name=f'{self.name}-{self.workers}',
+                                 daemon=True).start()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception:
+                log.exception('Worker call failed')
+            self._idle.release()
+
+    def shutdown(self):
+        """
+        Workers exit once done with their current call.
+        """
+        with self._lock:
+            for _ in range(self.workers):
+                self._jobs.put(None)
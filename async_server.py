@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+asyncio engine for the control connections.
+
+Instead of holding a worker thread per client, every control connection
+is a coroutine multiplexed on an event loop. There is one event loop per core,
+each accepting on its own listening socket bound with SO_REUSEPORT, so the
+kernel balances new clients across loops.
+
+The command dispatch is the same one used by the threaded server: sessions
+are ClientSupporter objects whose 'cli_conn' is an adapter writing to the
+asyncio transport. Commands whose spec is 'blocking' run in thread pools
+shared by all loops, so the loop never waits on the disk or on a client
+data socket: those with a data connection (transfers and listings, which
+can last long or be slowed down on purpose) in one, the rest (PASS, CWD,
+SIZE...) in another, so a pool full of transfers doesn't hold up logins.
+"""
+
+import asyncio, os, socket, threading
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import Admission
+from client_supporter import ClientSupporter, LineReader, ReplyBuffer
+from data_ports import DataPortPool
+from listing_cache import ListingCache
+import metrics
+
+
+class ControlConnection:
+    """
+    Socket-like wrapper around an asyncio StreamWriter.
+    Replies sent from executor threads are handed to the loop thread.
+    """
+
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+        self._loop_thread = threading.get_ident()
+
+    def send(self, data):
+        if threading.get_ident() == self._loop_thread:
+            self._writer.write(data)
+        else:
+            self._loop.call_soon_threadsafe(self._writer.write, data)
+        return len(data)
+
+    sendall = send
+
+    def getsockname(self):
+        return self._writer.get_extra_info('sockname')
+
+    def getpeername(self):
+        return self._writer.get_extra_info('peername')
+
+    def close(self):
+        if threading.get_ident() == self._loop_thread:
+            self._writer.close()
+        else:
+            self._loop.call_soon_threadsafe(self._writer.close)
+
+
+class AsyncClientSupporter(ClientSupporter):
+    """
+    ClientSupporter driven by a coroutine instead of a worker thread.
+    """
+
+    def __init__(self, reader, writer, server_dir, executor, data_ports=None,
+                 listing_cache=None, authenticator=None, throttle=None, usage=None,
+                 transfers=None):
+        loop = asyncio.get_running_loop()
+        ClientSupporter.__init__(self, ControlConnection(loop, writer),
+                                 writer.get_extra_info('peername'), server_dir, data_ports,
+                                 listing_cache, authenticator, throttle, usage)
+        self._reader = reader
+        self._writer = writer
+        self._executor = executor
+        self._transfers = transfers or executor     # For the verbs with a data connection
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.cli_conn = ReplyBuffer(self.cli_conn)
+        parse = self.parse_code
+        lines = LineReader(self.MAX_LINE_SIZE)
+
+        self.log.info("Cliente conectado")
+        metrics.SESSIONS.inc()
+        self.cli_conn.send(parse(self.WELCOME_MSG))
+        try:
+            while self._quit is False:
+                line = lines.next_line()
+                if line is None:
+                    # Every complete request is answered, send replies and wait for more
+                    self.cli_conn.flush()
+                    await self._writer.drain()
+                    data = await asyncio.wait_for(self._reader.read(self.CLIENT_MAX_SIZE_MSG),
+                                                  self.IDLE_TIMEOUT)
+                    if not data:
+                        break
+                    lines.feed(data)
+                    continue
+
+                req = self._decode_line(line)
+                cmd = self._parse_request(req) if req else None
+                if cmd is None:
+                    continue
+                spec = cmd[0]
+                if spec.blocking:
+                    executor = self._transfers if spec.data_conn else self._executor
+                    await loop.run_in_executor(executor, self._execute, *cmd)
+                else:
+                    self._execute(*cmd)
+            self.cli_conn.flush()
+            await self._writer.drain()
+        except asyncio.TimeoutError:
+            self.log.info('Idle timeout')
+            self._send_quietly(parse(self.IDLE_MSG))
+        except OSError:
+            pass    # Connection lost
+        finally:
+            metrics.SESSIONS.dec()
+            self._release_passive()
+            self.fs.close()
+            self.log.info("Cliente desconectado")
+
+
+class _EventLoopWorker(threading.Thread):
+    """
+    Runs one event loop serving the connections accepted on 'sock'.
+    """
+
+    def __init__(self, sock, server_dir, executor, transfers, data_ports, listing_cache,
+                 admission, authenticator, throttle, usage):
+        self.sock = sock
+        self.admission = admission
+        self.authenticator = authenticator
+        self.throttle = throttle
+        self.usage = usage
+        self.server_dir = server_dir
+        self.executor = executor
+        self.transfers = transfers
+        self.data_ports = data_ports
+        self.listing_cache = listing_cache
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.sessions = set()
+        threading.Thread.__init__(self, daemon=True)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self._serve_client, sock=self.sock))
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            # Sessions still open get cancelled, so they run their clean-up
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    async def _serve_client(self, reader, writer):
+        metrics.CONNECTIONS.inc()
+        # asyncio only sets it on sockets created with proto=IPPROTO_TCP, ours are proto 0:
+        # without it the final 226/250 waits behind the unacknowledged 150 (delayed ACK)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        ip = writer.get_extra_info('peername')[0]
+        refused = self.admission.admit(ip)
+        if refused:
+            writer.write(refused)
+            writer.close()
+            return
+        session = None
+        try:
+            session = AsyncClientSupporter(reader, writer, self.server_dir, self.executor,
+                                           self.data_ports, self.listing_cache,
+                                           self.authenticator, self.throttle, self.usage,
+                                           self.transfers)
+            self.sessions.add(session)
+            await session.serve()
+        except asyncio.CancelledError:
+            pass    # Loop closing; start_server's callback chokes on cancelled tasks
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+            self.admission.release(ip)
+
+    def stop_accepting(self):
+        self.loop.call_soon_threadsafe(self._close_server)
+
+    def _close_server(self):
+        if self.server is not None:
+            self.server.close()
+
+    def stop(self):
+        for session in list(self.sessions):
+            session.abort_transfer()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class AsyncFTPServer(threading.Thread):
+    """
+    Drop-in alternative to FTPServer (same start/stop/join interface).
+    """
+    LISTEN_QUEUE = 1024
+    MAX_SESSIONS = 10000    # Idle sessions cost little here, unlike one thread each
+    TRANSFER_WORKERS = 64   # Data connections served at once, the next ones wait
+
+    def __init__(self, port=8887, server_dir=None, loops=None, io_workers=None,
+                 data_ports=None, listing_cache=None, admission=None, backlog=None,
+                 reuse_port=False, authenticator=None, throttle=None, usage=None,
+                 transfer_workers=None):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            loops = 1   # Can't share the port between loops
+        self.port = port
+        self.loops = loops or os.cpu_count() or 1
+        self._server_dir = server_dir or os.getcwd()
+        self.data_ports = data_ports if data_ports is not None else DataPortPool()
+        self.listing_cache = listing_cache if listing_cache is not None else ListingCache()
+        self.admission = admission if admission is not None else Admission(self.MAX_SESSIONS)
+        self.backlog = backlog or self.LISTEN_QUEUE
+        self.authenticator = authenticator
+        self.throttle = throttle
+        self.usage = usage
+        if usage is not None:
+            usage.index(self._server_dir + ClientSupporter.NAV_FOLDER)  # Walked ahead of logins
+
+        # Bind here, so errors show up on the caller like FTPServer does
+        self._sockets = [self._bind(reuse_port or self.loops > 1) for _ in range(self.loops)]
+
+        self._executor = ThreadPoolExecutor(max_workers=io_workers,
+                                            thread_name_prefix='ftp-io')
+        self._transfers = ThreadPoolExecutor(
+            max_workers=transfer_workers or self.TRANSFER_WORKERS,
+            thread_name_prefix='ftp-transfer')
+        self._workers = [_EventLoopWorker(s, self._server_dir, self._executor, self._transfers,
+                                          self.data_ports, self.listing_cache, self.admission,
+                                          self.authenticator, self.throttle, self.usage)
+                         for s in self._sockets]
+        threading.Thread.__init__(self)
+
+    def _bind(self, reuse_port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', self.port))
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        return sock
+
+    def run(self):
+        for w in self._workers:
+            w.start()
+        for w in self._workers:
+            w.join()
+        self.data_ports.close()
+
+    def stop_accepting(self):
+        """
+        Closes the control port, sessions already open go on.
+        """
+        for w in self._workers:
+            w.stop_accepting()
+
+    def stop(self):
+        # Each loop closes its listening socket on the way out
+        for w in self._workers:
+            w.stop()
+        # Queued commands are dropped and running transfers cut (the interpreter
+        # waits for the pool threads at exit)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._transfers.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Authentication of USER/PASS.
+
+Backends map a user name to a UserRecord, with the password hash and the
+home directory of the user (None for the shared one, see ClientSupporter):
+ - StaticUsers: a dict of names and passwords given in code (the default).
+ - UserFile: a text file with a 'name:hash[:home]' line per user, indexed
+   in a dict and reloaded when it changes.
+
+Authenticator checks the passwords of the sessions:
+ - The hashing (salted scrypt or PBKDF2) runs on a pool of 'verify_workers'
+   threads (hashlib releases the GIL), and at most 'max_pending' logins
+   wait for it: more are refused at once instead of queueing.
+ - A password verified in the last 'cache_ttl' seconds is accepted without
+   hashing it again, and logins with the same credentials arriving while
+   it's being hashed wait for that hash: a login storm after a network
+   blip is mostly the same clients reconnecting.
+ - After 'max_failures' failures in 'failure_window' seconds for one user
+   from one IP, or 'max_ip_failures' from one IP for any users, the next
+   attempts are refused without hashing anything until the window passes.
+   Failures from other IPs don't lock a user out, so nobody can lock a
+   shared account (like the one of the web client) by failing on purpose.
+
+Usage, to add a user to a file or change its password (and home):
+    python auth.py users.txt USER [HOME]
+"""
+
+import base64, collections, getpass, hashlib, hmac, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+LOGINS = metrics.REGISTRY.counter('ftp_logins_total', 'PASS commands, by result', ('result',))
+VERIFY = metrics.REGISTRY.histogram('ftp_password_verify_seconds',
+                                    'Time to hash a password to verify it')
+
+# Results of Authenticator.login
+OK, FAILED, THROTTLED, BUSY = 'ok', 'failed', 'throttled', 'busy'
+
+UserRecord = collections.namedtuple('UserRecord', 'name password home', defaults=(None,))
+
+SCRYPT_PARAMS = (2 ** 14, 8, 1)     # n, r, p: 16 MiB and some 50 ms per hash
+PBKDF2_ITERATIONS = 600000
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def hash_password(password, scheme='scrypt'):
+    """
+    Salted hash of a password, to be stored:
+    'scrypt$n$r$p$salt$hash' or 'pbkdf2_sha256$iterations$salt$hash'.
+    """
+    salt = os.urandom(16)
+    if scheme == 'scrypt':
+        n, r, p = SCRYPT_PARAMS
+        digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p)
+        return f'scrypt${n}${r}${p}${_b64(salt)}${_b64(digest)}'
+    if scheme == 'pbkdf2_sha256':
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, PBKDF2_ITERATIONS)
+        return f'pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64(salt)}${_b64(digest)}'
+    raise ValueError(f'Unknown scheme {scheme}')
+
+
+def verify_password(password, stored):
+    """
+    True if 'password' matches a hash made by 'hash_password'. Slow on purpose.
+    """
+    scheme, _, params = stored.partition('$')
+    try:
+        if scheme == 'scrypt':
+            n, r, p, salt, expected = params.split('$')
+            digest = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt),
+                                    n=int(n), r=int(r), p=int(p))
+        elif scheme == 'pbkdf2_sha256':
+            iterations, salt, expected = params.split('$')
+            digest = hashlib.pbkdf2_hmac('sha256', password.encode(), base64.b64decode(salt),
+                                         int(iterations))
+        else:
+            return False
+    except ValueError:
+        return False    # Malformed entry
+    return hmac.compare_digest(digest, base64.b64decode(expected))
+
+
+class StaticUsers:
+    """
+    Users given as {name: password}, hashed once when created, and their
+    homes as {name: home} (the users left out share the default one).
+    """
+
+    def __init__(self, users, homes=None):
+        homes = homes or {}
+        self._users = {name: UserRecord(name, hash_password(password), homes.get(name))
+                       for name, password in users.items()}
+
+    def get(self, name):
+        return self._users.get(name)
+
+
+class UserFile:
+    """
+    Users of a text file, a 'name:hash[:home]' line each ('#' starts a comment).
+    The whole file is indexed by name; it's read again if it changed, which
+    is checked at most every 'reload_interval' seconds.
+    """
+
+    def __init__(self, path, reload_interval=5):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._users = {}
+        self._mtime = None
+        self._checked = 0
+        self._reload()
+
+    def _reload(self):
+        st = os.stat(self.path)
+        if st.st_mtime_ns == self._mtime:
+            return
+        users = {}
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                name, _, password = line.partition(':')
+                password, _, home = password.partition(':')     # No ':' in the hashes
+                users[name] = UserRecord(name, password, home or None)
+        self._users = users
+        self._mtime = st.st_mtime_ns
+
+    def get(self, name):
+        now = time.monotonic()
+        if now - self._checked > self.reload_interval:
+            with self._lock:
+                if now - self._checked > self.reload_interval:
+                    self._checked = now
+                    try:
+                        self._reload()
+                    except OSError:
+                        pass    # Keep the users we have
+        return self._users.get(name)
+
+
+class _Failures:
+    """
+    Failed logins by key, in a sliding window. Keys of old failures are
+    dropped first when there are more than 'max_keys'.
+    """
+
+    def __init__(self, limit, window, max_keys=100000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._times = collections.OrderedDict()     # Key -> deque of failure times
+
+    def _recent(self, key, now):
+        times = self._times.get(key)
+        if times is None:
+            return None
+        while times and now - times[0] > self.window:
+            times.popleft()
+        if not times:
+            del self._times[key]
+            return None
+        return times
+
+    def blocked(self, key, now):
+        times = self._recent(key, now)
+        return times is not None and len(times) >= self.limit
+
+    def add(self, key, now):
+        times = self._recent(key, now)
+        if times is None:
+            times = self._times[key] = collections.deque(maxlen=self.limit)
+        times.append(now)
+        self._times.move_to_end(key)
+        if len(self._times) > self.max_keys:
+            self._times.popitem(last=False)
+
+    def clear(self, key):
+        self._times.pop(key, None)
+
+
+class Authenticator:
+    DEFAULT_MAX_PENDING = 256
+    DEFAULT_CACHE_TTL = 300     # Seconds
+    DEFAULT_MAX_FAILURES = 5        # For a user from an IP
+    DEFAULT_MAX_IP_FAILURES = 20    # From an IP, NAT may put several users behind it
+    DEFAULT_FAILURE_WINDOW = 60     # Seconds
+
+    def __init__(self, backend, verify_workers=None, max_pending=DEFAULT_MAX_PENDING,
+                 cache_ttl=DEFAULT_CACHE_TTL, max_failures=DEFAULT_MAX_FAILURES,
+                 failure_window=DEFAULT_FAILURE_WINDOW,
+                 max_ip_failures=DEFAULT_MAX_IP_FAILURES):
+        self.backend = backend
+        self.cache_ttl = cache_ttl
+        self._executor = ThreadPoolExecutor(max_workers=verify_workers or os.cpu_count() or 1,
+                                            thread_name_prefix='ftp-auth')
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._failures = _Failures(max_failures, failure_window)       # By (name, IP)
+        self._ip_failures = _Failures(max_ip_failures, failure_window)  # By IP
+        # Verified passwords: name -> (stored hash, HMAC of the password, expiry).
+        # The HMAC key only lives in this process, passwords are never kept.
+        self._cache_key = os.urandom(32)
+        self._cache = {}
+        # Hashes being computed: (stored hash, HMAC) -> Future. The same user logging in
+        # from many connections at once (before the first one is cached) waits for one hash
+        self._verifying = {}
+        # Unknown users cost a hash too, so they can't be told apart by the time taken
+        self._dummy = hash_password(os.urandom(16).hex())
+
+    def _mac(self, password):
+        return hmac.new(self._cache_key, password.encode(), 'sha256').digest()
+
+    def _verify(self, password, stored, key):
+        start = time.perf_counter()
+        try:
+            return verify_password(password, stored)
+        finally:
+            VERIFY.observe(time.perf_counter() - start)
+            with self._lock:
+                del self._verifying[key]
+            self._pending.release()
+
+    def login(self, name, password, ip):
+        """
+        Checks a USER/PASS pair: OK, FAILED, THROTTLED (too many failures)
+        or BUSY (too many logins waiting for a hash). Blocks while hashing.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._ip_failures.blocked(ip, now) or self._failures.blocked((name, ip), now):
+                LOGINS.inc(labels=(THROTTLED,))
+                return THROTTLED
+        record = self.backend.get(name)
+
+        mac = self._mac(password)
+        if record is not None:
+            cached = self._cache.get(name)
+            if cached is not None and cached[0] == record.password and \
+                    hmac.compare_digest(cached[1], mac) and now < cached[2]:
+                LOGINS.inc(labels=('cached',))
+                return OK
+
+        stored = record.password if record is not None else self._dummy
+        key = (stored, mac)
+        with self._lock:
+            verifying = self._verifying.get(key)
+            if verifying is None:
+                if not self._pending.acquire(blocking=False):
+                    LOGINS.inc(labels=(BUSY,))
+                    return BUSY
+                verifying = self._verifying[key] = self._executor.submit(self._verify,
+                                                                         password, stored, key)
+        valid = verifying.result()
+
+        now = time.monotonic()
+        if valid and record is not None:
+            with self._lock:
+                self._failures.clear((name, ip))
+                self._cache[name] = (record.password, mac, now + self.cache_ttl)
+            LOGINS.inc(labels=(OK,))
+            return OK
+        with self._lock:
+            self._ip_failures.add(ip, now)
+            self._failures.add((name, ip), now)
+            self._cache.pop(name, None)
+        LOGINS.inc(labels=(FAILED,))
+        return FAILED
+
+    def home(self, name):
+        """
+        Home directory of a user (None for the default one).
+        """
+        record = self.backend.get(name)
+        return record.home if record is not None else None
+
+
+def _set_password(path, name, home=None):
+    """
+    Adds or updates 'name' in a user file, asking for the password. The
+    home of an existing user is kept unless a new one is given.
+    """
+    password = getpass.getpass(f'Password for {name}: ')
+    if password != getpass.getpass('Again: '):
+        sys.exit('Passwords differ')
+    lines = []
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f.read().splitlines():
+                if line.partition(':')[0] != name:
+                    lines.append(line)
+                elif home is None:
+                    home = line.split(':')[2] if line.count(':') >= 2 else None
+    lines.append(f'{name}:{hash_password(password)}' + (f':{home}' if home else ''))
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp, path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        sys.exit('usage: python auth.py FILE USER [HOME]')
+    _set_password(*sys.argv[1:])
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Idle control connections benchmark: threaded FTPServer vs AsyncFTPServer.
+
+For every engine and connection count, the server is started in a child
+process, N clients connect and stay idle, and then we report:
+ - Server resident memory (VmRSS) with all clients connected.
+ - NOOP round-trip latency (p50/p99) measured on a sample of the clients.
+
+Usage (from the repo root, Linux):
+    python benchmarks/bench_connections.py --counts 1000 5000 10000
+"""
+
+import argparse, json, multiprocessing, os, random, resource, socket, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def _serve(engine, port, ready):
+    # Keep the benchmark output readable
+    sys.stdout = open(os.devnull, 'w')
+    from admission import Admission
+    # Every client comes from 127.0.0.1, and the point is holding as many as possible
+    admission = Admission(max_sessions=1000000, max_per_ip=None)
+    if engine == 'async':
+        from async_server import AsyncFTPServer
+        svr = AsyncFTPServer(port=port, admission=admission)
+    else:
+        from ftp_server import FTPServer
+        svr = FTPServer(port=port, admission=admission, backlog=1024)
+    svr.daemon = True
+    svr.start()
+    ready.set()
+    svr.join()
+
+
+def _rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _recv_reply(sock):
+    data = b''
+    while not data.endswith(b'\r\n'):
+        chunk = sock.recv(256)
+        if not chunk:
+            raise ConnectionError('Server closed the connection')
+        data += chunk
+    return data
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(engine, count, port, samples):
+    ready = multiprocessing.Event()
+    proc = multiprocessing.Process(target=_serve, args=(engine, port, ready), daemon=True)
+    proc.start()
+    ready.wait()
+    time.sleep(0.2)
+    base_rss = _rss_kb(proc.pid)
+
+    clients = []
+    try:
+        for _ in range(count):
+            s = socket.create_connection(('127.0.0.1', port))
+            _recv_reply(s)  # Welcome message
+            clients.append(s)
+        time.sleep(0.5)
+        rss = _rss_kb(proc.pid)
+
+        latencies = []
+        for s in random.choices(clients, k=samples):
+            t = time.perf_counter()
+            s.sendall(b'NOOP\r\n')
+            _recv_reply(s)
+            latencies.append((time.perf_counter() - t) * 1e6)
+    finally:
+        for s in clients:
+            s.close()
+        proc.terminate()
+        proc.join()
+
+    return {
+        'engine': engine,
+        'connections': count,
+        'rss_kb_idle_server': base_rss,
+        'rss_kb': rss,
+        'rss_kb_per_connection': round((rss - base_rss) / count, 2) if rss and base_rss else None,
+        'noop_p50_us': round(_percentile(latencies, 50), 1),
+        'noop_p99_us': round(_percentile(latencies, 99), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--counts', type=int, nargs='+', default=[1000, 5000, 10000])
+    parser.add_argument('--engines', nargs='+', default=['thread', 'async'],
+                        choices=['thread', 'async'])
+    parser.add_argument('--port', type=int, default=9887)
+    parser.add_argument('--samples', type=int, default=2000,
+                        help='NOOP round trips measured per run')
+    args = parser.parse_args()
+
+    # Every idle client costs one fd on each side
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    for count in args.counts:
+        for i, engine in enumerate(args.engines):
+            print(json.dumps(run(engine, count, args.port + i, args.samples)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Control channel command rate benchmark: a NOOP/PWD/SIZE storm.
+
+For every engine, the server is started in a child process and each client
+logs in and sends the NOOP, PWD and SIZE mix, either pipelined in batches
+('--window' commands in flight) or one at a time (window 1), like
+health checks do. Reports commands per second over all the clients.
+
+Usage (from the repo root):
+    python benchmarks/bench_dispatch.py --clients 1 8 --commands 20000 --window 1 64
+"""
+
+import argparse, json, multiprocessing, os, socket, sys, tempfile, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+MIX = (b'NOOP\r\n', b'PWD\r\n', b'SIZE file.txt\r\n')
+
+
+def _serve(engine, port, server_dir, ready):
+    sys.stdout = open(os.devnull, 'w')
+    from admission import Admission
+    admission = Admission(max_per_ip=None)    # Every client comes from 127.0.0.1
+    if engine == 'async':
+        from async_server import AsyncFTPServer
+        svr = AsyncFTPServer(port=port, server_dir=server_dir, admission=admission)
+    else:
+        from ftp_server import FTPServer
+        svr = FTPServer(port=port, server_dir=server_dir, admission=admission)
+    svr.daemon = True
+    svr.start()
+    ready.set()
+    svr.join()
+
+
+class _Replies:
+    """
+    Counts the single line replies received on a socket.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = b''
+
+    def wait(self, count):
+        while True:
+            lines = self.pending.count(b'\r\n')
+            if lines >= count:
+                # Keep whatever belongs to the next replies
+                cut = 0
+                for _ in range(count):
+                    cut = self.pending.index(b'\r\n', cut) + 2
+                self.pending = self.pending[cut:]
+                return
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError('Server closed the connection')
+            self.pending += data
+
+
+def _client(port, commands, window, logged_in, results):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    replies = _Replies(sock)
+    replies.wait(1)
+    sock.sendall(b'USER eps\r\nPASS eps\r\n')
+    replies.wait(2)
+    logged_in.wait()    # Logins (password hashing) aren't part of the measure
+
+    batch = b''.join(MIX[i % len(MIX)] for i in range(window))
+    sent = 0
+    start = time.perf_counter()
+    while sent < commands:
+        sock.sendall(batch)
+        replies.wait(window)
+        sent += window
+    results.append((sent, time.perf_counter() - start))
+    sock.sendall(b'QUIT\r\n')
+    sock.close()
+
+
+def run(port, clients, commands, window):
+    results = []
+    logged_in = threading.Barrier(clients + 1)
+    threads = [threading.Thread(target=_client,
+                                args=(port, commands // clients, window, logged_in, results))
+               for _ in range(clients)]
+    for th in threads:
+        th.start()
+    logged_in.wait()
+    t = time.perf_counter()
+    for th in threads:
+        th.join()
+    elapsed = time.perf_counter() - t
+    return sum(r[0] for r in results), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--engines', nargs='+', default=['thread', 'async'])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--commands', type=int, default=20000, help='total per run')
+    parser.add_argument('--window', type=int, nargs='+', default=[1, 64],
+                        help='commands pipelined per round trip')
+    parser.add_argument('--port', type=int, default=9887)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as server_dir:
+        os.mkdir(os.path.join(server_dir, 'nav'))
+        with open(os.path.join(server_dir, 'nav', 'file.txt'), 'w') as f:
+            f.write('x' * 1024)
+
+        for i, engine in enumerate(args.engines):
+            port = args.port + i
+            ready = multiprocessing.Event()
+            proc = multiprocessing.Process(target=_serve, daemon=True,
+                                           args=(engine, port, server_dir, ready))
+            proc.start()
+            ready.wait()
+            time.sleep(0.2)
+            try:
+                for clients in args.clients:
+                    for window in args.window:
+                        done, elapsed = run(port, clients, args.commands, window)
+                        print(json.dumps({
+                            'engine': engine,
+                            'clients': clients,
+                            'window': window,
+                            'commands': done,
+                            'seconds': round(elapsed, 3),
+                            'commands_per_s': round(done / elapsed),
+                        }))
+            finally:
+                proc.terminate()
+                proc.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+RETR throughput benchmark (binary mode).
+
+Generates files of the given sizes in a temporary server root, starts the
+server in a child process and downloads every file with a client that reads
+into a preallocated buffer, so the client isn't the bottleneck.
+Each size is measured with the sendfile path and with the 'readinto' fallback.
+
+Usage (from the repo root):
+    python benchmarks/bench_retr.py --sizes 1M 100M 2G
+"""
+
+import argparse, ftplib, json, multiprocessing, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(txt):
+    if txt[-1].upper() in UNITS:
+        return int(float(txt[:-1]) * UNITS[txt[-1].upper()])
+    return int(txt)
+
+
+def _serve(port, server_dir, use_sendfile, buffer_size, ready):
+    sys.stdout = open(os.devnull, 'w')
+    from client_supporter import ClientSupporter
+    from ftp_server import FTPServer
+    ClientSupporter.USE_SENDFILE = use_sendfile
+    ClientSupporter.TRANSFER_BUFFER_SIZE = buffer_size
+    svr = FTPServer(port=port, server_dir=server_dir)
+    svr.daemon = True
+    svr.start()
+    ready.set()
+    svr.join()
+
+
+def make_file(path, size):
+    # Real data (not a sparse file), so the page cache holds actual pages
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        left = size
+        while left > 0:
+            f.write(block[:min(left, len(block))])
+            left -= len(block)
+
+
+def download(ftp, name, buf):
+    conn = ftp.transfercmd('RETR ' + name)
+    total = 0
+    start = time.perf_counter()
+    n = conn.recv_into(buf)
+    while n:
+        total += n
+        n = conn.recv_into(buf)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    ftp.voidresp()
+    return total, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', nargs='+', default=['1M', '100M', '2G'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--buffer', default='4M', help='TRANSFER_BUFFER_SIZE of the fallback')
+    parser.add_argument('--port', type=int, default=9987)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as server_dir:
+        os.mkdir(os.path.join(server_dir, 'nav'))
+        sizes = [parse_size(s) for s in args.sizes]
+        for size in sizes:
+            make_file(os.path.join(server_dir, 'nav', f'{size}.bin'), size)
+
+        for i, use_sendfile in enumerate([True, False]):
+            port = args.port + i
+            ready = multiprocessing.Event()
+            proc = multiprocessing.Process(target=_serve, daemon=True,
+                                           args=(port, server_dir, use_sendfile,
+                                                 parse_size(args.buffer), ready))
+            proc.start()
+            ready.wait()
+            time.sleep(0.2)
+            try:
+                ftp = ftplib.FTP()
+                ftp.set_pasv(False)
+                ftp.connect('127.0.0.1', port)
+                ftp.login('eps', 'eps')
+                ftp.voidcmd('TYPE I')
+                buf = memoryview(bytearray(4 * 1024 * 1024))
+                for size in sizes:
+                    best = None
+                    for _ in range(args.repeat):
+                        total, elapsed = download(ftp, f'{size}.bin', buf)
+                        assert total == size, (total, size)
+                        best = elapsed if best is None else min(best, elapsed)
+                    print(json.dumps({
+                        'path': 'sendfile' if use_sendfile else 'readinto',
+                        'size_bytes': size,
+                        'best_seconds': round(best, 4),
+                        'mb_per_s': round(size / best / 1024 ** 2, 1),
+                    }))
+                ftp.quit()
+            finally:
+                proc.terminate()
+                proc.join()
+
+
+if __name__ == '__main__':
+    main()
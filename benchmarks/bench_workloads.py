@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Mixed workload benchmark: N concurrent clients against a loopback server.
+
+A tree is generated in a temporary server root, then for every engine the
+server is started in a child process and each workload is run with every
+client count. Every client has its own control connection and does
+'--ops' operations, timing each one:
+ - login:       connect, USER/PASS, QUIT (a login storm).
+ - list:        LIST of a directory with '--tree' entries.
+ - retr-small:  RETR of small files, picked at random.
+ - stor-small:  STOR of small files, each client in its own names.
+ - retr-large:  RETR of one large file (streaming).
+ - stor-large:  STOR of a large file.
+ - churn:       RNFR/RNTO and DELE of a file (its STOR isn't timed).
+
+Reports, per engine, workload and client count, one JSON line with ops/s
+over all the clients, p50/p99 latency of an operation and MB/s moved on
+data connections. '--output' also saves the whole run, to compare later.
+
+Usage (from the repo root):
+    python benchmarks/bench_workloads.py --clients 1 16 --ops 200
+    python benchmarks/bench_workloads.py --workloads list churn --output before.json
+"""
+
+import argparse, ftplib, io, json, multiprocessing, os, platform, random, sys, tempfile
+import threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bench_retr import make_file, parse_size
+
+WORKLOADS = ('login', 'list', 'retr-small', 'stor-small', 'retr-large', 'stor-large', 'churn')
+SMALL_FILES = 100
+
+
+def _serve(engine, port, server_dir, ready):
+    sys.stdout = open(os.devnull, 'w')
+    from admission import Admission
+    admission = Admission(max_per_ip=None)    # Every client comes from 127.0.0.1
+    if engine == 'async':
+        from async_server import AsyncFTPServer
+        svr = AsyncFTPServer(port=port, server_dir=server_dir, admission=admission)
+    else:
+        from ftp_server import FTPServer
+        svr = FTPServer(port=port, server_dir=server_dir, admission=admission,
+                        backlog=1024)     # Login storms
+    svr.daemon = True
+    svr.start()
+    ready.set()
+    svr.join()
+
+
+def make_tree(root, entries, small_size, large_size):
+    nav = os.path.join(root, 'nav')
+    for name in ('tree', 'small', 'upload'):
+        os.makedirs(os.path.join(nav, name))
+    for i in range(entries):
+        if i % 10 == 0:
+            os.mkdir(os.path.join(nav, 'tree', f'dir{i:07d}'))
+        else:
+            with open(os.path.join(nav, 'tree', f'file{i:07d}.txt'), 'wb') as f:
+                f.write(b'x' * (i % 4096))
+    for i in range(SMALL_FILES):
+        make_file(os.path.join(nav, 'small', f'{i}.bin'), small_size)
+    make_file(os.path.join(nav, 'large.bin'), large_size)
+
+
+class Client:
+    """
+    One simulated client: a logged in ftplib connection in binary mode.
+    Each operation returns the data bytes it moved.
+    """
+
+    def __init__(self, port, index, small_data, large_size):
+        self.port = port
+        self.index = index
+        self.small_data = small_data
+        self.large_size = large_size
+        self.buf = memoryview(bytearray(1024 * 1024))
+        self.count = 0
+        self.ftp = self._login()
+
+    def _login(self):
+        ftp = ftplib.FTP()
+        ftp.connect('127.0.0.1', self.port)
+        ftp.login('eps', 'eps')
+        ftp.voidcmd('TYPE I')
+        return ftp
+
+    def close(self):
+        try:
+            self.ftp.quit()
+        except ftplib.all_errors:
+            self.ftp.close()
+
+    def _read(self, cmd):
+        conn = self.ftp.transfercmd(cmd)
+        total = 0
+        n = conn.recv_into(self.buf)
+        while n:
+            total += n
+            n = conn.recv_into(self.buf)
+        conn.close()
+        self.ftp.voidresp()
+        return total
+
+    def _name(self):
+        self.count += 1
+        return f'upload/c{self.index}-{self.count}.bin'
+
+    def prepare(self, workload):
+        """
+        Untimed setup before each operation.
+        """
+        if workload == 'churn':
+            self.churn_name = self._name()
+            self.ftp.storbinary('STOR ' + self.churn_name, io.BytesIO(self.small_data))
+
+    def login(self):
+        self._login().quit()
+        return 0
+
+    def list(self):
+        return self._read('LIST tree')
+
+    def retr_small(self):
+        return self._read(f'RETR small/{random.randrange(SMALL_FILES)}.bin')
+
+    def stor_small(self):
+        self.ftp.storbinary('STOR ' + self._name(), io.BytesIO(self.small_data))
+        return len(self.small_data)
+
+    def retr_large(self):
+        return self._read('RETR large.bin')
+
+    def stor_large(self):
+        conn = self.ftp.transfercmd(f'STOR upload/c{self.index}-large.bin')
+        block = self.buf[:len(self.buf)]
+        left = self.large_size
+        while left > 0:
+            conn.sendall(block[:min(left, len(block))])
+            left -= len(block)
+        conn.close()
+        self.ftp.voidresp()
+        return self.large_size
+
+    def churn(self):
+        renamed = self.churn_name + '.old'
+        self.ftp.rename(self.churn_name, renamed)
+        self.ftp.delete(renamed)
+        return 0
+
+
+def _client(port, index, workload, ops, small_data, large_size, start, results):
+    client = Client(port, index, small_data, large_size)
+    operation = getattr(client, workload.replace('-', '_'))
+    latencies = []
+    moved = 0
+    start.wait()
+    for _ in range(ops):
+        client.prepare(workload)
+        t = time.perf_counter()
+        moved += operation()
+        latencies.append(time.perf_counter() - t)
+    client.close()
+    results.append((latencies, moved))
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(port, workload, clients, ops, small_data, large_size):
+    results = []
+    start = threading.Barrier(clients + 1)
+    threads = [threading.Thread(target=_client,
+                                args=(port, i, workload, ops, small_data, large_size,
+                                      start, results))
+               for i in range(clients)]
+    for th in threads:
+        th.start()
+    start.wait()    # Every client logged in
+    t = time.perf_counter()
+    for th in threads:
+        th.join()
+    elapsed = time.perf_counter() - t
+
+    latencies = sorted(l for r in results for l in r[0])
+    moved = sum(r[1] for r in results)
+    return {
+        'ops': len(latencies),
+        'seconds': round(elapsed, 3),
+        'ops_per_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(_percentile(latencies, .5) * 1000, 3),
+        'p99_ms': round(_percentile(latencies, .99) * 1000, 3),
+        'mb_per_s': round(moved / elapsed / 1024 ** 2, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--engines', nargs='+', default=['thread', 'async'])
+    parser.add_argument('--workloads', nargs='+', default=list(WORKLOADS), choices=WORKLOADS)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 16])
+    parser.add_argument('--ops', type=int, default=100, help='per client and workload')
+    parser.add_argument('--large-ops', type=int, default=3,
+                        help='per client, for retr-large and stor-large')
+    parser.add_argument('--tree', type=int, default=10000, help='entries listed by LIST')
+    parser.add_argument('--small', default='4K', help='size of the small files')
+    parser.add_argument('--large', default='100M', help='size of the large file')
+    parser.add_argument('--port', type=int, default=9787)
+    parser.add_argument('--output', default=None, help='also save the run to this JSON file')
+    args = parser.parse_args()
+
+    small_size, large_size = parse_size(args.small), parse_size(args.large)
+    small_data = os.urandom(small_size)
+    results = []
+    with tempfile.TemporaryDirectory() as server_dir:
+        make_tree(server_dir, args.tree, small_size, large_size)
+        upload = os.path.join(server_dir, 'nav', 'upload')
+
+        for i, engine in enumerate(args.engines):
+            port = args.port + i
+            ready = multiprocessing.Event()
+            proc = multiprocessing.Process(target=_serve, daemon=True,
+                                           args=(engine, port, server_dir, ready))
+            proc.start()
+            ready.wait()
+            time.sleep(0.2)
+            try:
+                for workload in args.workloads:
+                    ops = args.large_ops if workload.endswith('-large') else args.ops
+                    for clients in args.clients:
+                        result = {'engine': engine, 'workload': workload, 'clients': clients}
+                        result.update(run(port, workload, clients, ops, small_data, large_size))
+                        results.append(result)
+                        print(json.dumps(result), flush=True)
+                        # Start every run from the same tree
+                        for name in os.listdir(upload):
+                            os.remove(os.path.join(upload, name))
+            finally:
+                proc.terminate()
+                proc.join()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'args': vars(args),
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
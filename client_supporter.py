@@ -35,11 +35,37 @@ https://www.adamsmith.haus/python/answers/how-to-call-a-function-by-its-name-as-
 """
 
 
-import threading, os, socket, time
+import os, socket, time, posixpath, codecs, stat, collections, logging, shutil
 
+from virtual_fs import VirtualFS, INSIDE
+import auth
+from throttle import Throttle, parse_rate, format_rate
+from usage import QuotaExceeded
+from mlst import FactsFormatter, format_time
+import metrics
+
+log = logging.getLogger('ftp.session')
+xferlog = logging.getLogger('ftp.xfer')
+
+# Users of the default authenticator, when the server isn't given one (see auth.py)
 users = {
     'eps': 'eps'
 }
+_default_auth = None
+
+def default_authenticator():
+    global _default_auth
+    if _default_auth is None:
+        _default_auth = auth.Authenticator(auth.StaticUsers(users))
+    return _default_auth
+
+_default_throttle = None
+
+def default_throttle():
+    global _default_throttle
+    if _default_throttle is None:
+        _default_throttle = Throttle()     # No limits
+    return _default_throttle
 
 cmds_available = {
     'HELP': True,
@@ -54,26 +80,163 @@ cmds_available = {
     'NOOP': True,
     'SYST': True,
     'PORT': True,
+    'PASV': True,
+    'EPSV': True,
     'LIST': True,
     'NLST': True,
     'RETR': True,
     'STOR': True,
     'APPE': True,
+    'ALLO': True,
+    'REST': True,
     'DELE': True,
     'RNFR': True,
     'RNTO': True,
     'RMD': True,
     'MKD': True,
-    'CWD': True
+    'CWD': True,
+    'MLSD': True,
+    'MLST': True,
+    'SIZE': True,
+    'MDTM': True,
+    'FEAT': True,
+    'SITE': True,
+    'AVBL': True
 }
 cmds_3_chars_0_args = {
     'PWD': True
 }
 
+# Argument policies
+ARGS_NONE = 0       # 'NOOP'
+ARGS_OPTIONAL = 1   # 'LIST' or 'LIST dir'
+ARGS_REQUIRED = 2   # 'RETR file'
+
+# needs_auth: only after a successful USER/PASS.
+# data_conn: opens a data connection. The asyncio engine runs these in its
+#            transfer pool, apart from the short blocking verbs.
+# blocking: touches the filesystem or the network, hence may block. The
+#           asyncio engine runs these in its executor instead of the event loop.
+CommandSpec = collections.namedtuple('CommandSpec', 'needs_auth args data_conn blocking')
+
+cmd_specs = {
+    'HELP': CommandSpec(False, ARGS_NONE, False, False),
+    'OPTS': CommandSpec(False, ARGS_REQUIRED, False, False),
+    'TYPE': CommandSpec(False, ARGS_REQUIRED, False, False),
+    'USER': CommandSpec(False, ARGS_REQUIRED, False, False),
+    'PASS': CommandSpec(False, ARGS_OPTIONAL, False, True),     # Hashing
+    'REIN': CommandSpec(False, ARGS_NONE, False, True),
+    'QUIT': CommandSpec(False, ARGS_NONE, False, False),
+    'CDUP': CommandSpec(True, ARGS_NONE, False, True),
+    'NOOP': CommandSpec(False, ARGS_NONE, False, False),
+    'SYST': CommandSpec(False, ARGS_NONE, False, False),
+    'PORT': CommandSpec(True, ARGS_REQUIRED, False, False),
+    'PASV': CommandSpec(True, ARGS_NONE, False, False),
+    'EPSV': CommandSpec(True, ARGS_OPTIONAL, False, False),
+    'LIST': CommandSpec(True, ARGS_OPTIONAL, True, True),
+    'NLST': CommandSpec(True, ARGS_OPTIONAL, True, True),
+    'RETR': CommandSpec(True, ARGS_REQUIRED, True, True),
+    'STOR': CommandSpec(True, ARGS_REQUIRED, True, True),
+    'APPE': CommandSpec(True, ARGS_REQUIRED, True, True),
+    'ALLO': CommandSpec(True, ARGS_REQUIRED, False, False),
+    'REST': CommandSpec(True, ARGS_REQUIRED, False, False),
+    'DELE': CommandSpec(True, ARGS_REQUIRED, False, True),
+    'RNFR': CommandSpec(True, ARGS_REQUIRED, False, True),
+    'RNTO': CommandSpec(True, ARGS_REQUIRED, False, True),
+    'RMD': CommandSpec(True, ARGS_REQUIRED, False, True),
+    'MKD': CommandSpec(True, ARGS_REQUIRED, False, True),
+    'CWD': CommandSpec(True, ARGS_REQUIRED, False, True),
+    'PWD': CommandSpec(True, ARGS_NONE, False, False),
+    'MLSD': CommandSpec(True, ARGS_OPTIONAL, True, True),
+    'MLST': CommandSpec(True, ARGS_OPTIONAL, False, True),
+    'SIZE': CommandSpec(True, ARGS_REQUIRED, False, True),
+    'MDTM': CommandSpec(True, ARGS_REQUIRED, False, True),
+    'FEAT': CommandSpec(False, ARGS_NONE, False, False),
+    'SITE': CommandSpec(True, ARGS_REQUIRED, False, True),     # QUOTA resolves a path
+    'AVBL': CommandSpec(True, ARGS_OPTIONAL, False, True),
+}
+
 ASCII = 'ascii'
 UTF8 = 'utf-8'
 
-class ClientSupporter(threading.Thread):
+class LineReader:
+    """
+    Splits the control connection stream into request lines.
+    Keeps partial lines between reads, so requests can be split or
+    merged (pipelined) by TCP in any way.
+    """
+    TOO_LONG = object()     # Returned in place of a line over 'max_line' bytes
+
+    def __init__(self, max_line):
+        self.max_line = max_line
+        self._buf = bytearray()
+        self._discarding = False    # Skipping the rest of a too long line
+
+    def feed(self, data):
+        self._buf += data
+
+    def next_line(self):
+        """
+        Next complete line without its CRLF, TOO_LONG, or None
+        if more data is needed.
+        """
+        end = self._buf.find(b'\n')
+        if end < 0:
+            if len(self._buf) > self.max_line:
+                self._buf.clear()
+                if not self._discarding:
+                    self._discarding = True
+                    return self.TOO_LONG
+            return None
+
+        line = bytes(self._buf[:end])
+        del self._buf[:end + 1]
+        if self._discarding:
+            self._discarding = False
+            return self.next_line()
+        if len(line) > self.max_line:
+            return self.TOO_LONG
+        return line[:-1] if line.endswith(b'\r') else line
+
+class ReplyBuffer:
+    """
+    Socket-like wrapper that holds replies until 'flush', so the replies
+    to pipelined requests leave in a single 'sendall'. Preliminary (1xx)
+    replies are sent at once, as the client waits for them before using
+    the data connection.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buf = bytearray()
+
+    def send(self, data):
+        self._buf += data
+        metrics.REPLIES.inc(labels=(data[:3].decode('ascii', 'replace'),))
+        if data[:1] == b'1':
+            self.flush()
+        return len(data)
+
+    sendall = send
+
+    def flush(self):
+        if self._buf:
+            # A new buffer, not 'clear()': the socket may write the old one later
+            data, self._buf = self._buf, bytearray()
+            self.sock.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+def _enabled_commands():
+    """
+    Specs of the commands enabled in 'cmds_available'/'cmds_3_chars_0_args'.
+    """
+    enabled = [c for c, on in cmds_available.items() if on is True]
+    enabled += [c for c, on in cmds_3_chars_0_args.items() if on is True]
+    return {c: cmd_specs[c] for c in enabled}
+
+class ClientSupporter:
     """
     The idea is the following:
       --> Server accepts a client and creates a ClientSupporter
@@ -83,98 +246,190 @@ class ClientSupporter(threading.Thread):
       --> ClientSupporter calls for 'recv()' and waits for client actions, repeatedly.
         --> ClientSupporter will end when QUIT command is received.
     """
-    CLIENT_MAX_SIZE_MSG = 256   # Buffer for client messages
-    READ_SIZE = 1024            # Buffer for reading files
-    WRITE_SIZE = 1024           # Buffer for writing files
+    CLIENT_MAX_SIZE_MSG = 4096  # Buffer for client messages
+    MAX_LINE_SIZE = 8192        # Longest request accepted
+    READ_SIZE = 64 * 1024       # Buffer for reading text files
+    WRITE_SIZE = 1024 * 1024    # Buffer for receiving files
+    TRANSFER_BUFFER_SIZE = 4 * 1024 * 1024  # Max buffer for binary transfers without sendfile
+    USE_SENDFILE = hasattr(os, 'sendfile')  # Zero-copy binary RETR
     DEFAULT_DATA_PORT = 8888    #20
-    NAV_FOLDER = '/nav'
-    NAV_FOLDER_AS_REL_PATH = 'nav/'
+    DATA_CONN_TIMEOUT = 30      # Seconds waiting for the client in passive mode
+    DATA_TIMEOUT = 60           # Seconds a data connection may stall in a transfer
+    IDLE_TIMEOUT = 300          # Seconds without requests before closing a session
+    IDLE_MSG = '421 Idle timeout, closing control connection.'
+    NAV_FOLDER = '/nav'         # Root of the users without a home of their own
+    SYMLINKS = INSIDE           # Symlink policy of the session roots, see virtual_fs.py
+    WELCOME_MSG = '220 Carlos FTP Server (Version 0.5) ready'
+    COMMANDS = _enabled_commands()
     
 
-    def __init__(self, client_connection, client_address, server_dir):
+    def __init__(self, client_connection, client_address, server_dir, data_ports=None,
+                 listing_cache=None, authenticator=None, throttle=None, usage=None):
         self.cli_conn = client_connection
         self.cli_addr = client_address  # Both IP and Port number from client
         self.data_addr = client_address[0]
         self.data_port = self.DEFAULT_DATA_PORT
+        self.data_conn = None
+        self.data_ports = data_ports    # Server DataPortPool, for passive mode
+        self.passive_sock = None        # Listening socket taken from 'data_ports'
+        self.listing_cache = listing_cache  # Server ListingCache, shared by all sessions
+        self.auth = authenticator or default_authenticator()
+        self.limiter = (throttle or default_throttle()).session()  # Bandwidth limits
+        self.usage = usage      # Server Usage, None when disk usage isn't accounted
+        self.mlst = FactsFormatter()    # Facts selected with 'OPTS MLST'
 
         self.encoding = ASCII
         self.binary = False
-        self.parse = lambda a: f'{a}\r\n'.encode(self.encoding)         # For control port data
-        self.parse_code = lambda a: f'{a}\r\n'.encode(self.encoding)    # For response code
-        self.parse_item = lambda a: f'{a}\r\n'.encode(self.encoding)    # For LST and NLST
-        self.decode = lambda a: a.decode(self.encoding)
 
         self.file_to_rename = None
+        self._transfer_buf = None       # Reused by transfers, see '_get_transfer_buffer'
+        self._transfer_start = None     # When the data connection was opened
+        self._transfer_bytes = 0        # Sent or received on the data connection
+        self._reserved = 0              # Quota reserved by the upload in progress
+        self._aborted = False           # Data connection cut by 'abort_transfer'
+        self.alloc_size = None          # Bytes announced by ALLO for the next STOR/APPE
+        self.rest_offset = 0            # Set by REST for the next RETR/STOR/APPE
         self.user = None
+        self.logged_in = False          # USER accepted and PASS verified
+        self.server_dir = server_dir
         self.root_dir = server_dir + self.NAV_FOLDER
-        self.curr_dir = self.root_dir
-        os.chdir(self.root_dir)
+        self.fs = VirtualFS(self.root_dir, self.SYMLINKS)  # Session cwd, no process-wide chdir
+        self.log = logging.LoggerAdapter(log, {'client': client_address[0],
+                                               'port': client_address[1]})
 
         self._quit = False
-        threading.Thread.__init__(self)
-    
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._DISPATCH = cls._dispatch_table()
+
+    @classmethod
+    def _dispatch_table(cls):
+        """
+        Verb -> (spec, handler function), so dispatching a request is a single
+        lookup. Built once per class, not per session.
+        """
+        return {verb: (spec, getattr(cls, verb)) for verb, spec in cls.COMMANDS.items()}
+
+    def parse(self, a):
+        """
+        For control port data.
+        """
+        return f'{a}\r\n'.encode(self.encoding)
+
+    parse_code = parse  # For response code
+
+    def decode(self, a):
+        return a.decode(self.encoding)
+
     def run(self):
         conn = self.cli_conn
+        self.cli_conn = ReplyBuffer(conn)
         parse = self.parse_code
+        lines = LineReader(self.MAX_LINE_SIZE)
+        # Idle sessions would hold a worker of the server pool
+        conn.settimeout(self.IDLE_TIMEOUT)
 
-
-        print(f"[{threading.get_ident()}] Cliente conectado")
-        conn.send(parse('220 Carlos FTP Server (Version 0.5) ready'))
-        while self._quit is False:
-            req = self.decode(conn.recv(self.CLIENT_MAX_SIZE_MSG))[:-2]
-            print(f"[{threading.get_ident()}] Recibido: _{req}_")
-            if req:
-                try:
-                    # Get method callback
-                    # Ensure the 3 char CMDs non-parametrized are available
-                    if len(req) == 3 and ''.join(req) not in cmds_3_chars_0_args:
-                        conn.send(parse('502 Method not implemented'))
-                        continue
-                    
-                    f = ''.join(req[:4])
-                    if f[-1] == ' ':    # Get the 3 char CMDs parametrized
-                        f = f[:3]
-                    
-                    # If not recognised, respond and exit
-                    exit = False
-                    if f not in cmds_available:
-                        exit = True
-                    if f in cmds_available:
-                        if cmds_available[f] is False:
-                            exit = True
-                    if exit:
-                        conn.send(parse('502 Method not implemented'))
-                        continue
-
-                    # Get callback as function
-                    func = getattr(self, f.upper())
-
-                    # Get params
-                    txt = ''
-                    if len(f) == 4 and len(req) > 4:
-                        txt = req[5:]
-                    elif len(f) == 3 and len(req) > 3:
-                        txt = req[4:]
-
-                    # Call function with its params
-                    func(txt)
-                
-                except Exception as e:
-                    print(e)
-                    # Function is recognised but couldn't be called properly
-                    conn.send(parse('501 Parameter syntax error'))
+        self.log.info('Cliente conectado')
+        metrics.SESSIONS.inc()
+        self.cli_conn.send(parse(self.WELCOME_MSG))
+        try:
+            while self._quit is False:
+                line = lines.next_line()
+                if line is None:
+                    # Every complete request is answered, send replies and wait for more
+                    self.cli_conn.flush()
+                    data = conn.recv(self.CLIENT_MAX_SIZE_MSG)
+                    if not data:
+                        break
+                    lines.feed(data)
                     continue
-            
-            else:
-                break
-        print(f"[{threading.get_ident()}] Cliente desconectado")
-    
-    def HELP(self, msg):
-        # Just accept the generic HELP cmd
-        if msg:
+
+                req = self._decode_line(line)
+                if req:
+                    self._handle_request(req)
+            self.cli_conn.flush()
+        except socket.timeout:
+            self.log.info('Idle timeout')
+            self._send_quietly(parse(self.IDLE_MSG))
+        except OSError:
+            pass    # Connection lost
+        finally:
+            metrics.SESSIONS.dec()
+            self._release_passive()
+            self.fs.close()
+            self.log.info('Cliente desconectado')
+
+    def _send_quietly(self, reply):
+        try:
+            self.cli_conn.send(reply)
+            self.cli_conn.flush()
+        except OSError:
+            pass
+
+    def _decode_line(self, line):
+        """
+        Request text of a line given by LineReader, or None (answering
+        the client if needed) when there's nothing to execute.
+        """
+        if line is LineReader.TOO_LONG:
+            self.cli_conn.send(self.parse_code('500 Line too long.'))
+            return None
+        try:
+            req = self.decode(line)
+        except UnicodeDecodeError:
+            self.cli_conn.send(self.parse_code('501 Parameter syntax error'))
+            return None
+
+        if log.isEnabledFor(logging.DEBUG):
+            shown = 'PASS ****' if req[:5].upper() == 'PASS ' else req
+            self.log.debug('Recibido: %s', shown)
+        return req or None
+
+    def _parse_request(self, req):
+        """
+        Looks up the handler of a request and applies the checks common to
+        every command (implemented, logged in, arguments). Returns
+        (spec, handler, argument), or None if the client was answered.
+        """
+        verb, _, arg = req.partition(' ')
+        cmd = self._DISPATCH.get(verb.upper())
+        if cmd is None:
+            self.cli_conn.send(self.parse_code('502 Method not implemented'))
+            return None
+
+        spec = cmd[0]
+        if spec.needs_auth and not self.logged_in:
+            self.cli_conn.send(self.parse_code('530 Not connected.'))
+            return None
+        if spec.args == ARGS_NONE and arg:
             self.cli_conn.send(self.parse_code('501 No parameters accepted.'))
-            return
+            return None
+        if spec.args == ARGS_REQUIRED and not arg:
+            self.cli_conn.send(self.parse_code('501 Parameter syntax error'))
+            return None
+        return spec, cmd[1], arg
 
+    def _execute(self, spec, handler, arg):
+        start = time.perf_counter()
+        try:
+            handler(self, arg)
+        except Exception as e:
+            self.log.error('%s failed: %s', handler.__name__, e, exc_info=True)
+            # Function is recognised but couldn't be called properly
+            self.cli_conn.send(self.parse_code('501 Parameter syntax error'))
+        metrics.COMMANDS.observe(time.perf_counter() - start, (handler.__name__,))
+
+    def _handle_request(self, req):
+        """
+        Executes a single client request (without the trailing CRLF).
+        Shared by the threaded loop in 'run' and the asyncio engine.
+        """
+        cmd = self._parse_request(req)
+        if cmd is not None:
+            self._execute(*cmd)
+
+    def HELP(self, msg):
         # Loop through all cmds available
         desc = '211 Commands implemented: '
         for c in cmds_available.keys():
@@ -190,6 +445,12 @@ class ClientSupporter(threading.Thread):
 
     def OPTS(self, msg):
         args = msg.split(" ")
+        if args[0].upper() == 'MLST':
+            # Select the facts of MLST/MLSD, 'OPTS MLST' alone disables all of them
+            facts = args[1].split(';') if len(args) == 2 else []
+            self.mlst = FactsFormatter(facts)
+            self.cli_conn.send(self.parse_code(f'200 MLST OPTS {self.mlst.opts_reply()}'))
+            return
         if len(args) == 2:
             if args[1] == 'ON':
                 if args[0] == 'UTF8':
@@ -204,11 +465,9 @@ class ClientSupporter(threading.Thread):
         """
         User log-in.
         """
-        if msg not in users:
-            self.cli_conn.send(self.parse_code('530 User doesn\'t exist.'))
-            return
-
+        # Unknown users are refused at PASS, not to tell which ones exist
         self.user = msg
+        self.logged_in = False      # A new login starts
         self.cli_conn.send(self.parse_code('331 Password needed.'))
     
     def PASS(self, msg):
@@ -219,36 +478,69 @@ class ClientSupporter(threading.Thread):
         if self.user is None:       # USER cmd not used
             self.cli_conn.send(self.parse_code('503 Incorrect sequence.'))
             return
-        if self.user not in users:  # USER not accepted
-            self.cli_conn.send(self.parse_code('530 User not connected.'))
+        result = self.auth.login(self.user, msg, self.cli_addr[0])
+        if result == auth.THROTTLED:
+            self.cli_conn.send(self.parse_code('530 Too many failed logins, try again later.'))
+            return
+        if result == auth.BUSY:
+            self.cli_conn.send(self.parse_code('530 Server busy, try again later.'))
             return
-        if users[self.user] != msg: # Wrong password
-            self.cli_conn.send(self.parse_code('530 Wrong password.'))
+        if result != auth.OK:
+            self.log.info('Login failed for %s', self.user)
+            self.cli_conn.send(self.parse_code('530 Wrong user or password.'))
             return
-            
+
+        try:
+            self._set_home(self.auth.home(self.user))
+            if self.usage is not None:
+                self.usage.index(self.fs.root_dir)     # First login: walked in the background
+        except OSError:
+            self.log.error('Home of %s not available', self.user, exc_info=True)
+            self.cli_conn.send(self.parse_code('530 Home directory not available.'))
+            return
+
+        self.logged_in = True
+        self.limiter.login(self.user)
         self.cli_conn.send(self.parse_code('230 User connected, please continue.'))
+
+    def _set_home(self, home):
+        """
+        Roots the session at a home directory, created if missing: relative
+        to the server folder or absolute, NAV_FOLDER for None. The user can't
+        leave it for the rest of the session.
+        """
+        if home:
+            root = os.path.normpath(os.path.join(self.server_dir, home))
+        else:
+            root = self.server_dir + self.NAV_FOLDER
+        if root == self.root_dir:
+            self.fs.cwd = '/'
+            return
+        os.makedirs(root, exist_ok=True)
+        fs = VirtualFS(root, self.SYMLINKS)
+        self.fs.close()
+        self.fs = fs
+        self.root_dir = root
     
     def REIN(self, msg):
-        if msg:
-            self.cli_conn(self.parse_code('502 Syntax error.'))
-            return
-
+        self._release_passive()
+        self.data_addr = self.cli_addr[0]
         self.data_port = self.DEFAULT_DATA_PORT
-        self.curr_dir = self.root_dir
-        os.chdir(self.root_dir)
+        self._set_home(None)
         self.encoding = ASCII
         self.binary = False
         self.user = None
+        self.logged_in = False
+        self.limiter.login(None)
+        self.alloc_size = None
+        self.rest_offset = 0
+        self.mlst = FactsFormatter()
         self.cli_conn.send(self.parse_code(f'220 Service prepared for new user.'))
 
     def QUIT(self, msg):
         """
         Quit user, hence thread dies.
         """
-        if msg:
-            self.cli_conn(self.parse_code('502 Syntax error.'))
-            return
-        
         self._quit = True
         self.cli_conn.send(self.parse_code(f'221 Bye.'))
     
@@ -256,265 +548,556 @@ class ClientSupporter(threading.Thread):
         """
         No operation.
         """
-        if msg:
-            self.cli_conn(self.parse_code('502 Syntax error.'))
-            return
-
         self.cli_conn.send(self.parse_code('220 OK.'))
     
     def SYST(self, msg):
         """
         Give information about the server.
         """
-        if msg:
-            self.cli_conn(self.parse_code('502 Syntax error.'))
-            return
-
         self.cli_conn.send(self.parse_code('215 CarlosFTPServer system type.'))
 
     def CDUP(self, msg):
         """
         Change to parent directory.
         """
-        if msg:
-            self.cli_conn(self.parse_code('502 Syntax error.'))
-            return
-        if self.user is None:
-            self.cli_conn.send(self.parse_code('530 Not connected.'))
-            return
-
-        depth_aimed, tot_depth = self._get_depth(['..'])
-        if tot_depth < 0:
+        try:
+            self.fs.chdir('..')
+        except PermissionError:
             self.cli_conn.send(self.parse_code('450 Not available, access forbidden.'))
             return
 
-        os.chdir('..')
-        self.curr_dir = os.getcwd()
         self.cli_conn.send(self.parse_code('200 OK.'))
 
     def CWD(self, msg):
-        if self.user is None:
-            self.cli_conn.send(self.parse_code('530 Not connected.'))
-            return
-
-        # Get depth aimed by client
-        path = msg.split('/')
-        depth_aimed, tot_depth = self._get_depth(path)
-
-        """
-        If total_depth is negative or depth_aimed is negative and the query starts with /<path_remaining>,
-        then reject the query from client.
-        """
-        if  (tot_depth < 0) or \
-            (path[0] == '' and depth_aimed < 0):
+        try:
+            self.fs.chdir(msg)
+        except PermissionError:
             self.cli_conn.send(self.parse_code('450 Not available, access forbidden.'))
             return
-
-        if msg == '/':
-            msg=self.root_dir
-        elif msg[0] == '/':
-            msg=self.root_dir + msg
-        
-        try:
-            os.chdir(msg)
         except OSError:
             self.cli_conn.send(self.parse_code('501 Incorrect path.'))
             return
 
-        self.curr_dir = os.getcwd()
         self.cli_conn.send(self.parse_code('250 OK.'))
 
+    def PWD(self, msg):
+        """
+        Print working directory, as seen by the client.
+        """
+        cwd = self.fs.cwd.replace('"', '""')
+        self.cli_conn.send(self.parse_code(f'257 "{cwd}" is the current directory.'))
+
     def PORT(self, msg):
         """
         Set a PORT and a IP to create future Data channels.
         """
-        if self.user is None:
-            self.cli_conn.send(self.parse_code('530 Not connected.'))
-            return
-
         data = msg.split(',')
         try:
             self.data_addr = '.'.join(data[:4])                 # Get IP
             self.data_port = (int(data[4]) << 8) + int(data[5]) # Get port
         except:
             self.cli_conn.send(self.parse_code('501 Parameter syntax error'))
-        
+            return
+
+        self._release_passive()     # Back to active mode
         self.cli_conn.send(self.parse_code('200 PORT succesful.'))
 
-    def LIST(self, msg):
+    def _enter_passive(self):
         """
-        Returns same format as 'ls -l' from UNIX systems.
+        Take a listening socket from the server pool for the next transfer.
+        Returns its port, or None if the client was answered with an error.
         """
-        if self.user is None:
-            self.cli_conn.send(self.parse_code('530 Not connected.'))
+        self._release_passive()
+        self.passive_sock = self.data_ports.acquire() if self.data_ports else None
+        if self.passive_sock is None:
+            self.cli_conn.send(self.parse_code('425 No data port available, try again.'))
+            return None
+        return self.passive_sock.getsockname()[1]
+
+    def _release_passive(self):
+        if self.passive_sock is not None:
+            self.data_ports.release(self.passive_sock)
+            self.passive_sock = None
+
+    def PASV(self, msg):
+        """
+        Passive mode: the client opens the data connection to the server.
+        """
+        port = self._enter_passive()
+        if port is None:
             return
 
+        ip = self.data_ports.public_address or self.cli_conn.getsockname()[0]
+        addr = ','.join(ip.split('.') + [str(port >> 8), str(port & 0xFF)])
+        self.cli_conn.send(self.parse_code(f'227 Entering Passive Mode ({addr}).'))
 
-        # Make up a 'ls -l' format type
-        listed = os.listdir('.')
-        if msg:
-            # Operate path of the directory
-            path = msg.split('/')
+    def EPSV(self, msg):
+        """
+        Extended passive mode (RFC 2428), only the port is given to the client.
+        """
+        if msg.upper() == 'ALL':
+            self.cli_conn.send(self.parse_code('200 EPSV ALL accepted.'))
+            return
+        if msg and msg != '1':      # IPv4 only
+            self.cli_conn.send(self.parse_code('522 Network protocol not supported, use (1).'))
+            return
 
-            # Ensure depth aimed by user is correct
-            depth_aimed, tot_depth = self._get_depth(path)
-            if  tot_depth < 0 or \
-                (path[0] == '' and depth_aimed < 0):
-                self.cli_conn.send(self.parse_code('550 Not available, access forbidden.'))
-                return
+        port = self._enter_passive()
+        if port is None:
+            return
 
-            if msg == '/':
-                msg=self.root_dir
-            elif msg[0] == '/':
-                msg=self.root_dir + msg
+        self.cli_conn.send(self.parse_code(f'229 Entering Extended Passive Mode (|||{port}|).'))
 
-            # Verify path exists
-            msg_path = '/'.join(path)
-            if msg_path != '' and not os.path.exists(msg_path):
-                self.cli_conn.send(self.parse_code('501 Path incorrect.'))
-                return
+    def _open_data_connection(self):
+        """
+        Open the data connection for a transfer: accept the client on the
+        pooled socket in passive mode, or connect to the PORT address.
+        Returns False if it couldn't be opened.
+        """
+        start = time.perf_counter()
+        self._aborted = False
+        try:
+            if self.passive_sock is not None:
+                self.passive_sock.settimeout(self.DATA_CONN_TIMEOUT)
+                while True:
+                    conn, addr = self.passive_sock.accept()
+                    if addr[0] == self.cli_addr[0]:
+                        break
+                    conn.close()    # Someone else than our client
+                self.data_conn = conn
+            else:
+                self.data_conn = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+                self.data_conn.settimeout(self.DATA_CONN_TIMEOUT)
+                self.data_conn.connect((self.data_addr,self.data_port))
+            # A client that stops reading or sending mustn't hold the thread forever
+            self.data_conn.settimeout(self.DATA_TIMEOUT)
+        except OSError:
+            self._close_data_connection()
+            return False
+        self._transfer_start = time.perf_counter()
+        self._transfer_bytes = 0
+        metrics.DATA_CONNECT.observe(self._transfer_start - start)
+        return True
+
+    def _close_data_connection(self):
+        """
+        Close the data connection and give the passive port back to the pool.
+        """
+        if self.data_conn is not None:
+            self.data_conn.close()
+            self.data_conn = None
+            if self._transfer_start is not None:
+                metrics.TRANSFERS.observe(time.perf_counter() - self._transfer_start)
+                self._transfer_start = None
+        self._release_passive()
 
-            # Verify user is listing a directory
-            if not os.path.isdir(msg):
-                self.cli_conn.send(self.parse_code('550 Not a directory.'))
-                return
-            
-            # Swap to new directory
-            listed = os.listdir(msg)
-            if msg[-1] != '/': msg += '/'
+    def abort_transfer(self):
+        """
+        Cuts the data connection from another thread (server stopping): the
+        transfer using it fails at once and cleans up in its own thread. An
+        upload sees the end of its data, '_aborted' tells it from a real one.
+        """
+        conn = self.data_conn
+        if conn is not None:
+            self._aborted = True
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _resolve(self, msg, code='550'):
+        """
+        Normalise a client path once. Returns its virtual path, or None
+        (after replying to the client) if it's outside of the user root,
+        symlinks included.
+        """
+        try:
+            return self.fs.resolve(msg)
+        except PermissionError:
+            self.cli_conn.send(self.parse_code(f'{code} Not available, access forbidden.'))
+            return None
+
+    def _list_target(self, msg):
+        """
+        Common checks of LIST and NLST. Returns (virtual path, stat) of
+        the directory to list, or None if the client was answered.
+        """
+        path = self._resolve(msg or '.')
+        if path is None:
+            return None
+
+        # Verify path exists
+        try:
+            st = self.fs.stat(path)
+        except OSError:
+            self.cli_conn.send(self.parse_code('501 Path incorrect.'))
+            return None
+
+        # Verify user is listing a directory
+        if not stat.S_ISDIR(st.st_mode):
+            self.cli_conn.send(self.parse_code('550 Not a directory.'))
+            return None
+
+        return path, st
+
+    def _get_listing(self, path, dir_stat, kind, formatter):
+        """
+        Encoded listing of a directory, from the server listing cache if it's
+        still valid. 'formatter' turns the 'os.scandir' entries into text.
+        """
+        key = (kind, self.encoding)
+        data = self.listing_cache.get(dir_stat, key) if self.listing_cache else None
+        if data is None:
+            with self.fs.scandir(path) as entries:
+                data = formatter(entries).encode(self.encoding)
+            if self.listing_cache:
+                self.listing_cache.put(dir_stat, key, data)
+        return data
+
+    def _invalidate_listing(self, path):
+        """
+        Forget the cached listings of the directory holding 'path',
+        after a verb changed it.
+        """
+        if self.listing_cache is None:
+            return
+        try:
+            self.listing_cache.invalidate(self.fs.stat(posixpath.dirname(path)))
+        except OSError:
+            pass
+
+    def _file_size(self, path):
+        """
+        Size of the regular file at 'path', None if there's none.
+        """
+        try:
+            st = self.fs.stat(path)
+        except OSError:
+            return None
+        return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+    def _account(self, path, nbytes, files):
+        """
+        Report a change in the directory holding 'path' to the usage index.
+        """
+        if self.usage is not None:
+            self.usage.add(self.fs.root_dir, posixpath.dirname(path), nbytes, files)
+
+    def _account_file(self, path, old_size):
+        """
+        Account a file written by STOR/APPE, which had 'old_size' bytes
+        before (None if it didn't exist), and give back the quota reserved
+        while it was received.
+        """
+        if self.usage is not None:
+            new_size = self._file_size(path)
+            self._account(path, (new_size or 0) - (old_size or 0),
+                          (new_size is not None) - (old_size is not None))
+            self.usage.release(self.fs.root_dir, self._reserved)
+            self._reserved = 0
+
+    @staticmethod
+    def _overwritten(old_size, offset):
+        """
+        Bytes of a file of 'old_size' bytes a STOR from 'offset' (APPE:
+        None) writes over: they take no more room.
+        """
+        if old_size is None or offset is None:
+            return 0
+        return max(0, old_size - offset)
+
+    def _quota_room(self, path, old_size, offset):
+        """
+        Bytes a STOR from 'offset' (APPE: None) of a file of 'old_size'
+        bytes may receive under the quota: None for no limit, 0 for none.
+        """
+        if self.usage is None:
+            return None
+        if old_size is None and self.usage.files_left(self.fs.root_dir) == 0:
+            return 0
+        room = self.usage.room(self.fs.root_dir)
+        if room is not None:
+            room += self._overwritten(old_size, offset)
+        return room
+
+    def _reserve(self, n, free):
+        """
+        Reserve the quota for the 'n' bytes just received, but for the
+        'free' first bytes of the transfer (written over the old content).
+        Raises QuotaExceeded when the root has no room left for them.
+        """
+        extra = min(n, self._transfer_bytes + n - free)
+        if extra > 0:
+            if not self.usage.reserve(self.fs.root_dir, extra):
+                raise QuotaExceeded()
+            self._reserved += extra
+
+    def _refuse_quota(self):
+        """
+        Reply to a command the quota leaves no room for: 552, or 450 (try
+        again) while the usage of the root is still being computed.
+        """
+        if self.usage.ready(self.fs.root_dir):
+            self.cli_conn.send(self.parse_code('552 Quota exceeded.'))
+        else:
+            self.cli_conn.send(self.parse_code('450 Disk usage being computed, try again later.'))
+
+    def _discard_upload(self, path, old_size, offset):
+        """
+        Undo a STOR from 'offset' (APPE: None) aborted by the quota: a file
+        resumed or appended to is cut back to its 'old_size', a new or
+        replaced one (its old content is gone already) is removed.
+        """
+        try:
+            if old_size is not None and offset != 0:
+                with self.fs.open(path, 'r+b') as f:
+                    f.truncate(old_size)
+            else:
+                self.fs.remove(path)
+        except OSError:
+            self.log.warning('Partial upload %s left behind', path, exc_info=True)
+
+    @staticmethod
+    def _format_list(entries):
+        """
+        'ls -l' lines. Dates are formatted once per distinct minute.
+        """
+        lines = []
+        dates = {}
+        for entry in entries:
+            try:
+                s = entry.stat()
+            except OSError:
+                continue    # E.g. broken symlink
+            minute = int(s.st_mtime) // 60
+            t = dates.get(minute)
+            if t is None:
+                t = dates[minute] = time.strftime(' %b %d %H:%M ', time.gmtime(s.st_mtime))
+            # TODO '1 user group' must be obtained from os
+            lines.append(f'{stat.filemode(s.st_mode)} 1 user group {s.st_size}{t}{entry.name}\r\n')
+        return ''.join(lines)
+
+    @staticmethod
+    def _format_nlst(entries):
+        return ''.join(f'{entry.name}\r\n' for entry in entries)
+
+    def _send_listing(self, msg, kind, formatter):
+        """
+        Common part of the listing verbs: build the listing and write
+        it with a single 'sendall'.
+        """
+        target = self._list_target(msg)
+        if target is None:
+            return
 
         # Open data connection
         self.cli_conn.send(self.parse_code(f'150 Opening ASCII mode data connection.'))
-        self.data_conn = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        try:
-            self.data_conn.connect((self.data_addr,self.data_port))
-        except:
+        if not self._open_data_connection():
             self.cli_conn.send(self.parse_code('425 Data conection cannot be opened.'))
             return
 
-        item_parsed = ''
-        base_mode = 'rwx'*3
         try:
-            for item in listed:
-                s = os.stat(msg+item)
-                final_mode = ''
-
-                # Guess the 'r', 'w', 'x', '-' mode
-                for i in range(1, len(base_mode)):
-                    final_mode += ((s.st_mode >> (8-i)) & 1) and base_mode[i] or '-'
-                
-                # Type of file ('d' -> Directory, '-' -> Any other)
-                dir = 'd' if os.path.isdir(item) else '-'
-                
-                # Date
-                t = time.strftime(' %b %d %H:%M ', time.gmtime(s.st_mtime))
-                
-                # Parse full item
-                item_parsed = dir + final_mode + ' 1 user group ' + str(s.st_size) + t + os.path.basename(item)
-                # TODO '1 user group' must be obtained from os
-                self.data_conn.send(self.parse_item(item_parsed))
+            data = self._get_listing(*target, kind, formatter)
+            self._send_data(data)
+            metrics.BYTES_SENT.inc(len(data))
         except Exception as e:
-            print(e)
-            self.data_conn.close()
+            self.log.error('Listing failed: %s', e)
+            self._close_data_connection()
             self.cli_conn.send(self.parse_code('451 Interrupted. Local error.'))
             return
 
-        
-        self.data_conn.close()
+        self._close_data_connection()
         self.cli_conn.send(self.parse_code('226 Closing data connection.'))
+
+    def LIST(self, msg):
+        """
+        Returns same format as 'ls -l' from UNIX systems.
+        """
+        self._send_listing(msg, 'LIST', self._format_list)
     
     def NLST(self, msg):
         """
         Returns file and directory names.
         """
-        if self.user is None:
-            self.cli_conn.send(self.parse_code('530 Not connected.'))
-            return
+        self._send_listing(msg, 'NLST', self._format_nlst)
 
-        # Make up a 'ls -l' format type
-        listed = os.listdir('.')
-        if msg:
-            # Operate path of the directory
-            path = msg.split('/')
+    def MLSD(self, msg):
+        """
+        Machine-readable listing of a directory (RFC 3659).
+        """
+        self._send_listing(msg, ('MLSD',) + self.mlst.facts, self.mlst.format_entries)
 
-            # Ensure depth aimed by user is correct
-            depth_aimed, tot_depth = self._get_depth(path)
-            if  tot_depth < 0 or \
-                (path[0] == '' and depth_aimed < 0):
-                self.cli_conn.send(self.parse_code('550 Not available, access forbidden.'))
-                return
+    def MLST(self, msg):
+        """
+        Facts of a single file or directory, sent on the control connection.
+        """
+        path = self._resolve(msg or '.')
+        if path is None:
+            return
+        try:
+            st = self.fs.stat(path)
+        except OSError:
+            self.cli_conn.send(self.parse_code('550 File not found.'))
+            return
 
-            if msg == '/':
-                msg=self.root_dir
-            elif msg[0] == '/':
-                msg=self.root_dir + msg
+        facts = self.mlst.format(path, st)
+        self.cli_conn.send(self.parse(f'250-Listing {path}\r\n {facts}250 End.'))
 
-            # Verify path exists
-            msg_path = '/'.join(path)
-            if msg_path != '' and not os.path.exists(msg_path):
-                self.cli_conn.send(self.parse_code('501 Path incorrect.'))
-                return
+    def _stat_file(self, msg):
+        """
+        Stat of a regular file for SIZE and MDTM, or None if the client was answered.
+        """
+        path = self._resolve(msg)
+        if path is None:
+            return None
+        try:
+            st = self.fs.stat(path)
+        except OSError:
+            self.cli_conn.send(self.parse_code('550 File not found.'))
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            self.cli_conn.send(self.parse_code('550 Not a file.'))
+            return None
+        return st
+
+    def SIZE(self, msg):
+        """
+        Size of a file in bytes.
+        """
+        st = self._stat_file(msg)
+        if st is not None:
+            self.cli_conn.send(self.parse_code(f'213 {st.st_size}'))
 
-            # Verify user is listing a directory
-            if not os.path.isdir(msg):
-                self.cli_conn.send(self.parse_code('550 Not a directory.'))
-                return
-            
-            # Swap to new directory
-            listed = os.listdir(msg)
-            if msg[-1] != '/': msg += '/'
+    def MDTM(self, msg):
+        """
+        Last modification time of a file (UTC).
+        """
+        st = self._stat_file(msg)
+        if st is not None:
+            self.cli_conn.send(self.parse_code(f'213 {format_time(st.st_mtime)}'))
 
-        # Open data connection
-        self.cli_conn.send(self.parse_code(f'150 Opening ASCII mode data connection.'))
-        self.data_conn = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        try:
-            self.data_conn.connect((self.data_addr,self.data_port))
-        except:
-            self.cli_conn.send(self.parse_code('425 Data conection cannot be opened.'))
+    def FEAT(self, msg):
+        """
+        Extensions supported (RFC 2389), available before login.
+        """
+        features = [FactsFormatter.feat_line()]
+        for c in ('AVBL', 'EPSV', 'MDTM', 'PASV', 'SIZE'):
+            if cmds_available.get(c) is True:
+                features.append(c)
+        if cmds_available.get('REST') is True:
+            features.append('REST STREAM')
+        features.append('UTF8')
+
+        lines = ''.join(f' {f}\r\n' for f in sorted(features))
+        self.cli_conn.send(self.parse(f'211-Features:\r\n{lines}211 End'))
+
+    def SITE(self, msg):
+        """
+        Server specific commands: 'SITE <command> [parameters]'.
+        """
+        name, _, arg = msg.partition(' ')
+        handler = getattr(self, 'SITE_' + name.upper(), None)
+        if handler is None:
+            self.cli_conn.send(self.parse_code('504 SITE command not implemented.'))
             return
+        handler(arg)
 
-        for item in listed:
-            self.data_conn.send(self.parse_item(item))
-        
-        self.data_conn.close()
-        self.cli_conn.send(self.parse_code('226 Closing data connection.'))
-    
-    def _get_actual_rel_path(self):
+    def SITE_STATS(self, msg):
         """
-        Get depth + build rel. path from <root>/.
+        Server wide metrics (see 'metrics.summary').
         """
-        curr = self.curr_dir.split('/')
-        root = self.root_dir.split('/')
-        j = len(root)
-        s = self.NAV_FOLDER_AS_REL_PATH
-        for i in range(1, len(curr)-j+1):
-            s += curr[j-1+i] + '/'
-        
-        return s
-    
-    def _get_depth(self, path_aimed):
+        lines = ''.join(f' {line}\r\n' for line in metrics.summary())
+        self.cli_conn.send(self.parse(f'211-Server statistics:\r\n{lines}211 End'))
+
+    def SITE_QUOTA(self, msg):
         """
-        Returns a tuple (depth_aimed, total_depth) so the function
-        calling can decide what to do.
+        Disk usage of the user root (or of a directory) and its quota,
+        from the usage index.
         """
-        # Get current depth
-        curr = self.curr_dir.split('/')
-        root = self.root_dir.split('/')
-        act_depth = len(curr) - len(root)
-        
-        # Get depth aimed by client
-        depth_aimed = 0
-        for item in path_aimed:
-            if item == '..': 
-                depth_aimed -= 1
-            elif item != '':        # Avoid '/' character ('' by split)
-                depth_aimed += 1
-            if -depth_aimed > act_depth:
-                return -1, -1
-
-        tot_depth = act_depth + depth_aimed
-        return depth_aimed, tot_depth
-    
+        if self.usage is None:
+            self.cli_conn.send(self.parse_code('502 Disk usage is not accounted.'))
+            return
+        path = self._resolve(msg.strip() or '/')
+        if path is None:
+            return
+        index = self.usage.index(self.fs.root_dir)
+        nbytes, files = index.get(path)
+        quota = []
+        if self.usage.quota_bytes is not None:
+            quota.append(f'{self.usage.quota_bytes} bytes')
+        if self.usage.quota_files is not None:
+            quota.append(f'{self.usage.quota_files} files')
+        scanned = format_time(index.scanned) + ' UTC' if index.scanned else 'running'
+        used = f'{nbytes} bytes in {files} files' if index.scanned else 'not known yet'
+        lines = (f' Used: {used}\r\n'
+                 f' Quota: {", ".join(quota) or "none"}\r\n'
+                 f' Last scan: {scanned}\r\n')
+        self.cli_conn.send(self.parse(f'211-Disk usage of {path}:\r\n{lines}211 End'))
+
+    def SITE_LIMIT(self, msg):
+        """
+        Bandwidth limits (see throttle.py), in bytes per second:
+        'SITE LIMIT' shows them, 'SITE LIMIT SESSION <rate>' sets the one of
+        this session, 'SITE LIMIT USER <name> <rate>' and 'SITE LIMIT SERVER
+        <rate>' are for the admins. Rates like '512K' or '10M', 0 for none.
+        """
+        limiter = self.limiter
+        throttle = limiter.throttle
+        args = msg.split()
+        if not args:
+            user = format_rate(limiter.user.rate) if limiter.user is not None else 'unlimited'
+            lines = (f' Server: {format_rate(throttle.rate)}\r\n'
+                     f' User {self.user}: {user}\r\n'
+                     f' Session: {format_rate(limiter.bucket.rate)}\r\n')
+            self.cli_conn.send(self.parse(f'211-Transfer limits:\r\n{lines}211 End'))
+            return
+
+        scope = args[0].upper()
+        try:
+            rate = parse_rate(args[-1])
+        except ValueError:
+            self.cli_conn.send(self.parse_code('501 Incorrect rate.'))
+            return
+        if len(args) != (3 if scope == 'USER' else 2) or scope not in ('SESSION', 'USER', 'SERVER'):
+            self.cli_conn.send(self.parse_code(
+                '501 Syntax: SITE LIMIT [SESSION|USER <name>|SERVER] <rate>'))
+            return
+
+        admin = self.user in throttle.admins
+        if scope == 'SESSION':
+            # Only admins may go over the default limit of the sessions
+            cap = throttle.session_rate
+            if not admin and cap is not None and (rate is None or rate > cap):
+                self.cli_conn.send(self.parse_code(f'550 Session limit is at most {format_rate(cap)}.'))
+                return
+            limiter.bucket.set_rate(rate)
+        elif not admin:
+            self.cli_conn.send(self.parse_code('550 Not available, access forbidden.'))
+            return
+        elif scope == 'USER':
+            throttle.user_bucket(args[1]).set_rate(rate)
+        else:
+            throttle.set_rate(rate)
+        self.log.info('Limit of %s set to %s', ' '.join(args[:-1]), format_rate(rate))
+        self.cli_conn.send(self.parse_code(f'200 Limit set to {format_rate(rate)}.'))
+
+    def AVBL(self, msg):
+        """
+        Bytes that can still be stored in a directory: the free disk space,
+        or less if the quota leaves less.
+        """
+        path = self._resolve(msg or '.')
+        if path is None:
+            return
+        if not self.fs.isdir(path):
+            self.cli_conn.send(self.parse_code('550 Not a directory.'))
+            return
+        available = shutil.disk_usage(self.fs.real_path(path)).free
+        room = self.usage.room(self.fs.root_dir) if self.usage is not None else None
+        if room is not None:
+            available = min(available, room)
+        self.cli_conn.send(self.parse_code(f'213 {available}'))
+
     def TYPE(self, msg):
         """
         Change file format tranfer.
@@ -526,6 +1109,7 @@ class ClientSupporter(threading.Thread):
         elif msg.lower() == 'a':    # ASCII
             self.encoding = ASCII
             self.binary = False
+            self.rest_offset = 0    # Byte offsets are meaningless for text
             self.cli_conn.send(self.parse_code('200 ASCII mode enabled.'))
             return
 
@@ -535,240 +1119,386 @@ class ClientSupporter(threading.Thread):
         """
         Send file content to client.
         """
-        if self.user is None:
-            self.cli_conn.send(self.parse_code('530 Not connected.'))
-            return
+        offset, self.rest_offset = self.rest_offset, 0
         
+        path = self._resolve(msg, '450')
+        if path is None:
+            return
+
         # Verify path exists
-        if not os.path.exists(msg):
+        if not self.fs.exists(path):
             self.cli_conn.send(self.parse_code('501 File not found.'))
             return
 
         # Verify user is retrieving a file
-        if os.path.isdir(msg):
+        if self.fs.isdir(path):
             self.cli_conn.send(self.parse_code('450 Not a file.'))
             return
 
         # Open data connection
         self.cli_conn.send(self.parse_code('150 Opening data connection.'))
-        self.data_conn = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        try:
-            self.data_conn.connect((self.data_addr,self.data_port))
-        except:
+        if not self._open_data_connection():
             self.cli_conn.send(self.parse_code('425 Data conection cannot be opened.'))
             return
 
         # Send data
         try:
             if self.binary is False:
-                with open(msg, 'r') as f:
+                with self.fs.open(path, 'r') as f:
                     data = f.read(self.READ_SIZE)
                     while data:
-                        self.data_conn.send(data.encode(self.encoding))
+                        self._send_data(data.encode(self.encoding))
                         data = f.read(self.READ_SIZE)
             else:
-                with open(msg, 'rb') as f:
-                    data = f.read(self.READ_SIZE)
-                    while data:
-                        self.data_conn.send(data)
-                        data = f.read(self.READ_SIZE)
+                with self.fs.open(path, 'rb', buffering=0) as f:
+                    self._send_binary(f, offset)
         except:
-            self.data_conn.close()
+            self._log_transfer(path, 'RETR', complete=False)
+            self._close_data_connection()
             bin = 'disabled' if self.binary is False else 'enabled'
             desc = f'450 Binary mode is {bin}. Cannot send requested file.'
             self.cli_conn.send(self.parse_code(desc))
             return
         
         # Close data connection
-        self.data_conn.close()
+        self._log_transfer(path, 'RETR')
+        self._close_data_connection()
         self.cli_conn.send(self.parse_code('250 File transferred succesfully.'))
 
+    def _log_transfer(self, path, verb, complete=True):
+        """
+        Account a file transfer of 'verb' (RETR, STOR or APPE), before closing its
+        data connection: metrics and a 'ftp.xfer' record (direction 'o'ut or 'i'n).
+        """
+        direction = 'o' if verb == 'RETR' else 'i'
+        (metrics.BYTES_SENT if direction == 'o' else metrics.BYTES_RECEIVED).inc(self._transfer_bytes)
+        if xferlog.isEnabledFor(logging.INFO):
+            seconds = time.perf_counter() - (self._transfer_start or time.perf_counter())
+            xferlog.info('%s %s', verb, path, extra={
+                'client': self.cli_addr[0], 'user': self.user, 'verb': verb, 'path': path,
+                'bytes': self._transfer_bytes, 'seconds': round(seconds, 6),
+                'direction': direction, 'binary': self.binary, 'complete': complete})
+
+    def _get_transfer_buffer(self, size):
+        """
+        Returns a memoryview of at least 'size' bytes (up to TRANSFER_BUFFER_SIZE),
+        reusing the session buffer so transfers don't allocate per chunk.
+        """
+        size = max(1, min(size, self.TRANSFER_BUFFER_SIZE))
+        if self._transfer_buf is None or len(self._transfer_buf) < size:
+            self._transfer_buf = memoryview(bytearray(size))
+        return self._transfer_buf[:size]
+
+    def _send_data(self, data):
+        """
+        'sendall' on the data connection, in chunks paced by the bandwidth
+        limits if there are any.
+        """
+        chunk = self.limiter.chunk_size()
+        if chunk is None:
+            self.data_conn.sendall(data)
+            self._transfer_bytes += len(data)
+            return
+        view = memoryview(data)
+        for i in range(0, len(view), chunk):
+            part = view[i:i + chunk]
+            self.limiter.wait(len(part), self._transfer_bytes)
+            self.data_conn.sendall(part)
+            self._transfer_bytes += len(part)
+
+    def _send_binary(self, f, offset=0):
+        """
+        Send an unbuffered binary file through the data connection, from 'offset'.
+        Zero-copy with sendfile, else 'readinto' a reusable buffer sized
+        after the file (small files don't need a multi-MB buffer).
+        """
+        size = os.fstat(f.fileno()).st_size
+        chunk = self.limiter.chunk_size()
+        if self.USE_SENDFILE:
+            if chunk is None:
+                self._transfer_bytes += self.data_conn.sendfile(f, offset)
+                return
+            pos = offset
+            while pos < size:
+                n = min(chunk, size - pos)
+                self.limiter.wait(n, pos - offset)
+                n = self.data_conn.sendfile(f, pos, n)
+                if not n:
+                    break
+                pos += n
+                self._transfer_bytes += n
+            return
+
+        f.seek(offset)
+        buf = self._get_transfer_buffer(min(chunk or size, size - offset))
+        n = f.readinto(buf)
+        while n:
+            self._send_data(buf[:n])
+            n = f.readinto(buf)
+
     def STOR(self, msg):
         """
         Create a file or replace its content with new data.
         """
-        if self.user is None:
-            self.cli_conn.send(self.parse_code('530 Not connected.'))
-            return
+        offset, self.rest_offset = self.rest_offset, 0
         
-        # Operate path of the file to append
-        path = msg.split('/')
-        path.pop()
-
-        # Ensure depth aimed by user is correct
-        _, tot_depth = self._get_depth(path)
-        if tot_depth < 0:
-            self.cli_conn.send(self.parse_code('450 Not available, access forbidden.'))
+        path = self._resolve(msg, '450')
+        if path is None:
             return
 
-        # Verify path exists
-        msg_path = '/'.join(path)
-        if msg_path != '' and not os.path.exists(msg_path):
+        # Verify parent directory exists
+        if not self.fs.isdir(posixpath.dirname(path)):
             self.cli_conn.send(self.parse_code('501 Path incorrect.'))
             return
 
+        # Check the quota before anything is sent
+        old_size = self._file_size(path) if self.usage is not None else None
+        room = self._quota_room(path, old_size, offset)
+        if room == 0:
+            self._refuse_quota()
+            return
+
         # Open data connection
         self.cli_conn.send(self.parse_code('150 Opening data connection.'))
-        self.data_conn = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        try:
-            self.data_conn.connect((self.data_addr,self.data_port))
-        except:
+        if not self._open_data_connection():
             self.cli_conn.send(self.parse_code('425 Data conection cannot be opened.'))
             return
         
         # Get file transferred by user
         try:
-            self._store_file(msg)
+            free = None if room is None else self._overwritten(old_size, offset)
+            self._receive_file(path, offset=offset, free=free)
+            self._invalidate_listing(path)
+        except QuotaExceeded:
+            self._discard_upload(path, old_size, offset)
+            self.cli_conn.send(self.parse_code('552 Quota exceeded, transfer aborted.'))
+            self._log_transfer(path, 'STOR', complete=False)
+            self._close_data_connection()
+            return
         except OSError as e:
             if e.errno == 21:
                 desc = f'450 Aiming a directory. Cannot store requested file.'
-                self.cli_conn.send(self.parse_code(desc))
-                self.data_conn.close()
-                return
+            elif isinstance(e, (socket.timeout, ConnectionError)):
+                desc = '426 Connection closed, transfer aborted.'
+                self._invalidate_listing(path)     # Partly written, kept for a REST
+            else:
+                desc = f'451 Local error, cannot store requested file.'
+            self.cli_conn.send(self.parse_code(desc))
+            self._log_transfer(path, 'STOR', complete=False)
+            self._close_data_connection()
+            return
         except:
                 bin = 'disabled' if self.binary is False else 'enabled'
                 desc = f'450 Binary mode is {bin}. Cannot store requested file.'
                 self.cli_conn.send(self.parse_code(desc))
-                self.data_conn.close()
+                self._log_transfer(path, 'STOR', complete=False)
+                self._close_data_connection()
                 return
+        finally:
+            self._account_file(path, old_size)
 
         # Close data connection
-        self.data_conn.close()
+        self._log_transfer(path, 'STOR')
+        self._close_data_connection()
         self.cli_conn.send(self.parse_code('250 File transferred succesfully.'))
     
-    def _store_file(self, msg):
+    def _receive_file(self, path, append=False, offset=0, free=None):
         """
-        Private function to store given content.
+        Private function to store the content sent through the data connection.
+        Data is received into the reusable session buffer, and text is decoded
+        incrementally so multibyte characters split between chunks are kept.
+        With 'offset' (REST) the data is written in place from that byte on.
+        Unless 'free' is None (no quota) the bytes received past the 'free'
+        first ones are reserved under the quota as they come, see '_reserve'.
         """
+        alloc_size, self.alloc_size = self.alloc_size, None
+        preallocate = bool(alloc_size) and hasattr(os, 'posix_fallocate')
+        chunk = self.limiter.chunk_size()     # None: no bandwidth limits
+        buf = self._get_transfer_buffer(chunk or self.WRITE_SIZE)
+        mode = 'a' if append else 'w'
+        if offset or (append and preallocate):
+            # O_TRUNC would lose what REST resumes from, and with O_APPEND
+            # the data would land after the preallocated space
+            self.fs.open(path, 'ab').close()
+            mode = 'r+'
+
         # Store ASCII/UTF-8/... file (.txt, .php, ...)
         if self.binary is False:
-            with open(msg, 'w') as f:
-                data = self.decode(self.data_conn.recv(self.WRITE_SIZE))
-                f.write(data)
-                while data:
-                    data = self.decode(self.data_conn.recv(self.WRITE_SIZE))
-                    f.write(data)
+            decoder = codecs.getincrementaldecoder(self.encoding)()
+            with self.fs.open(path, mode) as f:
+                size = self._seek_and_preallocate(f, offset, preallocate and alloc_size)
+                n = self.data_conn.recv_into(buf)
+                while n:
+                    if free is not None:
+                        self._reserve(n, free)
+                    f.write(decoder.decode(buf[:n]))
+                    if chunk:
+                        self.limiter.wait(n, self._transfer_bytes)
+                    self._transfer_bytes += n
+                    n = self.data_conn.recv_into(buf)
+                if self._aborted:
+                    raise ConnectionAbortedError('Data connection cut')
+                f.write(decoder.decode(b'', final=True))
+                if preallocate:
+                    f.truncate(max(f.tell(), size))
         
         # Store BINARY file (.jpeg, .mp4, ...)
         else:
-            with open(msg, 'wb') as f:
-                data = self.data_conn.recv(self.WRITE_SIZE)
-                f.write(data)
-                while data:
-                    data = self.data_conn.recv(self.WRITE_SIZE)
-                    f.write(data)
+            with self.fs.open(path, mode + 'b') as f:
+                size = self._seek_and_preallocate(f, offset, preallocate and alloc_size)
+                n = self.data_conn.recv_into(buf)
+                while n:
+                    if free is not None:
+                        self._reserve(n, free)
+                    f.write(buf[:n])
+                    if chunk:
+                        self.limiter.wait(n, self._transfer_bytes)
+                    self._transfer_bytes += n
+                    n = self.data_conn.recv_into(buf)
+                if self._aborted:
+                    raise ConnectionAbortedError('Data connection cut')
+                if preallocate:
+                    f.truncate(max(f.tell(), size))
+
+    def _seek_and_preallocate(self, f, offset, alloc_size):
+        """
+        Place the file at the write position ('offset' or its end), and
+        reserve disk space for 'alloc_size' more bytes as announced by ALLO.
+        Returns the file size before preallocating, so the caller can
+        truncate what wasn't written.
+        """
+        size = os.fstat(f.fileno()).st_size
+        f.seek(offset) if offset else f.seek(0, os.SEEK_END)
+        if alloc_size:
+            try:
+                os.posix_fallocate(f.fileno(), size, alloc_size)
+            except OSError:
+                pass    # Not supported by the filesystem, just a hint anyway
+        return size
 
     def APPE(self, msg):
         """
         Append content to an existing or new file.
+        After REST, content is written from that offset instead.
         """
-        if self.user is None:
-            self.cli_conn.send(self.parse_code('530 Not connected.'))
+        offset, self.rest_offset = self.rest_offset, 0
+        path = self._resolve(msg, '450')
+        if path is None:
             return
 
-        # Operate path of the file to append
-        path = msg.split('/')
-        path.pop()
-
-        # Ensure depth aimed by user is correct
-        _, tot_depth = self._get_depth(path)
-        if tot_depth < 0:
-            self.cli_conn.send(self.parse_code('450 Not available, access forbidden.'))
+        # Verify parent directory exists
+        if not self.fs.isdir(posixpath.dirname(path)):
+            self.cli_conn.send(self.parse_code('501 Path incorrect.'))
             return
 
-        # Verify path exists
-        msg_path = '/'.join(path)
-        if msg_path != '' and not os.path.exists(msg_path):
-            self.cli_conn.send(self.parse_code('501 Path incorrect.'))
+        # Check the quota before anything is sent
+        old_size = self._file_size(path) if self.usage is not None else None
+        room = self._quota_room(path, old_size, None)
+        if room == 0:
+            self._refuse_quota()
             return
 
         # Open data connection
         self.cli_conn.send(self.parse_code('150 Opening data connection.'))
-        self.data_conn = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        try:
-            self.data_conn.connect((self.data_addr,self.data_port))
-        except:
+        if not self._open_data_connection():
             self.cli_conn.send(self.parse_code('425 Data conection cannot be opened.'))
             return
         
         # Get file transferred by user
         try:
-            self._append_file(msg)
+            free = None if room is None else self._overwritten(old_size, None)
+            self._receive_file(path, append=True, offset=offset, free=free)
+            self._invalidate_listing(path)
+        except QuotaExceeded:
+            self._discard_upload(path, old_size, None)
+            self.cli_conn.send(self.parse_code('552 Quota exceeded, transfer aborted.'))
+            self._log_transfer(path, 'APPE', complete=False)
+            self._close_data_connection()
+            return
         except OSError as e:
             if e.errno == 21:
                 desc = f'450 Aiming a directory. Cannot append requested file.'
-                self.cli_conn.send(self.parse_code(desc))
-                self.data_conn.close()
-                return
+            elif isinstance(e, (socket.timeout, ConnectionError)):
+                desc = '426 Connection closed, transfer aborted.'
+                self._invalidate_listing(path)     # Partly written, kept for a REST
+            else:
+                desc = f'451 Local error, cannot append requested file.'
+            self.cli_conn.send(self.parse_code(desc))
+            self._log_transfer(path, 'APPE', complete=False)
+            self._close_data_connection()
+            return
         except:
                 bin = 'disabled' if self.binary is False else 'enabled'
                 desc = f'450 Binary mode is {bin}. Cannot append requested file.'
                 self.cli_conn.send(self.parse_code(desc))
-                self.data_conn.close()
+                self._log_transfer(path, 'APPE', complete=False)
+                self._close_data_connection()
                 return
+        finally:
+            self._account_file(path, old_size)
 
         # Close data connection
-        self.data_conn.close()
+        self._log_transfer(path, 'APPE')
+        self._close_data_connection()
         self.cli_conn.send(self.parse_code('250 File transferred succesfully.'))
     
-    def _append_file(self, msg):
+    def ALLO(self, msg):
         """
-        Private function to store given content.
+        Announce the size of the next file to store, so its space
+        can be reserved in one go.
         """
-        # Append to ASCII/UTF-8/... file (.txt, .php, ...)
-        if self.binary is False:
-            with open(msg, 'a') as f:
-                data = self.decode(self.data_conn.recv(self.WRITE_SIZE))
-                f.write(data)
-                while data:
-                    data = self.decode(self.data_conn.recv(self.WRITE_SIZE))
-                    f.write(data)
-        
-        # Append to BINARY file (.jpeg, .mp4, ...)
-        else:
-            with open(msg, 'ab') as f:
-                data = self.data_conn.recv(self.WRITE_SIZE)
-                f.write(data)
-                while data:
-                    data = self.data_conn.recv(self.WRITE_SIZE)
-                    f.write(data)
+        # 'ALLO <size> [R <record size>]', the record size is meaningless here
+        try:
+            size = int(msg.split(' ')[0])
+        except ValueError:
+            self.cli_conn.send(self.parse_code('501 Parameter syntax error'))
+            return
+        if size < 0:
+            self.cli_conn.send(self.parse_code('501 Parameter syntax error'))
+            return
 
-    def RNFR(self, msg):
+        self.alloc_size = size
+        self.cli_conn.send(self.parse_code(f'200 {size} bytes will be reserved.'))
+
+    def REST(self, msg):
         """
-        Get and prepare the file to rename.
+        Restart the next RETR/STOR/APPE at the given byte offset (stream mode).
         """
-        # Check user is logged
-        if self.user is None:
-            self.cli_conn.send(self.parse_code('530 Not connected.'))
+        if self.binary is False:
+            self.cli_conn.send(self.parse_code('504 REST only supported in binary mode (TYPE I).'))
             return
-        
-        # Operate path of the directory
-        path = msg.split('/')
-        path.pop()
 
-        # Ensure depth aimed by user is correct
-        _, tot_depth = self._get_depth(path)
-        if  tot_depth < 0:
-            self.cli_conn.send(self.parse_code('550 Not available, access forbidden.'))
+        try:
+            offset = int(msg)
+        except ValueError:
+            self.cli_conn.send(self.parse_code('501 Parameter syntax error'))
+            return
+        if offset < 0:
+            self.cli_conn.send(self.parse_code('501 Parameter syntax error'))
             return
 
-        if msg == '/':
-            msg=self.root_dir
-        elif msg[0] == '/':
-            msg=self.root_dir + msg
+        self.rest_offset = offset
+        self.cli_conn.send(self.parse_code(f'350 Restarting at {offset}. Send RETR, STOR or APPE.'))
+
+    def RNFR(self, msg):
+        """
+        Get and prepare the file to rename.
+        """
+        path = self._resolve(msg)
+        if path is None:
+            return
 
         # Verify path exists
-        msg_path = '/'.join(path)
-        if msg_path != '' and not os.path.exists(msg_path):
+        if not self.fs.exists(path):
             self.cli_conn.send(self.parse_code('501 Path incorrect.'))
             return
 
-        # Verify user is deleting a file
-        if not os.path.isfile(msg):
+        # Verify user is renaming a file
+        if not self.fs.isfile(path):
             self.cli_conn.send(self.parse_code('450 Not a file.'))
             return
 
-        self.file_to_rename = msg
+        self.file_to_rename = path
         self.cli_conn.send(self.parse_code('350 File selected.'))
 
     def RNTO(self, msg):
@@ -778,8 +1508,20 @@ class ClientSupporter(threading.Thread):
         """
         if self.file_to_rename is None:
             self.cli_conn.send(self.parse_code('503 Incorrect sequence.'))
-        
-        os.rename(self.file_to_rename, msg)
+            return
+
+        path = self._resolve(msg)
+        if path is None:
+            return
+
+        if self.usage is not None:
+            size, replaced = self._file_size(self.file_to_rename), self._file_size(path)
+        self.fs.rename(self.file_to_rename, path)
+        if self.usage is not None:
+            self._account(self.file_to_rename, -(size or 0), -1)
+            self._account(path, (size or 0) - (replaced or 0), int(replaced is None))
+        self._invalidate_listing(self.file_to_rename)
+        self._invalidate_listing(path)
         self.file_to_rename = None  # Reset
 
         self.cli_conn.send(self.parse_code('250 File renamed succesfully.'))
@@ -788,39 +1530,25 @@ class ClientSupporter(threading.Thread):
         """
         Delete file.
         """
-        # Check user is logged
-        if self.user is None:
-            self.cli_conn.send(self.parse_code('530 Not connected.'))
-            return
-        
-        # Operate path of the directory
-        path = msg.split('/')
-        path.pop()
-
-        # Ensure depth aimed by user is correct
-        _, tot_depth = self._get_depth(path)
-        if  tot_depth < 0:
-            self.cli_conn.send(self.parse_code('550 Not available, access forbidden.'))
+        path = self._resolve(msg)
+        if path is None:
             return
 
-        if msg == '/':
-            msg=self.root_dir
-        elif msg[0] == '/':
-            msg=self.root_dir + msg
-
         # Verify path exists
-        msg_path = '/'.join(path)
-        if msg_path != '' and not os.path.exists(msg_path):
+        if not self.fs.exists(path):
             self.cli_conn.send(self.parse_code('501 Path incorrect.'))
             return
 
         # Verify user is deleting a file
-        if not os.path.isfile(msg):
+        if not self.fs.isfile(path):
             self.cli_conn.send(self.parse_code('450 Not a file.'))
             return
         
         # Delete file
-        os.remove(msg)
+        size = self._file_size(path) if self.usage is not None else None
+        self.fs.remove(path)
+        self._account(path, -(size or 0), -1)
+        self._invalidate_listing(path)
 
         self.cli_conn.send(self.parse_code('250 File deleted succesfully.'))
     
@@ -828,39 +1556,26 @@ class ClientSupporter(threading.Thread):
         """
         Delete directory.
         """
-        # Check user is logged
-        if self.user is None:
-            self.cli_conn.send(self.parse_code('530 Not connected.'))
-            return
-        
-        # Operate path of the directory
-        path = msg.split('/')
-        path.pop()
-
-        # Ensure depth aimed by user is correct
-        _, tot_depth = self._get_depth(path)
-        if  tot_depth < 0:
-            self.cli_conn.send(self.parse_code('550 Not available, access forbidden.'))
+        path = self._resolve(msg)
+        if path is None:
             return
 
-        if msg == '/':
-            msg=self.root_dir
-        elif msg[0] == '/':
-            msg=self.root_dir + msg
-
         # Verify path exists
-        msg_path = '/'.join(path)
-        if msg_path != '' and not os.path.exists(msg_path):
+        if not self.fs.exists(path):
             self.cli_conn.send(self.parse_code('501 Path incorrect.'))
             return
 
-        # Verify user is deleting a directory
-        if not os.path.isdir(msg):
+        # Verify user is deleting a directory (but never the root)
+        if path == '/' or not self.fs.isdir(path):
             self.cli_conn.send(self.parse_code('550 Not a directory.'))
             return
         
         # Delete directory
-        os.rmdir(msg)
+        if self.listing_cache:
+            self.listing_cache.invalidate(self.fs.stat(path))
+        self.fs.rmdir(path)
+        self._account(path, 0, -1)
+        self._invalidate_listing(path)
 
         self.cli_conn.send(self.parse_code('250 Directory deleted succesfully.'))
     
@@ -868,33 +1583,25 @@ class ClientSupporter(threading.Thread):
         """
         Create directory.
         """
-        # Check user is logged
-        if self.user is None:
-            self.cli_conn.send(self.parse_code('530 Not connected.'))
-            return
-        
-        # Operate path of the directory
-        path = msg.split('/')
-        path.pop()
-
-        # Ensure depth aimed by user is correct
-        _, tot_depth = self._get_depth(path)
-        if  tot_depth < 0:
-            self.cli_conn.send(self.parse_code('550 Not available, access forbidden.'))
+        path = self._resolve(msg)
+        if path is None:
             return
 
-        if msg == '/':
-            msg=self.root_dir
-        elif msg[0] == '/':
-            msg=self.root_dir + msg
-
-        # Verify path exists
-        msg_path = '/'.join(path)
-        if msg_path != '' and not os.path.exists(msg_path):
+        # Verify parent directory exists
+        if not self.fs.isdir(posixpath.dirname(path)):
             self.cli_conn.send(self.parse_code('501 Path incorrect.'))
             return
         
+        if self.usage is not None and self.usage.files_left(self.fs.root_dir) == 0:
+            self._refuse_quota()
+            return
+
         # Create directory
-        os.mkdir(msg)
+        self.fs.mkdir(path)
+        self._account(path, 0, 1)
+        self._invalidate_listing(path)
 
         self.cli_conn.send(self.parse_code('250 Directory created succesfully.'))
+
+
+ClientSupporter._DISPATCH = ClientSupporter._dispatch_table()
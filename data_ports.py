@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Server-wide allocator of data ports for passive mode (PASV/EPSV).
+
+A range of ports is bound and put to listen once, when the server starts.
+PASV hands one of those sockets to the session, which accepts the client
+data connection on it, and gives it back when the transfer is over. So no
+socket is created, bound or closed per transfer, and the server never has
+to connect back to the client (which NATed clients don't allow).
+"""
+
+import collections, socket, threading
+
+
+class DataPortPool:
+    LISTEN_QUEUE = 4
+    DEFAULT_RANGE = (60000, 60099)
+
+    def __init__(self, first_port=DEFAULT_RANGE[0], last_port=DEFAULT_RANGE[1],
+                 host='', public_address=None):
+        """
+        'public_address' is the IP announced to clients in the PASV reply,
+        needed when the server itself is behind a NAT. By default it's the
+        local address of each control connection.
+        """
+        self.public_address = public_address
+        self._lock = threading.Lock()
+        self._free = collections.deque()
+        for port in range(first_port, last_port + 1):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind((host, port))
+            except OSError:
+                sock.close()    # Port in use, just skip it
+                continue
+            sock.listen(self.LISTEN_QUEUE)
+            self._free.append(sock)
+        self.size = len(self._free)
+
+    def available(self):
+        return len(self._free)
+
+    def acquire(self):
+        """
+        Returns a listening socket, or None if all of them are in use.
+        """
+        with self._lock:
+            return self._free.popleft() if self._free else None
+
+    def release(self, sock):
+        """
+        Gives a socket back to the pool. Any connection queued on it
+        since the transfer (late or foreign clients) is dropped.
+        """
+        sock.setblocking(False)
+        try:
+            while True:
+                conn, _ = sock.accept()
+                conn.close()
+        except OSError:
+            pass
+        sock.setblocking(True)
+
+        with self._lock:
+            self._free.append(sock)
+
+    def close(self):
+        with self._lock:
+            while self._free:
+                self._free.popleft().close()
@@ -1,50 +1,234 @@
 #!/usr/bin/env python3
 
-import socket, threading, os
+import socket, threading, os, argparse, logging, time
 
+from admission import Admission, WorkerPool, refuse
 from client_supporter import ClientSupporter
+from data_ports import DataPortPool
+from virtual_fs import SYMLINK_POLICIES
+from listing_cache import ListingCache
+from throttle import Throttle, parse_rate
+from usage import Usage, parse_size
+import metrics
+import server_logging
+
+log = logging.getLogger('ftp.server')
 
 class FTPServer(threading.Thread):
-    MY_IP = '127.0.0.1'
     DEFAULT_CONTROL_PORT = 8887 #21
-    LISTEN_QUEUE = 5
+    LISTEN_QUEUE = 128
+    MAX_SESSIONS = Admission.DEFAULT_MAX_SESSIONS
+    ACCEPT_BACKOFF = 0.1    # Seconds to wait after a failed accept
 
-    def __init__(self):
+    def __init__(self, port=DEFAULT_CONTROL_PORT, server_dir=None, data_ports=None,
+                 listing_cache=None, admission=None, backlog=None, reuse_port=False,
+                 authenticator=None, throttle=None, usage=None):
+        """
+        Sessions run on a pool of as many threads as 'admission' lets in;
+        connections over its limits get a 421 from the accept loop.
+        With 'reuse_port', other processes can bind the same port
+        (SO_REUSEPORT) and the kernel balances the clients among them.
+        """
+        self.port = port
+        self.backlog = backlog or self.LISTEN_QUEUE
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind(('', FTPServer.DEFAULT_CONTROL_PORT))
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(('', self.port))
         self._running = True
-        self._server_dir = os.getcwd()
+        self._server_dir = server_dir or os.getcwd()
+        self.data_ports = data_ports if data_ports is not None else DataPortPool()
+        self.listing_cache = listing_cache if listing_cache is not None else ListingCache()
+        self.admission = admission if admission is not None else Admission(self.MAX_SESSIONS)
+        self.authenticator = authenticator     # None: the built-in users
+        self.throttle = throttle               # None: no bandwidth limits
+        self.usage = usage                     # None: no disk usage accounting
+        if usage is not None:
+            usage.index(self._server_dir + ClientSupporter.NAV_FOLDER)  # Walked ahead of logins
+        self._sessions = WorkerPool(self.admission.max_sessions)
         threading.Thread.__init__(self)
-    
+
     def run(self):
-        self.socket.listen(FTPServer.LISTEN_QUEUE)
+        self.socket.listen(self.backlog)
         while self._running:
             try:
                 c_conn, c_addr = self.socket.accept()
-                if self._running:
-                    th = ClientSupporter(c_conn, c_addr, self._server_dir)
-                    th.daemon = True
-                    th.start()
-            except Exception as e:
-                print(e)
-                break
-    
-    def stop(self):
+            except OSError as e:
+                if not self._running:
+                    break   # stop_accepting() closed the socket
+                # Out of fds (EMFILE) and such: the clients already in go on,
+                # and accepting again once some of them left may work
+                log.error('Accept failed: %s', e)
+                time.sleep(self.ACCEPT_BACKOFF)
+                continue
+            if not self._running:
+                c_conn.close()
+                continue
+            metrics.CONNECTIONS.inc()
+            refused = self.admission.admit(c_addr[0])
+            if refused:
+                refuse(c_conn, refused)
+                continue
+            try:
+                # Replies are tiny and come in pairs (150 + 226), don't let Nagle hold them
+                c_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                session = ClientSupporter(c_conn, c_addr, self._server_dir, self.data_ports,
+                                          self.listing_cache, self.authenticator,
+                                          self.throttle, self.usage)
+                self._sessions.submit(self._serve, session, c_conn, c_addr[0])
+            except Exception:
+                log.exception('Session for %s could not start', c_addr[0])
+                c_conn.close()
+                self.admission.release(c_addr[0])
+                time.sleep(self.ACCEPT_BACKOFF)
+        self._sessions.shutdown()
+
+    def _serve(self, session, conn, ip):
+        try:
+            session.run()
+        finally:
+            conn.close()
+            self.admission.release(ip)
+
+    def stop_accepting(self):
+        """
+        Closes the control port, sessions already open go on.
+        """
         self._running = False
 
-        # Salir del accept()
-        sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        sock.connect((self.MY_IP, self.DEFAULT_CONTROL_PORT))
+        # Salir del accept(): connecting to ourselves could reach another
+        # process sharing the port, shutdown() wakes up the accept() instead
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.socket.close()
-        sock.close()
+
+    def stop(self):
+        self.stop_accepting()
+        self.data_ports.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Carlos FTP Server')
+    parser.add_argument('--port', type=int, default=FTPServer.DEFAULT_CONTROL_PORT,
+                        help='control connection port')
+    parser.add_argument('--pasv-ports', default='%d-%d' % DataPortPool.DEFAULT_RANGE,
+                        help='range of ports kept listening for passive mode, as FIRST-LAST')
+    parser.add_argument('--pasv-address', default=None,
+                        help='IP announced in PASV replies (when behind a NAT)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='server processes sharing the port (SO_REUSEPORT), '
+                             'with a supervisor restarting them')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='serve control connections from asyncio event loops '
+                             'instead of one thread per client')
+    parser.add_argument('--loops', type=int, default=None,
+                        help='event loops for --async mode (default: one per core, '
+                             'or one per worker with --workers)')
+    parser.add_argument('--io-workers', type=int, default=None,
+                        help='threads for blocking file I/O in --async mode')
+    parser.add_argument('--transfer-workers', type=int, default=None,
+                        help='threads for data transfers in --async mode (default: 64)')
+    parser.add_argument('--max-sessions', type=int, default=None,
+                        help='sessions served at once, more connections get a 421 '
+                             '(default: MAX_SESSIONS of the engine)')
+    parser.add_argument('--max-per-ip', type=int, default=Admission.DEFAULT_MAX_PER_IP,
+                        help='sessions served at once for one client IP (0: no limit)')
+    parser.add_argument('--backlog', type=int, default=None,
+                        help='connections waiting to be accepted (listen backlog)')
+    parser.add_argument('--users', default=None, metavar='FILE',
+                        help='user file with password hashes, see auth.py '
+                             '(default: the built-in users)')
+    parser.add_argument('--symlinks', default=ClientSupporter.SYMLINKS, choices=SYMLINK_POLICIES,
+                        help='symlinks in the user roots: followed anywhere, only inside '
+                             'the root, or refused (default: %(default)s)')
+    parser.add_argument('--auth-workers', type=int, default=None,
+                        help='threads hashing passwords (default: one per core)')
+    parser.add_argument('--max-rate', type=parse_rate, default=None,
+                        help='bandwidth of all the data transfers together, in bytes/s '
+                             '(e.g. 100M)')
+    parser.add_argument('--user-rate', type=parse_rate, default=None,
+                        help='bandwidth of the transfers of each user')
+    parser.add_argument('--session-rate', type=parse_rate, default=None,
+                        help='bandwidth of the transfers of each session')
+    parser.add_argument('--limit-admins', default='', metavar='USER,...',
+                        help="users allowed to change the server and user limits "
+                             "with 'SITE LIMIT'")
+    parser.add_argument('--quota', type=parse_size, default=None, metavar='BYTES',
+                        help='bytes each user root can hold (e.g. 10G)')
+    parser.add_argument('--quota-files', type=int, default=None,
+                        help='files and directories each user root can hold')
+    parser.add_argument('--usage', action='store_true',
+                        help="account disk usage for 'SITE QUOTA' even without quotas")
+    parser.add_argument('--rescan-interval', type=int, default=Usage.DEFAULT_RESCAN_INTERVAL,
+                        help='seconds between full rescans of the usage index')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--log-level', default='INFO',
+                        help='DEBUG logs every command (default: INFO)')
+    parser.add_argument('--log-file', default=None,
+                        help='write JSON log lines here instead of stderr')
+    parser.add_argument('--xferlog', default=None,
+                        help='also write transfers to this file, in xferlog format')
+    parser.add_argument('--log-sample', action='append', metavar='LEVEL=N',
+                        help='keep 1 out of N records of LEVEL, e.g. DEBUG=100 (repeatable)')
+    parser.add_argument('--log-queue', type=int, default=10000,
+                        help='records waiting to be written; more are dropped')
+    return parser.parse_args()
 
 if __name__ == '__main__':
+    args = parse_args()
+    log_args = (args.log_level.upper(), args.log_file, args.xferlog,
+                server_logging.parse_sample(args.log_sample), args.log_queue)
+    listener = server_logging.setup_logging(*log_args)
+
     # Iniciar servidor FTP
-    print(f'Iniciando servidor FTP en el puerto {FTPServer.DEFAULT_CONTROL_PORT}...')
-    svr = FTPServer()
+    print(f'Iniciando servidor FTP en el puerto {args.port}...')
+    first, last = (int(p) for p in args.pasv_ports.split('-'))
+    if args.metrics_port:
+        metrics.MetricsServer(args.metrics_port).start()
+    ClientSupporter.SYMLINKS = args.symlinks
+    limits = (args.max_rate, args.user_rate, args.session_rate,
+              [name for name in args.limit_admins.split(',') if name])
+    quotas = None
+    if args.usage or args.quota is not None or args.quota_files is not None:
+        quotas = (args.quota, args.quota_files, args.rescan_interval)
+    authenticator = None
+    if args.users and args.workers <= 1:
+        from auth import Authenticator, UserFile
+        authenticator = Authenticator(UserFile(args.users), verify_workers=args.auth_workers)
+    if args.workers > 1:
+        from prefork import PreforkServer
+        svr = PreforkServer(args.workers, port=args.port, pasv_ports=(first, last),
+                            pasv_address=args.pasv_address,
+                            engine='async' if args.use_async else 'thread',
+                            max_sessions=args.max_sessions, max_per_ip=args.max_per_ip or None,
+                            backlog=args.backlog, loops=args.loops or 1,
+                            io_workers=args.io_workers,
+                            transfer_workers=args.transfer_workers, log_args=log_args,
+                            users_file=args.users, auth_workers=args.auth_workers,
+                            symlinks=args.symlinks, limits=limits, quotas=quotas)
+    elif args.use_async:
+        data_ports = DataPortPool(first, last, public_address=args.pasv_address)
+        from async_server import AsyncFTPServer
+        admission = Admission(args.max_sessions or AsyncFTPServer.MAX_SESSIONS,
+                              args.max_per_ip or None)
+        svr = AsyncFTPServer(port=args.port, loops=args.loops, io_workers=args.io_workers,
+                             transfer_workers=args.transfer_workers,
+                             data_ports=data_ports, admission=admission, backlog=args.backlog,
+                             authenticator=authenticator, throttle=Throttle(*limits),
+                             usage=quotas and Usage(*quotas))
+    else:
+        data_ports = DataPortPool(first, last, public_address=args.pasv_address)
+        admission = Admission(args.max_sessions or FTPServer.MAX_SESSIONS,
+                              args.max_per_ip or None)
+        svr = FTPServer(port=args.port, data_ports=data_ports, admission=admission,
+                        backlog=args.backlog, authenticator=authenticator,
+                        throttle=Throttle(*limits), usage=quotas and Usage(*quotas))
     svr.daemon = True
     svr.start()
-    
+
     # Esperar a cancelacion
     try:
         input('Servidor en marcha. Pulse cualquier tecla para parar...\n')
@@ -52,4 +236,5 @@ if __name__ == '__main__':
         pass
     print('Cerrando servidor...')
     svr.stop()
-    svr.join()
\ No newline at end of file
+    svr.join()
+    listener.stop()
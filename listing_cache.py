@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Server-wide cache of formatted directory listings (LIST, NLST, ...).
+
+Entries are keyed on the directory identity (device, inode) plus the kind
+of listing, and are only served while the directory mtime still matches,
+so renames/creations done outside of the server are noticed too. File
+content changes don't touch the directory mtime, which is why the server's
+own mutating verbs call 'invalidate' and entries also expire after
+'max_age' seconds.
+
+Eviction is LRU, bounded both by number of directories and total bytes.
+"""
+
+import collections, threading, time
+
+
+class ListingCache:
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+    DEFAULT_MAX_DIRS = 1024
+    DEFAULT_MAX_AGE = 30    # Seconds
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_dirs=DEFAULT_MAX_DIRS,
+                 max_age=DEFAULT_MAX_AGE):
+        self.max_bytes = max_bytes
+        self.max_dirs = max_dirs
+        self.max_age = max_age
+        self.size = 0       # Bytes held
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # (st_dev, st_ino) -> {kind: (st_mtime_ns, created, data)}, in LRU order
+        self._dirs = collections.OrderedDict()
+
+    def get(self, dir_stat, kind):
+        """
+        Returns the cached listing of 'kind' for the directory, or None.
+        """
+        key = (dir_stat.st_dev, dir_stat.st_ino)
+        with self._lock:
+            entry = self._dirs.get(key, {}).get(kind)
+            if entry is None or entry[0] != dir_stat.st_mtime_ns \
+                    or time.monotonic() - entry[1] > self.max_age:
+                self.misses += 1
+                return None
+            self._dirs.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, dir_stat, kind, data):
+        if len(data) > self.max_bytes:
+            return
+        key = (dir_stat.st_dev, dir_stat.st_ino)
+        with self._lock:
+            kinds = self._dirs.setdefault(key, {})
+            old = kinds.get(kind)
+            if old is not None:
+                self.size -= len(old[2])
+            kinds[kind] = (dir_stat.st_mtime_ns, time.monotonic(), data)
+            self.size += len(data)
+            self._dirs.move_to_end(key)
+
+            while self._dirs and (self.size > self.max_bytes or len(self._dirs) > self.max_dirs):
+                _, evicted = self._dirs.popitem(last=False)
+                self.size -= sum(len(e[2]) for e in evicted.values())
+
+    def invalidate(self, dir_stat):
+        """
+        Drops every listing of the directory.
+        """
+        with self._lock:
+            kinds = self._dirs.pop((dir_stat.st_dev, dir_stat.st_ino), None)
+            if kinds:
+                self.size -= sum(len(e[2]) for e in kinds.values())
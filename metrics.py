@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Server metrics: counters, gauges and histograms, exported in the Prometheus
+text format by a small HTTP server (GET /metrics) and summed up by 'SITE STATS'.
+
+Updates are a dict lookup and an addition under a per-metric lock, cheap
+enough for every command. Label values are given as a tuple, in the order
+of the label names of the metric.
+"""
+
+import bisect, http.server, threading, time
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}   # Label values -> value
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def series(self):
+        """
+        Label values -> value (a copy).
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self):
+        """
+        (suffix, labels text, value) of every time series.
+        """
+        items = self.series().items()
+        return [('', self._label_text(labels), value) for labels, value in items]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+    DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # Count per bucket (not cumulative, that's done when rendering), +Inf, sum
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def stats(self, labels=()):
+        """
+        (count, sum, approximate 50th and 99th percentiles) of a time series.
+        """
+        with self._lock:
+            series = list(self._values.get(labels, ()))
+        if not series:
+            return 0, 0.0, None, None
+        counts, total = series[:-1], series[-1]
+        count = sum(counts)
+        return count, total, self._quantile(counts, count, .5), self._quantile(counts, count, .99)
+
+    def _quantile(self, counts, count, q):
+        """
+        Upper bound of the bucket holding the quantile.
+        """
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= q * count:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return None
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._values.items()]
+        samples = []
+        for labels, series in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), series):
+                cumulative += n
+                samples.append(('_bucket', self._label_text(labels, [('le', bound)]), cumulative))
+            samples.append(('_sum', self._label_text(labels), series[-1]))
+            samples.append(('_count', self._label_text(labels), cumulative))
+        return samples
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+        self.started = time.time()
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """
+        Every metric in the Prometheus text exposition format.
+        """
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
+
+    def snapshot(self):
+        """
+        Name -> series of every metric, picklable, to send it to another process.
+        """
+        return {m.name: m.series() for m in self.metrics}
+
+    def merge(self, snapshots, gauges=True):
+        """
+        Sum of several snapshots (e.g. of the worker processes of a server).
+        Without 'gauges' these are left out: the sessions of a worker that
+        exited are gone, its counters aren't.
+        """
+        kinds = {m.name: m for m in self.metrics}
+        merged = {}
+        for snapshot in snapshots:
+            for name, series in snapshot.items():
+                metric = kinds.get(name)
+                if metric is None or (not gauges and isinstance(metric, Gauge)):
+                    continue
+                total = merged.setdefault(name, {})
+                for labels, value in series.items():
+                    if labels not in total:
+                        total[labels] = list(value) if isinstance(value, list) else value
+                    elif isinstance(value, list):   # Histogram
+                        total[labels] = [a + b for a, b in zip(total[labels], value)]
+                    else:
+                        total[labels] += value
+        return merged
+
+    def load(self, snapshot):
+        """
+        Replaces the values of every metric with those of a snapshot.
+        """
+        for m in self.metrics:
+            with m._lock:
+                m._values = dict(snapshot.get(m.name, {}))
+
+
+REGISTRY = Registry()
+
+CONNECTIONS = REGISTRY.counter('ftp_connections_total', 'Control connections accepted')
+SESSIONS = REGISTRY.gauge('ftp_sessions_active', 'Control connections open')
+COMMANDS = REGISTRY.histogram('ftp_command_seconds', 'Time to execute a command', ('verb',))
+REPLIES = REGISTRY.counter('ftp_replies_total', 'Replies sent, by code', ('code',))
+BYTES_SENT = REGISTRY.counter('ftp_data_bytes_sent_total', 'Bytes sent on data connections')
+BYTES_RECEIVED = REGISTRY.counter('ftp_data_bytes_received_total',
+                                  'Bytes received on data connections')
+DATA_CONNECT = REGISTRY.histogram('ftp_data_connect_seconds',
+                                  'Time to open a data connection (accept or connect)')
+TRANSFERS = REGISTRY.histogram('ftp_transfer_seconds',
+                               'Lifetime of data connections, from open to close',
+                               buckets=(.001, .01, .1, .5, 1, 5, 10, 30, 60, 300, 1800))
+
+
+def summary():
+    """
+    Human readable lines for 'SITE STATS'.
+    """
+    uptime = int(time.time() - REGISTRY.started)
+    errors = sum(v for (code,), v in REPLIES.series().items() if code[0] in '45')
+    count, _, p50, p99 = TRANSFERS.stats()
+    lines = [
+        f'Uptime: {uptime} s',
+        f'Sessions: {SESSIONS.value()} active, {CONNECTIONS.value()} since start',
+        f'Data bytes: {BYTES_SENT.value()} sent, {BYTES_RECEIVED.value()} received',
+        f'Transfers: {count}' + (f', p50 <= {p50} s, p99 <= {p99} s' if count else ''),
+        f'Error replies (4xx/5xx): {errors}',
+    ]
+    for labels in sorted(COMMANDS.series()):
+        count, total, p50, p99 = COMMANDS.stats(labels)
+        lines.append(f'{labels[0]}: {count} calls, avg {total / count * 1000:.3f} ms, '
+                     f'p99 <= {p99 * 1000:g} ms')
+    return lines
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass    # Scrapes every few seconds would flood the output
+
+
+class MetricsServer(threading.Thread):
+    """
+    HTTP scrape endpoint, GET /metrics. Local only by default.
+    """
+
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        self.httpd = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = registry
+        threading.Thread.__init__(self, daemon=True)
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Machine-readable listings (RFC 3659 MLST/MLSD).
+
+A FactsFormatter is built once per session (and again on 'OPTS MLST'), with
+one extractor per selected fact and a format template for the whole line,
+so a listing is produced in a single pass over the 'os.scandir' entries.
+"""
+
+import functools, stat, time
+
+# Facts in the order they are written, '*' marks them as enabled by default in FEAT
+FACTS = ('type', 'size', 'modify', 'perm', 'unique', 'unix.mode')
+DEFAULT_FACTS = ('type', 'size', 'modify', 'perm')
+
+
+def _type(st):
+    return 'dir' if stat.S_ISDIR(st.st_mode) else 'file'
+
+
+def _perm(st):
+    """
+    Owner permissions mapped to the RFC 3659 'perm' letters.
+    """
+    mode = st.st_mode
+    w = mode & stat.S_IWUSR
+    if stat.S_ISDIR(mode):
+        return ('e' if mode & stat.S_IXUSR else '') + ('l' if mode & stat.S_IRUSR else '') + \
+               ('cmpdf' if w else '')
+    return ('r' if mode & stat.S_IRUSR else '') + ('awdf' if w else '')
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_second(t):
+    return time.strftime('%Y%m%d%H%M%S', time.gmtime(t))
+
+
+def format_time(st_mtime):
+    """
+    'YYYYMMDDHHMMSS' in UTC, as used by MLST 'modify' and MDTM.
+    """
+    return _format_second(int(st_mtime))
+
+
+_EXTRACTORS = {
+    'type': _type,
+    'size': lambda st: st.st_size,
+    'modify': lambda st: format_time(st.st_mtime),
+    'perm': _perm,
+    'unique': lambda st: f'{st.st_dev:x}g{st.st_ino:x}',
+    'unix.mode': lambda st: oct(st.st_mode & 0o7777)[2:].zfill(4),
+}
+
+
+class FactsFormatter:
+
+    def __init__(self, facts=DEFAULT_FACTS):
+        # Keep the canonical order, ignore unknown facts as the RFC asks
+        wanted = {f.lower() for f in facts}
+        self.facts = tuple(f for f in FACTS if f in wanted)
+        self._extractors = tuple(_EXTRACTORS[f] for f in self.facts)
+        self._template = ''.join(f'{f}={{}};' for f in self.facts) + ' {}\r\n'
+
+    def opts_reply(self):
+        """
+        Facts as reported by 'OPTS MLST' and FEAT.
+        """
+        return ''.join(f + ';' for f in self.facts)
+
+    @staticmethod
+    def feat_line():
+        return 'MLST ' + ''.join(f + ('*;' if f in DEFAULT_FACTS else ';') for f in FACTS)
+
+    def format(self, name, st):
+        return self._template.format(*[fn(st) for fn in self._extractors], name)
+
+    def format_entries(self, entries):
+        """
+        MLSD body for the 'os.scandir' entries of a directory.
+        """
+        fmt = self._template.format
+        extractors = self._extractors
+        lines = []
+        for entry in entries:
+            try:
+                st = entry.stat()
+            except OSError:
+                continue    # E.g. broken symlink
+            lines.append(fmt(*[fn(st) for fn in extractors], entry.name))
+        return ''.join(lines)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Multi-process server: a supervisor and N worker processes.
+
+The threads of one CPython process share a single core for command parsing
+and text encoding (the GIL), however many clients there are. In prefork mode
+the supervisor starts N workers, each a whole server (threaded or asyncio)
+bound to the control port with SO_REUSEPORT, and the kernel spreads the
+clients among them.
+
+State of the workers:
+ - Admission limits are shared: SharedAdmission keeps its counters in
+   shared memory.
+ - Data ports are split: each worker owns a slice of the passive range.
+ - Metrics are added up: every worker sends a snapshot of its registry
+   through a pipe each METRICS_INTERVAL seconds, and the supervisor serves
+   the sum on /metrics. 'SITE STATS' shows the worker of the session.
+ - Users: every worker loads the same user file, with its own
+   verified-password cache and failure counts, and has the same symlink
+   policy.
+ - Bandwidth limits: each worker gets an equal share of the server rate;
+   user and session rates apply in each worker (see throttle.py).
+ - Disk usage: each worker keeps its own usage index, and applies the
+   quotas with it (see usage.py).
+
+The supervisor restarts the workers that exit unexpectedly. To stop, it
+sends them SIGTERM: a worker closes the control port, lets its sessions
+finish for up to GRACE seconds, and exits.
+"""
+
+import logging, multiprocessing, multiprocessing.connection, signal, socket, threading, time
+
+from admission import SharedAdmission
+from client_supporter import ClientSupporter
+from data_ports import DataPortPool
+from throttle import Throttle
+from usage import Usage
+import metrics
+
+log = logging.getLogger('ftp.server')
+
+METRICS_INTERVAL = 1    # Seconds
+GRACE = 30              # Seconds given to open sessions when stopping
+
+
+def _worker(index, config, admission, metrics_conn):
+    """
+    Main function of a worker process.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # Ctrl+C is for the supervisor
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    listener = None
+    if config['log_args'] is not None:
+        import server_logging
+        listener = server_logging.setup_logging(*config['log_args'])
+    admission.worker = index
+    ClientSupporter.SYMLINKS = config['symlinks']   # Not inherited by spawned processes
+    authenticator = None
+    if config['users_file'] is not None:
+        from auth import Authenticator, UserFile
+        authenticator = Authenticator(UserFile(config['users_file']),
+                                      verify_workers=config['auth_workers'])
+    rate, user_rate, session_rate, admins = config['limits']
+    throttle = Throttle(rate and max(1, rate // config['workers']), user_rate, session_rate,
+                        admins)
+    usage = Usage(*config['quotas']) if config['quotas'] is not None else None
+    first, last = config['pasv_ports']
+    data_ports = DataPortPool(first, last, public_address=config['pasv_address'])
+    if config['engine'] == 'async':
+        from async_server import AsyncFTPServer
+        svr = AsyncFTPServer(port=config['port'], server_dir=config['server_dir'],
+                             loops=config['loops'], io_workers=config['io_workers'],
+                             transfer_workers=config['transfer_workers'],
+                             data_ports=data_ports, admission=admission,
+                             backlog=config['backlog'], reuse_port=True,
+                             authenticator=authenticator, throttle=throttle, usage=usage)
+    else:
+        from ftp_server import FTPServer
+        svr = FTPServer(port=config['port'], server_dir=config['server_dir'],
+                        data_ports=data_ports, admission=admission, backlog=config['backlog'],
+                        reuse_port=True, authenticator=authenticator, throttle=throttle,
+                        usage=usage)
+    svr.daemon = True
+    svr.start()
+
+    while not stopping.wait(METRICS_INTERVAL):
+        metrics_conn.send(metrics.REGISTRY.snapshot())
+
+    svr.stop_accepting()
+    deadline = time.monotonic() + GRACE
+    while metrics.SESSIONS.value() > 0 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    svr.stop()
+    metrics_conn.send(metrics.REGISTRY.snapshot())
+    if listener is not None:
+        listener.stop()
+
+
+class PreforkServer(threading.Thread):
+    """
+    Same start/stop/join interface as FTPServer. 'engine' is 'thread' or 'async'
+    (then with 'loops' event loops per worker); 'max_sessions' and 'max_per_ip'
+    are limits for all the workers together.
+    """
+    RESTART_DELAY = 1   # Seconds, at least, between starts of the same worker
+
+    def __init__(self, workers, port=8887, server_dir=None,
+                 pasv_ports=DataPortPool.DEFAULT_RANGE, pasv_address=None, engine='thread',
+                 max_sessions=None, max_per_ip=SharedAdmission.DEFAULT_MAX_PER_IP,
+                 backlog=None, loops=1, io_workers=None, transfer_workers=None,
+                 log_args=None, users_file=None,
+                 auth_workers=None, symlinks=None, limits=(None, None, None, ()),
+                 quotas=None):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise OSError('Prefork mode needs SO_REUSEPORT')
+        first, last = pasv_ports
+        per_worker = (last - first + 1) // workers
+        if per_worker < 1:
+            raise ValueError(f'{last - first + 1} passive ports for {workers} workers')
+
+        # Holding the port (bound, not listening) reports errors here like the other
+        # servers do, and keeps it ours while a worker restarts
+        self._port_lock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._port_lock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._port_lock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._port_lock.bind(('', port))
+
+        if max_sessions is None:
+            if engine == 'async':
+                from async_server import AsyncFTPServer as engine_class
+            else:
+                from ftp_server import FTPServer as engine_class
+            max_sessions = engine_class.MAX_SESSIONS
+        self.port = port
+        self.workers = workers
+        self._context = multiprocessing.get_context('spawn')
+        self.admission = SharedAdmission(workers, max_sessions, max_per_ip,
+                                         context=self._context)
+        self._configs = [{
+            'port': port,
+            'server_dir': server_dir,
+            'pasv_ports': (first + i * per_worker, first + (i + 1) * per_worker - 1),
+            'pasv_address': pasv_address,
+            'engine': engine,
+            'backlog': backlog,
+            'loops': loops,
+            'io_workers': io_workers,
+            'transfer_workers': transfer_workers,
+            'log_args': log_args,
+            'users_file': users_file,
+            'auth_workers': auth_workers,
+            'symlinks': symlinks or ClientSupporter.SYMLINKS,
+            'limits': limits,
+            'quotas': quotas,
+            'workers': workers,
+        } for i in range(workers)]
+        self._procs = [None] * workers
+        self._pipes = [None] * workers
+        self._start_times = [0.0] * workers
+        self._snapshots = {}    # Worker -> its last metrics
+        self._retired = {}      # Counters of the workers that exited
+        self._running = True
+        self._wake, self._waker = multiprocessing.Pipe(duplex=False)    # For stop()
+        threading.Thread.__init__(self)
+
+    def _start(self, index):
+        recv_conn, send_conn = self._context.Pipe(duplex=False)
+        proc = self._context.Process(target=_worker, name=f'ftp-worker-{index}', daemon=True,
+                                     args=(index, self._configs[index], self.admission,
+                                           send_conn))
+        proc.start()
+        send_conn.close()
+        self._procs[index] = proc
+        self._pipes[index] = recv_conn
+        self._start_times[index] = time.monotonic()
+
+    def _exited(self, index):
+        """
+        Bookkeeping of a worker that exited: its metrics and admission slots.
+        """
+        proc = self._procs[index]
+        self._receive(index)
+        self._pipes[index].close()
+        self._pipes[index] = None
+        self._procs[index] = None
+        last = self._snapshots.pop(index, {})
+        self._retired = metrics.REGISTRY.merge([self._retired, last], gauges=False)
+        self.admission.clear(index)
+        return proc.exitcode
+
+    def _receive(self, index):
+        conn = self._pipes[index]
+        try:
+            while conn.poll():
+                self._snapshots[index] = conn.recv()
+        except (EOFError, OSError):
+            pass
+
+    def run(self):
+        for i in range(self.workers):
+            self._start(i)
+        while self._running:
+            waiting = [self._wake] + [c for c in self._pipes if c is not None]
+            waiting += [p.sentinel for p in self._procs if p is not None]
+            multiprocessing.connection.wait(waiting, timeout=METRICS_INTERVAL)
+
+            for i, proc in enumerate(self._procs):
+                if proc is not None:
+                    self._receive(i)
+                    if not proc.is_alive() and self._running:
+                        code = self._exited(i)
+                        log.warning('Worker %d exited (code %s), restarting', i, code)
+                if self._procs[i] is None and self._running and \
+                        time.monotonic() - self._start_times[i] >= self.RESTART_DELAY:
+                    self._start(i)
+            self._load_metrics()
+
+        for proc in self._procs:
+            if proc is not None:
+                proc.terminate()    # SIGTERM: stop accepting, finish the sessions
+        for i, proc in enumerate(self._procs):
+            if proc is not None:
+                proc.join(GRACE + 5)
+                if proc.is_alive():
+                    proc.kill()
+                    proc.join()
+                self._exited(i)
+        self._load_metrics()
+        self._port_lock.close()
+
+    def _load_metrics(self):
+        snapshots = [self._retired] + list(self._snapshots.values())
+        metrics.REGISTRY.load(metrics.REGISTRY.merge(snapshots))
+
+    def stop(self):
+        self._running = False
+        self._waker.send(None)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Server logging: structured, asynchronous and bounded.
+
+Loggers used by the server:
+ - 'ftp.server':  start/stop and accept errors.
+ - 'ftp.session': connections and commands (commands at DEBUG level).
+ - 'ftp.xfer':    one record per file transfer, also written as an
+                  xferlog (wu-ftpd format) line if configured.
+
+Records are put in a bounded queue and written by a QueueListener thread,
+so a session never waits on the console or disk. When the queue is full
+records are dropped and counted instead of blocking ('ftp_log_records_dropped_total'),
+and DEBUG/INFO records can be sampled (1 out of N kept) before being queued.
+"""
+
+import itertools, json, logging, logging.handlers, queue, time
+
+import metrics
+
+LOG_DROPPED = metrics.REGISTRY.counter('ftp_log_records_dropped_total',
+                                       'Log records dropped because the log queue was full')
+
+# Attributes given with 'extra=' that are written as JSON fields
+FIELDS = ('client', 'port', 'user', 'verb', 'path', 'bytes', 'seconds', 'direction',
+          'binary', 'complete')
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks: records that don't fit are dropped.
+    Records are formatted by the listener thread, not by the caller.
+    """
+
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            LOG_DROPPED.inc()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps 1 out of every N records of a level, e.g. {logging.DEBUG: 100}.
+    Levels not given are always kept.
+    """
+
+    def __init__(self, every):
+        logging.Filter.__init__(self)
+        self._counters = {level: (n, itertools.count()) for level, n in every.items() if n > 1}
+
+    def filter(self, record):
+        sample = self._counters.get(record.levelno)
+        return sample is None or next(sample[1]) % sample[0] == 0
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class XferlogFormatter(logging.Formatter):
+    """
+    wu-ftpd xferlog lines, for the 'ftp.xfer' records:
+    date, seconds, host, bytes, file, type (a/b), action (_), direction (o/i),
+    access mode (r), user, service, auth method (0), auth user id (*), status (c/i)
+    """
+
+    def format(self, record):
+        return ' '.join([
+            time.strftime('%a %b %d %H:%M:%S %Y', time.localtime(record.created)),
+            str(max(1, round(record.seconds))),
+            record.client,
+            str(record.bytes),
+            record.path.replace(' ', '_'),
+            'b' if record.binary else 'a',
+            '_',
+            record.direction,
+            'r',
+            record.user or '*',
+            'ftp', '0', '*',
+            'c' if record.complete else 'i',
+        ])
+
+
+def setup_logging(level=logging.INFO, log_file=None, xferlog_file=None, sample=None,
+                  queue_size=10000):
+    """
+    Configures the 'ftp' loggers: JSON lines to 'log_file' (stderr by default)
+    and, optionally, transfers to 'xferlog_file'. 'sample' maps levels to N as
+    in SamplingFilter. Returns the QueueListener, to be stopped on exit.
+    """
+    log_queue = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    if sample:
+        queue_handler.addFilter(SamplingFilter(sample))
+
+    handlers = []
+    out = logging.FileHandler(log_file) if log_file else logging.StreamHandler()
+    out.setFormatter(JsonFormatter())
+    handlers.append(out)
+    if xferlog_file:
+        xfer = logging.FileHandler(xferlog_file)
+        xfer.setFormatter(XferlogFormatter())
+        xfer.addFilter(logging.Filter('ftp.xfer'))
+        handlers.append(xfer)
+
+    logger = logging.getLogger('ftp')
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.handlers[:] = [queue_handler]
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
+
+
+def parse_sample(specs):
+    """
+    ['DEBUG=100', 'INFO=10'] -> {logging.DEBUG: 100, logging.INFO: 10}
+    """
+    sample = {}
+    for spec in specs or ():
+        level, _, n = spec.partition('=')
+        sample[logging.getLevelName(level.upper())] = int(n)
+    return sample
@@ -0,0 +1,98 @@
+import ftplib, os, socket, sys, time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from async_server import AsyncFTPServer
+from ftp_server import FTPServer
+
+
+@pytest.fixture
+def server_dir(tmp_path):
+    """
+    A server folder with the shared nav/ root of the users without a home.
+    """
+    (tmp_path / 'nav').mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def start_server():
+    """
+    Starts servers on a free port: start_server(engine, server_dir, **kwargs)
+    returns (server, port), 'engine' being 'threaded' or 'async'. They are
+    stopped after the test.
+    """
+    servers = []
+
+    def start(engine, server_dir, **kwargs):
+        if engine == 'async':
+            svr = AsyncFTPServer(port=0, server_dir=str(server_dir), loops=1, **kwargs)
+            port = svr._sockets[0].getsockname()[1]
+        else:
+            svr = FTPServer(port=0, server_dir=str(server_dir), **kwargs)
+            port = svr.socket.getsockname()[1]
+        svr.daemon = True
+        svr.start()
+        servers.append(svr)
+        if engine != 'async':
+            # It listens once its thread runs
+            deadline = time.monotonic() + 5
+            while not svr.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+        return svr, port
+
+    yield start
+    for svr in servers:
+        svr.stop()
+    for svr in servers:
+        svr.join(5)     # The async one gives its data ports back on the way out
+
+
+@pytest.fixture
+def login():
+    """
+    login(port, user, password) opens an ftplib session, closed after the test.
+    """
+    sessions = []
+
+    def connect(port, user='eps', password='eps'):
+        ftp = ftplib.FTP(timeout=10)
+        sessions.append(ftp)
+        ftp.connect('127.0.0.1', port)
+        ftp.login(user, password)
+        return ftp
+
+    yield connect
+    for ftp in sessions:
+        ftp.close()
+
+
+@pytest.fixture
+def webapp(tmp_path, monkeypatch):
+    """
+    webapp(port) returns the routes module of the web client, talking to
+    the FTP server on 'port', with its caches in a temporary folder.
+    """
+    pytest.importorskip('flask')
+    pytest.importorskip('flask_dropzone')
+    sys.path.insert(0, os.path.join(ROOT, 'webapp'))
+    from app import routes
+    from app.api.api import API, FTPConnectionPool
+    from app.api.cache import DownloadCache
+    from app.api.listings import SessionListings
+    pools = []
+
+    def connect(port):
+        pools.append(FTPConnectionPool(port=port, min_size=0))
+        monkeypatch.setattr(routes, 'cmd', API(pools[-1]))
+        monkeypatch.setattr(routes, 'downloads', DownloadCache(str(tmp_path / 'downloads')))
+        monkeypatch.setattr(routes, 'listings', SessionListings())
+        return routes
+
+    yield connect
+    for pool in pools:
+        pool.close()
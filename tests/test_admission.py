@@ -0,0 +1,26 @@
+import ftplib
+
+import pytest
+
+import ftp_server
+from admission import Admission
+
+
+def test_session_start_failure_keeps_accepting(server_dir, start_server, login, monkeypatch):
+    # A session that can't be built (its root can't be opened, say) is
+    # refused alone: its slot is given back and the next clients get in
+    failures = [OSError(24, 'Too many open files')]
+    session = ftp_server.ClientSupporter
+
+    def flaky(*args):
+        if failures:
+            raise failures.pop()
+        return session(*args)
+
+    monkeypatch.setattr(ftp_server, 'ClientSupporter', flaky)
+    admission = Admission(max_sessions=1, max_per_ip=1)
+    svr, port = start_server('threaded', server_dir, admission=admission)
+    with pytest.raises((EOFError, OSError, ftplib.Error)):
+        login(port)
+    ftp = login(port)
+    assert ftp.pwd() == '/'
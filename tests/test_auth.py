@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+import auth
+from auth import Authenticator, StaticUsers, UserFile, hash_password, verify_password
+
+
+@pytest.fixture
+def fast_pbkdf2(monkeypatch):
+    monkeypatch.setattr(auth, 'PBKDF2_ITERATIONS', 1000)
+
+
+@pytest.mark.parametrize('scheme', ['scrypt', 'pbkdf2_sha256'])
+def test_hash_and_verify(fast_pbkdf2, scheme):
+    stored = hash_password('s3cret', scheme)
+    assert stored.startswith(scheme + '$')
+    assert verify_password('s3cret', stored)
+    assert not verify_password('s3cret ', stored)
+    assert hash_password('s3cret', scheme) != stored   # Salted
+
+
+@pytest.mark.parametrize('stored', ['', 'plain', 'md5$x$y', 'scrypt$1$2', 'pbkdf2_sha256$x$AAAA$BBBB'])
+def test_malformed_hashes_dont_verify(stored):
+    assert not verify_password('anything', stored)
+
+
+def test_unknown_scheme_refused():
+    with pytest.raises(ValueError):
+        hash_password('x', 'md5')
+
+
+def test_user_file(tmp_path, fast_pbkdf2):
+    path = tmp_path / 'users.txt'
+    path.write_text(f'# comment\nann:{hash_password("a")}\n'
+                    f'bob:{hash_password("b", "pbkdf2_sha256")}:homes/bob\n')
+    users = UserFile(str(path))
+    assert users.get('ann').home is None
+    assert users.get('bob').home == 'homes/bob'
+    assert users.get('carl') is None
+    authenticator = Authenticator(users)
+    assert authenticator.login('bob', 'b', '10.0.0.1') == auth.OK
+    assert authenticator.login('ann', 'b', '10.0.0.1') == auth.FAILED
+    assert authenticator.home('bob') == 'homes/bob'
+
+
+def test_verified_password_cached(monkeypatch):
+    hashed = []
+    verify = auth.verify_password
+    monkeypatch.setattr(auth, 'verify_password', lambda *a: hashed.append(a) or verify(*a))
+    authenticator = Authenticator(StaticUsers({'eps': 'eps'}))
+    assert authenticator.login('eps', 'eps', '10.0.0.1') == auth.OK
+    assert authenticator.login('eps', 'eps', '10.0.0.2') == auth.OK
+    assert len(hashed) == 1
+    assert authenticator.login('eps', 'wrong', '10.0.0.1') == auth.FAILED
+    assert len(hashed) == 2
+
+
+def test_lockout_per_user_and_ip():
+    authenticator = Authenticator(StaticUsers({'eps': 'eps'}), max_failures=3, max_ip_failures=10)
+    assert [authenticator.login('eps', 'bad', '10.0.0.1') for _ in range(3)] == [auth.FAILED] * 3
+    # Locked out from that IP, even with the right password
+    assert authenticator.login('eps', 'eps', '10.0.0.1') == auth.THROTTLED
+    # Failures elsewhere don't lock the user out for everyone
+    assert authenticator.login('eps', 'eps', '10.0.0.2') == auth.OK
+
+
+def test_lockout_per_ip():
+    authenticator = Authenticator(StaticUsers({'eps': 'eps'}), max_failures=3, max_ip_failures=4)
+    for name in ('ann', 'bob', 'carl', 'dave'):
+        assert authenticator.login(name, 'x', '10.0.0.3') == auth.FAILED
+    assert authenticator.login('eps', 'eps', '10.0.0.3') == auth.THROTTLED
+    assert authenticator.login('eps', 'eps', '10.0.0.4') == auth.OK
+
+
+def test_lockout_ends_with_window():
+    authenticator = Authenticator(StaticUsers({'eps': 'eps'}), max_failures=2,
+                                  failure_window=0.2)
+    for _ in range(2):
+        authenticator.login('eps', 'bad', '10.0.0.1')
+    assert authenticator.login('eps', 'eps', '10.0.0.1') == auth.THROTTLED
+    time.sleep(0.3)
+    assert authenticator.login('eps', 'eps', '10.0.0.1') == auth.OK
@@ -0,0 +1,11 @@
+import os, subprocess, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_help():
+    # Parsing the options mustn't need the optional engines' modules
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'ftp_server.py'), '--help'],
+                            capture_output=True, text=True, timeout=30)
+    assert result.returncode == 0, result.stderr
+    assert '--transfer-workers' in result.stdout
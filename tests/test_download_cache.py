@@ -0,0 +1,103 @@
+import os, sys, time
+
+import pytest
+
+from conftest import ROOT
+
+pytest.importorskip('flask')
+sys.path.insert(0, os.path.join(ROOT, 'webapp'))
+from app.api.cache import DownloadCache
+
+
+def download(cache, path, data, mtime=1000, blocks=2):
+    step = -(-len(data) // blocks)
+    filled = cache.fill(path, len(data), mtime, (data[i:i + step] for i in range(0, len(data), step)))
+    return b''.join(filled)
+
+
+def test_entry_validated_by_size_and_mtime(tmp_path):
+    cache = DownloadCache(str(tmp_path), ttl=60)
+    assert download(cache, '/a', b'hello') == b'hello'
+    entry = cache.fresh('/a')
+    with open(entry.file, 'rb') as f:
+        assert f.read() == b'hello'
+    assert cache.lookup('/a', 5, 1000).etag == entry.etag
+    assert cache.lookup('/a', 5, 2000) is None     # Changed on the FTP server
+    assert cache.fresh('/a') is None
+    assert not os.path.exists(entry.file)
+
+
+def test_entry_not_fresh_after_ttl(tmp_path):
+    cache = DownloadCache(str(tmp_path), ttl=0.05)
+    download(cache, '/a', b'hello')
+    assert cache.fresh('/a') is not None
+    time.sleep(0.1)
+    assert cache.fresh('/a') is None
+    assert cache.lookup('/a', 5, 1000) is not None
+    assert cache.fresh('/a') is not None
+
+
+def test_same_content_stored_once(tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    download(cache, '/a', b'same')
+    download(cache, '/b', b'same')
+    assert cache.size == 4
+    assert cache.fresh('/a').file == cache.fresh('/b').file
+    cache.invalidate('/a')
+    assert os.path.exists(cache.fresh('/b').file)
+
+
+def test_least_recently_used_evicted(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=250, max_file_bytes=100)
+    for name in 'abc':
+        download(cache, '/' + name, name.encode() * 100)
+    assert cache.fresh('/a') is None
+    assert cache.size == 200
+    cache.fresh('/b')
+    download(cache, '/d', b'd' * 100)
+    assert cache.fresh('/c') is None
+    assert cache.fresh('/b') is not None
+    assert sorted(os.listdir(cache.directory)) == sorted(
+        cache.fresh(p).etag for p in ('/b', '/d'))
+
+
+def test_big_file_not_cached(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=400)
+    assert download(cache, '/a', b'a' * 101) == b'a' * 101
+    assert cache.fresh('/a') is None
+    assert os.listdir(cache.directory) == []
+
+
+def test_partial_fill_discarded(tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    filled = cache.fill('/a', 10, 1000, iter([b'hello', b'world']))
+    assert next(filled) == b'hello'
+    filled.close()      # HTTP client gone
+    assert download(cache, '/b', b'short', blocks=1) == b'short'
+    filled = cache.fill('/c', 10, 1000, iter([b'short']))
+    assert b''.join(filled) == b'short'     # FTP transfer cut
+    assert cache.fresh('/a') is None and cache.fresh('/c') is None
+    assert os.listdir(cache.directory) == [cache.fresh('/b').etag]
+
+
+def test_caches_keep_their_own_files(tmp_path):
+    first = DownloadCache(str(tmp_path))
+    download(first, '/a', b'hello')
+    second = DownloadCache(str(tmp_path))
+    assert second.directory != first.directory
+    assert os.path.exists(first.fresh('/a').file)
+    directory = first.directory
+    del first
+    assert not os.path.exists(directory)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_forked_process_starts_empty(tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    download(cache, '/a', b'hello')
+    pid = os.fork()
+    if pid == 0:
+        ok = cache.fresh('/a') is None and os.path.isdir(cache.directory)
+        os._exit(0 if ok and cache.directory.startswith(os.path.join(str(tmp_path), f'{os.getpid()}-')) else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert os.path.exists(cache.fresh('/a').file)
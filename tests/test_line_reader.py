@@ -0,0 +1,45 @@
+from client_supporter import LineReader
+
+
+def lines(reader):
+    out = []
+    line = reader.next_line()
+    while line is not None:
+        out.append(line)
+        line = reader.next_line()
+    return out
+
+
+def test_line_split_between_reads():
+    reader = LineReader(100)
+    for part in (b'RE', b'TR fi', b'le.txt\r'):
+        reader.feed(part)
+        assert reader.next_line() is None
+    reader.feed(b'\n')
+    assert lines(reader) == [b'RETR file.txt']
+
+
+def test_pipelined_lines():
+    reader = LineReader(100)
+    reader.feed(b'USER eps\r\nPASS eps\r\nNOOP\nPW')
+    assert lines(reader) == [b'USER eps', b'PASS eps', b'NOOP']
+    reader.feed(b'D\r\n')
+    assert lines(reader) == [b'PWD']
+
+
+def test_too_long_line_reported_once():
+    reader = LineReader(10)
+    reader.feed(b'X' * 8)
+    assert reader.next_line() is None
+    reader.feed(b'X' * 8)
+    assert reader.next_line() is LineReader.TOO_LONG
+    reader.feed(b'X' * 50)
+    assert reader.next_line() is None
+    reader.feed(b'XX\r\nNOOP\r\n')
+    assert lines(reader) == [b'NOOP']
+
+
+def test_too_long_complete_line():
+    reader = LineReader(10)
+    reader.feed(b'STOR ' + b'x' * 20 + b'\r\nPWD\r\n')
+    assert lines(reader) == [LineReader.TOO_LONG, b'PWD']
@@ -0,0 +1,53 @@
+import threading, time
+
+import pytest
+
+from throttle import Throttle, TokenBucket, parse_rate, format_rate
+
+
+def test_parse_and_format_rate():
+    assert parse_rate('512K') == 512 * 1024
+    assert parse_rate('1.5M') == 1536 * 1024
+    assert parse_rate('off') is None and parse_rate('0') is None
+    with pytest.raises(ValueError):
+        parse_rate('-1K')
+    assert format_rate(2 * 1024 ** 2) == '2M/s'
+    assert format_rate(None) == 'unlimited'
+
+
+def test_token_bucket_debt():
+    bucket = TokenBucket(64 * 1024)
+    assert bucket.take(bucket.burst) == 0
+    assert bucket.take(32 * 1024) == pytest.approx(0.5, abs=0.05)
+    assert TokenBucket(None).take(10 ** 9) == 0
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_login_during_throttled_downloads(server_dir, start_server, login, engine):
+    # Throttled transfers wait in their own threads, they must not hold up the
+    # short commands of other sessions (async: more downloads than I/O workers)
+    (server_dir / 'nav' / 'big.bin').write_bytes(b'x' * 512 * 1024)
+    kwargs = {'io_workers': 2} if engine == 'async' else {}
+    svr, port = start_server(engine, server_dir, throttle=Throttle(rate=1024 ** 2), **kwargs)
+
+    done = []
+    def download():
+        ftp = login(port)
+        ftp.retrbinary('RETR big.bin', lambda b: None)
+        done.append(True)
+
+    downloads = [threading.Thread(target=download, daemon=True) for _ in range(6)]
+    for t in downloads:
+        t.start()
+    time.sleep(0.5)
+    assert not done     # Still going: 3 MB at 1 MB/s
+
+    start = time.perf_counter()
+    ftp = login(port)
+    ftp.cwd('/')
+    ftp.pwd()
+    assert time.perf_counter() - start < 1
+
+    for t in downloads:
+        t.join(10)
+    assert len(done) == 6
@@ -0,0 +1,33 @@
+import ftplib, time
+
+import pytest
+
+import client_supporter
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_stalled_upload_fails(server_dir, start_server, login, monkeypatch, engine):
+    monkeypatch.setattr(client_supporter.ClientSupporter, 'DATA_TIMEOUT', 0.5)
+    svr, port = start_server(engine, server_dir)
+    ftp = login(port)
+    ftp.voidcmd('TYPE I')
+    conn = ftp.transfercmd('STOR stalled.bin')
+    conn.sendall(b'x' * 1000)
+    with pytest.raises(ftplib.error_temp, match='426'):
+        ftp.voidresp()
+    conn.close()
+    assert (server_dir / 'nav' / 'stalled.bin').stat().st_size == 1000   # Left for a REST
+
+
+def test_upload_cut_at_stop_fails(server_dir, start_server, login):
+    svr, port = start_server('async', server_dir)
+    ftp = login(port)
+    ftp.voidcmd('TYPE I')
+    conn = ftp.transfercmd('STOR cut.bin')
+    conn.sendall(b'x' * 1000)
+    time.sleep(0.2)
+    session, = [s for w in svr._workers for s in w.sessions if s.data_conn is not None]
+    session.abort_transfer()
+    with pytest.raises(ftplib.error_temp, match='426'):
+        ftp.voidresp()
+    conn.close()
@@ -0,0 +1,132 @@
+import ftplib, io, threading, time
+
+import pytest
+
+from usage import Usage, UsageIndex, parse_size
+
+
+def test_parse_size():
+    assert parse_size('500') == 500
+    assert parse_size('2K') == 2048
+    assert parse_size('1.5g') == 3 * 1024 ** 3 // 2
+    with pytest.raises(ValueError):
+        parse_size('lots')
+
+
+def test_index_totals_subtrees(tmp_path):
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    (tmp_path / 'top').write_bytes(b'x' * 10)
+    (tmp_path / 'a' / 'b' / 'deep').write_bytes(b'x' * 5)
+    (tmp_path / 'link').symlink_to(tmp_path / 'top')
+    index = UsageIndex(str(tmp_path))
+    index.scan()
+    assert index.get('/') == (15, 4)    # Two files and two directories, not the link
+    assert index.get('/a') == (5, 2)
+    index.add('/a/b', 100, 1)
+    assert index.get('/') == (115, 5)
+    assert index.get('/a/b') == (105, 2)
+
+
+def wait_ready(quotas, root, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not quotas.ready(root):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def stor(ftp, name, size, cmd='STOR'):
+    ftp.storbinary(f'{cmd} {name}', io.BytesIO(b'x' * size))
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_quota_accounting(server_dir, start_server, login, engine):
+    root = str(server_dir / 'nav')
+    (server_dir / 'nav' / 'old').write_bytes(b'x' * 1000)
+    quotas = Usage(quota_bytes=10000, quota_files=6, rescan_interval=0)
+    svr, port = start_server(engine, server_dir, usage=quotas)
+    wait_ready(quotas, root)
+    index = quotas.index(root)
+    assert index.get() == (1000, 1)
+
+    ftp = login(port)
+    ftp.mkd('d')
+    stor(ftp, 'd/a', 3000)
+    assert index.get() == (4000, 3) and index.get('/d') == (3000, 1)
+    stor(ftp, 'd/a', 2000)                  # Replaced
+    stor(ftp, 'd/a', 500, 'APPE')
+    assert index.get() == (3500, 3)
+
+    ftp.rename('d/a', 'moved')              # Between directories
+    assert index.get('/d') == (0, 0) and index.get() == (3500, 3)
+    ftp.rename('moved', 'old')              # Over another file
+    assert index.get() == (2500, 2)
+    ftp.delete('old')
+    assert index.get() == (0, 1)
+
+    # Over the quota: refused, and the partial file is not left behind
+    with pytest.raises(ftplib.error_perm, match='552'):
+        stor(ftp, 'big', 20000)
+    assert not (server_dir / 'nav' / 'big').exists()
+    assert index.get() == (0, 1)
+    assert quotas.room(root) == 10000
+
+    # The totals kept up to date are those of a new walk
+    fresh = UsageIndex(root)
+    fresh.scan()
+    assert fresh.get() == index.get()
+
+
+def test_append_over_quota_truncated(server_dir, start_server, login):
+    root = str(server_dir / 'nav')
+    (server_dir / 'nav' / 'log').write_bytes(b'x' * 1000)
+    quotas = Usage(quota_bytes=5000, rescan_interval=0)
+    svr, port = start_server('threaded', server_dir, usage=quotas)
+    wait_ready(quotas, root)
+    ftp = login(port)
+    with pytest.raises(ftplib.error_perm, match='552'):
+        stor(ftp, 'log', 20000, 'APPE')
+    assert (server_dir / 'nav' / 'log').stat().st_size == 1000
+    assert quotas.index(root).get() == (1000, 1)
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_parallel_uploads_share_the_quota(server_dir, start_server, login, engine):
+    root = str(server_dir / 'nav')
+    quotas = Usage(quota_bytes=100000, rescan_interval=0)
+    svr, port = start_server(engine, server_dir, usage=quotas)
+    wait_ready(quotas, root)
+    clients = [login(port) for _ in range(2)]
+    conns = []
+    for i, ftp in enumerate(clients):
+        ftp.voidcmd('TYPE I')
+        conns.append(ftp.transfercmd(f'STOR f{i}'))
+    # Both started with the whole quota left, which can't take both of them
+    for conn in conns:
+        conn.sendall(b'x' * 30000)
+    conns[0].sendall(b'x' * 30000)
+    conns[0].close()
+    assert clients[0].voidresp().startswith('250')
+    conns[1].sendall(b'x' * 30000)
+    conns[1].close()
+    with pytest.raises(ftplib.error_perm, match='552'):
+        clients[1].voidresp()
+    assert quotas.index(root).get() == (60000, 1)
+    assert quotas.index(root).reserved == 0
+    assert quotas.room(root) == 40000
+
+
+def test_cold_root_refuses_uploads(server_dir, start_server, login, monkeypatch):
+    # While the first walk of a root runs its usage isn't known: no room left
+    walked = threading.Event()
+    scan = UsageIndex._scan
+    monkeypatch.setattr(UsageIndex, '_scan', lambda self: walked.wait(5) and scan(self))
+    quotas = Usage(quota_bytes=5000, rescan_interval=0)
+    svr, port = start_server('threaded', server_dir, usage=quotas)
+    ftp = login(port)   # Doesn't wait for the walk
+    assert 'not known yet' in ftp.sendcmd('SITE QUOTA')
+    with pytest.raises(ftplib.error_temp, match='450'):
+        stor(ftp, 'f', 10)
+    walked.set()
+    wait_ready(quotas, str(server_dir / 'nav'))
+    stor(ftp, 'f', 10)
+    assert quotas.room(str(server_dir / 'nav')) == 4990
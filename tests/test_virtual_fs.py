@@ -0,0 +1,137 @@
+import ftplib, os
+
+import pytest
+
+import client_supporter
+import virtual_fs
+from virtual_fs import VirtualFS, FOLLOW, INSIDE, DENY
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """
+    root/dir/file.txt, root/in -> root/dir, root/out -> outside,
+    root/dir/up -> ../../outside, root/secret -> outside/secret.txt
+    """
+    root, outside = tmp_path / 'root', tmp_path / 'outside'
+    (root / 'dir').mkdir(parents=True)
+    outside.mkdir()
+    (root / 'dir' / 'file.txt').write_text('inside')
+    (outside / 'secret.txt').write_text('outside')
+    (root / 'in').symlink_to('dir')
+    (root / 'out').symlink_to(os.path.join('..', 'outside'))
+    (root / 'dir' / 'up').symlink_to(os.path.join('..', '..', 'outside'))
+    (root / 'secret').symlink_to(os.path.join('..', 'outside', 'secret.txt'))
+    return root
+
+
+@pytest.fixture
+def open_fs():
+    opened = []
+
+    def make(root, symlinks=INSIDE):
+        fs = VirtualFS(str(root), symlinks)
+        opened.append(fs)
+        return fs
+
+    yield make
+    for fs in opened:
+        fs.close()
+
+
+@pytest.mark.parametrize('path', ['..', '../outside', '/..', '/dir/../..', 'dir/../../x'])
+def test_dotdot_above_root_refused(tree, open_fs, path):
+    fs = open_fs(tree)
+    with pytest.raises(PermissionError):
+        fs.resolve(path)
+
+
+def test_dotdot_from_cwd(tree, open_fs):
+    fs = open_fs(tree)
+    fs.chdir('dir')
+    assert fs.resolve('..') == '/'
+    assert fs.resolve('../dir/./file.txt') == '/dir/file.txt'
+    with pytest.raises(PermissionError):
+        fs.resolve('../..')
+
+
+def test_absolute_paths_are_rooted(tree, open_fs):
+    fs = open_fs(tree)
+    fs.chdir('dir')
+    assert fs.resolve('/etc/passwd') == '/etc/passwd'
+    assert fs.real_path('/etc/passwd') == os.path.join(str(tree), 'etc', 'passwd')
+    with pytest.raises(FileNotFoundError):
+        fs.open('/etc/passwd')
+    with fs.open('/dir/file.txt') as f:
+        assert f.read() == 'inside'
+
+
+# Path -> allowed under FOLLOW, INSIDE, DENY
+SYMLINKS = {
+    'in/file.txt': (True, True, False),
+    'out/secret.txt': (True, False, False),
+    'dir/up/secret.txt': (True, False, False),
+    'secret': (True, False, False),
+    'dir/file.txt': (True, True, True),
+}
+
+
+@pytest.mark.parametrize('policy', [FOLLOW, INSIDE, DENY])
+@pytest.mark.parametrize('path', sorted(SYMLINKS))
+def test_symlink_policies(tree, open_fs, policy, path):
+    fs = open_fs(tree, policy)
+    allowed = SYMLINKS[path][(FOLLOW, INSIDE, DENY).index(policy)]
+    if allowed:
+        with fs.open(path) as f:
+            assert f.read() in ('inside', 'outside')
+    else:
+        with pytest.raises(PermissionError):
+            fs.open(path)
+        with pytest.raises(PermissionError):
+            fs.stat(path)
+
+
+@pytest.mark.skipif(not virtual_fs._HAVE_DIR_FD, reason='needs dir_fd support')
+def test_sessions_share_the_root_fd(tree, open_fs):
+    first, second = open_fs(tree), open_fs(tree)
+    assert first._root_fd == second._root_fd
+    first.close()
+    assert sorted(second.listdir('/dir')) == ['file.txt', 'up']
+    fd = second._root_fd
+    second.close()
+    with pytest.raises(OSError):
+        os.fstat(fd)
+    # A root replaced on disk isn't served from the descriptor of the old one
+    third = open_fs(tree)
+    tree.rename(tree.parent / 'old')
+    (tree / 'dir').mkdir(parents=True)
+    assert open_fs(tree)._root_fd != third._root_fd
+
+
+def test_symlink_swapped_after_check(tree, open_fs):
+    # A link made to point out after it was resolved is refused once forgotten
+    fs = open_fs(tree, INSIDE)
+    fs.stat('in/file.txt')
+    (tree / 'in').unlink()
+    (tree / 'in').symlink_to(tree.parent / 'outside')
+    fs.forget()
+    with pytest.raises(PermissionError):
+        fs.stat('in/secret.txt')
+
+
+def test_session_jail(tree, start_server, login, monkeypatch):
+    # The server folder holds the shared root, nav/
+    server_dir = tree.parent
+    os.rename(tree, server_dir / 'nav')
+    monkeypatch.setattr(client_supporter.ClientSupporter, 'SYMLINKS', INSIDE)
+    svr, port = start_server('threaded', server_dir)
+    ftp = login(port)
+    with pytest.raises((ftplib.error_perm, ftplib.error_temp)):
+        ftp.cwd('..')
+    assert ftp.pwd() == '/'
+    for path in ('../outside/secret.txt', 'out/secret.txt', 'dir/up/secret.txt', 'secret'):
+        with pytest.raises((ftplib.error_perm, ftplib.error_temp)):
+            ftp.retrbinary('RETR ' + path, lambda b: None)
+    data = []
+    ftp.retrbinary('RETR in/file.txt', data.append)
+    assert b''.join(data) == b'inside'
@@ -0,0 +1,90 @@
+import socket, threading, time
+
+import pytest
+
+
+def test_slow_downloads_leave_connections_for_listings(server_dir, start_server, webapp):
+    (server_dir / 'nav' / 'f.bin').write_bytes(b'f' * 300000)
+    svr, port = start_server('threaded', server_dir)
+    routes = webapp(port)
+    from app.api.api import API, PoolTimeout
+    cmd = API(routes.cmd.pool, acquire_timeout=0.5, max_downloads=1)
+    size, blocks = cmd.open_file('/f.bin')
+    try:
+        assert size == 300000
+        with pytest.raises(PoolTimeout):
+            cmd.open_file('/f.bin')
+        assert [e['title'] for e in cmd.list_dir('/')] == ['f.bin']
+    finally:
+        blocks.close()
+    size, blocks = cmd.open_file('/f.bin')
+    assert b''.join(blocks) == b'f' * 300000
+
+
+def test_busy_server_answers_503(server_dir, start_server, webapp, monkeypatch):
+    (server_dir / 'nav' / 'f.bin').write_bytes(b'f' * 300000)
+    svr, port = start_server('threaded', server_dir)
+    routes = webapp(port)
+    from app.api.api import API
+    monkeypatch.setattr(routes, 'cmd', API(routes.cmd.pool, acquire_timeout=0.5, max_downloads=1))
+    size, blocks = routes.cmd.open_file('/f.bin')
+    try:
+        response = routes.app.test_client().get('/files/f.bin')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == str(routes.RETRY_AFTER)
+    finally:
+        blocks.close()
+
+
+class SlowCondition(threading.Condition):
+    """
+    Lets the other threads run after each critical section, where a thread
+    preempted between two of them would let them in.
+    """
+    def __exit__(self, *exc_info):
+        super().__exit__(*exc_info)
+        time.sleep(0.01)
+
+
+def test_pool_never_exceeds_max_size(server_dir, start_server, webapp):
+    # Threads arriving together used to all pass the size check before
+    # any of them counted its new connection
+    svr, port = start_server('threaded', server_dir)
+    webapp(port)
+    from app.api.api import FTPConnectionPool
+    pool = FTPConnectionPool(port=port, min_size=0, max_size=3)
+    pool._cond = SlowCondition()
+    sizes = []
+    start = threading.Barrier(8)
+
+    def borrow():
+        start.wait()
+        for _ in range(5):
+            with pool.connection(5) as ftp:
+                sizes.append(pool._size)
+                ftp.voidcmd('NOOP')
+
+    try:
+        threads = [threading.Thread(target=borrow) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(sizes) == 40
+        assert max(sizes) <= 3
+        assert pool._size == len(pool._idle) <= 3
+    finally:
+        pool.close()
+
+
+def test_failed_connection_gives_its_slot_back(webapp):
+    webapp(0)
+    from app.api.api import FTPConnectionPool
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]   # Nothing listening
+    pool = FTPConnectionPool(host='127.0.0.1', port=port, min_size=0, max_size=2)
+    for _ in range(3):
+        with pytest.raises(OSError):
+            pool.acquire(1)
+    assert pool._size == 0
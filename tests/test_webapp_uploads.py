@@ -0,0 +1,59 @@
+import pytest
+
+from usage import Usage
+
+BOUNDARY = 'xYzZy'
+
+
+def multipart(name, data, fields=None, truncate=None):
+    body = b''
+    for key, value in (fields or {}).items():
+        body += (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n'
+                 f'{value}\r\n').encode()
+    body += (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; '
+             f'filename="{name}"\r\nContent-Type: application/octet-stream\r\n\r\n').encode()
+    body += data + f'\r\n--{BOUNDARY}--\r\n'.encode()
+    return body[:truncate] if truncate else body
+
+
+def upload(client, body):
+    return client.post('/upload_file', data=body,
+                       content_type=f'multipart/form-data; boundary={BOUNDARY}')
+
+
+def test_upload_replaces_file(server_dir, start_server, webapp):
+    (server_dir / 'nav' / 'f.bin').write_bytes(b'old')
+    svr, port = start_server('threaded', server_dir)
+    client = webapp(port).app.test_client()
+    assert upload(client, multipart('f.bin', b'n' * 100000)).status_code == 200
+    assert (server_dir / 'nav' / 'f.bin').read_bytes() == b'n' * 100000
+    assert sorted(p.name for p in (server_dir / 'nav').iterdir()) == ['f.bin']
+
+
+def test_cut_upload_keeps_previous_file(server_dir, start_server, webapp):
+    (server_dir / 'nav' / 'f.bin').write_bytes(b'old')
+    svr, port = start_server('threaded', server_dir)
+    client = webapp(port).app.test_client()
+    response = upload(client, multipart('f.bin', b'n' * 100000, truncate=50000))
+    assert response.status_code == 502
+    assert (server_dir / 'nav' / 'f.bin').read_bytes() == b'old'
+    assert sorted(p.name for p in (server_dir / 'nav').iterdir()) == ['f.bin']
+
+
+def test_upload_over_quota_is_an_error(server_dir, start_server, webapp):
+    quotas = Usage(quota_bytes=10000, rescan_interval=0)
+    svr, port = start_server('threaded', server_dir, usage=quotas)
+    client = webapp(port).app.test_client()
+    while not quotas.ready(str(server_dir / 'nav')):
+        pass
+    response = upload(client, multipart('big.bin', b'b' * 200000))
+    assert response.status_code == 502
+    assert list((server_dir / 'nav').iterdir()) == []
+
+
+def test_chunks_written_at_their_offset(server_dir, start_server, webapp):
+    svr, port = start_server('threaded', server_dir)
+    client = webapp(port).app.test_client()
+    for offset, data in ((0, b'hello'), (5, b'world')):
+        assert upload(client, multipart('c.txt', data, {'dzchunkbyteoffset': offset})).status_code == 200
+    assert (server_dir / 'nav' / 'c.txt').read_bytes() == b'helloworld'
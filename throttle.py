@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Bandwidth limits of the data transfers (RETR, STOR, APPE and the listings).
+
+Limits are token buckets of bytes per second, at three levels: the whole
+server, each user (shared by all of their sessions) and each session. A
+transfer moves its data in chunks of about 1/CHUNKS_PER_SECOND of the
+tightest rate and waits for the tokens of every level before each chunk.
+
+The server bucket is handed out by a FairScheduler: when it runs short,
+the chunk of the transfer that moved the fewest bytes so far goes first.
+Short transfers (small files, LIST replies) get through quickly while a
+large one goes on with the rest of the bandwidth. Sizes are not known up
+front, so this is least-attained-service scheduling rather than shortest
+job first.
+
+Without limits (the default) transfers run as before, at full speed.
+Waits happen in the thread moving the data: the session thread, or a
+thread of the transfer pool in the asyncio engine, which is apart from
+the one serving PASS, CWD and the other short commands.
+
+In prefork mode the server rate is split among the workers, and 'SITE
+LIMIT' changes the limits of the worker of the session.
+"""
+
+import heapq, itertools, threading, time
+
+import metrics
+
+WAITED = metrics.REGISTRY.counter('ftp_throttle_wait_seconds_total',
+                                  'Time transfers waited for bandwidth, by limit', ('limit',))
+
+CHUNKS_PER_SECOND = 16  # A short transfer waits for about one chunk of a long one
+MIN_CHUNK = 4 * 1024
+BURST = 0.25            # Seconds of the rate that can be sent at once after a pause
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(text):
+    """
+    Bytes per second from '512K', '10M', '1G' or a number; None (no limit)
+    for '0', 'none', 'off' or 'unlimited'. Raises ValueError.
+    """
+    text = text.strip().upper()
+    if text in ('NONE', 'OFF', 'UNLIMITED'):
+        return None
+    factor = UNITS.get(text[-1:], 1)
+    if factor != 1:
+        text = text[:-1]
+    rate = int(float(text) * factor)
+    if rate < 0:
+        raise ValueError(f'Negative rate {text}')
+    return rate or None
+
+
+def format_rate(rate):
+    if rate is None:
+        return 'unlimited'
+    for unit in ('G', 'M', 'K'):
+        if rate >= UNITS[unit] and rate % UNITS[unit] == 0:
+            return f'{rate // UNITS[unit]}{unit}/s'
+    return f'{rate}/s'
+
+
+class TokenBucket:
+    """
+    'rate' bytes per second, None for no limit. Tokens can go below zero:
+    a chunk taken without enough of them is paid by waiting afterwards.
+    """
+
+    def __init__(self, rate=None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate or None
+            self.burst = max(MIN_CHUNK, int((rate or 0) * BURST))
+            self._tokens = self.burst
+            self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, n):
+        """
+        Takes 'n' tokens. Returns the seconds to wait before using them.
+        """
+        with self._lock:
+            if self.rate is None:
+                return 0
+            self._refill(time.monotonic())
+            self._tokens -= n
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def debt(self):
+        """
+        Seconds until the bucket has tokens again (0 if it has some).
+        """
+        with self._lock:
+            if self.rate is None:
+                return 0
+            self._refill(time.monotonic())
+            return -self._tokens / self.rate if self._tokens <= 0 else 0
+
+
+class FairScheduler:
+    """
+    Serves the chunks waiting for a bucket in order of the bytes their
+    transfer already moved (least first), then of arrival.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self._cond = threading.Condition()
+        self._waiting = []      # Heap of (bytes moved, arrival)
+        self._arrivals = itertools.count()
+
+    def take(self, n, moved):
+        """
+        Waits for the turn of a chunk of 'n' bytes and takes its tokens.
+        Returns the seconds waited.
+        """
+        if self.bucket.rate is None:
+            return 0
+        start = time.monotonic()
+        entry = (moved, next(self._arrivals))
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            self._cond.notify_all()     # A new first one
+            try:
+                while True:
+                    if self._waiting[0] is entry:
+                        delay = self.bucket.debt()
+                        if delay <= 0:
+                            break
+                        self._cond.wait(delay)
+                    else:
+                        self._cond.wait()
+                self.bucket.take(n)
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+        return time.monotonic() - start
+
+
+class Throttle:
+    """
+    Limits of a server: 'rate' for all the transfers together, 'user_rate'
+    for those of a user and 'session_rate' for those of a session (None
+    for no limit). 'admins' are the users allowed to change the server and
+    user limits with 'SITE LIMIT'.
+    """
+
+    def __init__(self, rate=None, user_rate=None, session_rate=None, admins=()):
+        self.scheduler = FairScheduler(TokenBucket(rate))
+        self.user_rate = user_rate
+        self.session_rate = session_rate
+        self.admins = frozenset(admins)
+        self._users = {}    # Name -> TokenBucket
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.scheduler.bucket.rate
+
+    def set_rate(self, rate):
+        self.scheduler.bucket.set_rate(rate)
+
+    def user_bucket(self, name):
+        with self._lock:
+            bucket = self._users.get(name)
+            if bucket is None:
+                bucket = self._users[name] = TokenBucket(self.user_rate)
+            return bucket
+
+    def session(self):
+        """
+        A SessionLimiter for a new session.
+        """
+        return SessionLimiter(self)
+
+
+class SessionLimiter:
+    """
+    The limits applying to the transfers of one session.
+    """
+
+    def __init__(self, throttle):
+        self.throttle = throttle
+        self.bucket = TokenBucket(throttle.session_rate)
+        self.user = None    # TokenBucket of the user, once logged in
+
+    def login(self, name):
+        self.user = self.throttle.user_bucket(name) if name is not None else None
+
+    def chunk_size(self):
+        """
+        Bytes to move between waits, None when no limit applies.
+        """
+        rates = [r for r in (self.bucket.rate, self.user and self.user.rate,
+                             self.throttle.rate) if r]
+        if not rates:
+            return None
+        return max(MIN_CHUNK, min(rates) // CHUNKS_PER_SECOND)
+
+    def wait(self, n, moved):
+        """
+        Waits until the limits let 'n' more bytes go, for a transfer that
+        already moved 'moved' bytes.
+        """
+        session = self.bucket.take(n)
+        user = self.user.take(n) if self.user is not None else 0
+        delay = max(session, user)
+        if delay:
+            WAITED.inc(delay, labels=('session' if session >= user else 'user',))
+            time.sleep(delay)
+        waited = self.throttle.scheduler.take(n, moved)
+        if waited:
+            WAITED.inc(waited, labels=('server',))
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Disk usage accounting and quotas of the user roots.
+
+Walking a large tree to learn how much a user stores is far too slow to
+do per command. Usage keeps a UsageIndex per session root (a user home or
+the shared nav/ folder) instead, built by one walk in a background thread
+when the first user of that root logs in. Each directory of the index holds the bytes and files of
+its whole subtree. The verbs that change the tree (STOR, APPE, DELE, RMD,
+MKD, RNTO) report their changes with 'add', which updates a directory and
+its parents, so reading the usage of a root or of a directory is a dict
+lookup.
+
+Until that first walk ends the usage of the root isn't known, and it's
+taken as full: no room is left under its quotas, so uploads are refused
+(with a transient error, see 'ready') rather than let through unchecked.
+
+Changes made outside of the server are picked up by a full rescan of every
+index each 'rescan_interval' seconds, in a background thread. Changes
+reported while a rescan is running are replayed on the new totals if the
+rescan had already listed their directory.
+
+Quotas apply to a root: 'quota_bytes' and 'quota_files' (directories count
+as files), None for no limit. Users sharing a root share its quota. Uploads
+reserve the bytes they receive as they go ('reserve'), so uploads running at
+once can't each take all the room left. In
+prefork mode every worker keeps its own indexes, so between rescans a
+worker doesn't see the changes made through the others.
+"""
+
+import logging, os, posixpath, threading, time
+
+import metrics
+
+log = logging.getLogger('ftp.server')
+
+SCAN = metrics.REGISTRY.histogram('ftp_usage_scan_seconds', 'Time to walk a root to index it',
+                                  buckets=(.01, .1, 1, 10, 60, 300, 1800))
+
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def parse_size(text):
+    """
+    Bytes from '500M', '10G' or a number. Raises ValueError.
+    """
+    text = text.strip().upper()
+    factor = UNITS.get(text[-1:], 1)
+    return int(float(text[:-1] if factor != 1 else text) * factor)
+
+
+def _parent(vdir):
+    return posixpath.dirname(vdir) if vdir != '/' else None
+
+
+class UsageIndex:
+    """
+    Bytes and files under each directory of a root, subtrees included.
+    Directories are virtual paths ('/', '/a/b') as the sessions see them.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.scanned = None     # time.time() of the last scan
+        self.reserved = 0       # Bytes received by uploads not accounted yet
+        self._dirs = {}         # Directory -> [bytes, files]
+        self._lock = threading.Lock()
+        self._scanning = threading.Lock()   # One scan at a time
+        self._listed = None     # Directories listed by a running scan
+        self._replay = []       # Changes to replay after it
+
+    def get(self, vdir='/'):
+        """
+        (bytes, files) under a directory, (0, 0) if not indexed.
+        """
+        totals = self._dirs.get(vdir)
+        return (totals[0], totals[1]) if totals is not None else (0, 0)
+
+    def add(self, vdir, nbytes, files):
+        """
+        Accounts 'nbytes' and 'files' (negative to subtract) in a directory.
+        """
+        with self._lock:
+            self._add(self._dirs, vdir, nbytes, files)
+            if self._listed is not None and vdir in self._listed:
+                self._replay.append((vdir, nbytes, files))
+
+    def reserve(self, nbytes, limit):
+        """
+        Sets 'nbytes' aside if the root stays within 'limit' bytes with them.
+        """
+        with self._lock:
+            if self.get()[0] + self.reserved + nbytes > limit:
+                return False
+            self.reserved += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self._lock:
+            self.reserved -= nbytes
+
+    @staticmethod
+    def _add(dirs, vdir, nbytes, files):
+        while vdir is not None:
+            totals = dirs.get(vdir)
+            if totals is None:
+                totals = dirs[vdir] = [0, 0]
+            totals[0] += nbytes
+            totals[1] += files
+            vdir = _parent(vdir)
+
+
+    def scan(self):
+        """
+        Walks the root (without following symlinks) and replaces the totals.
+        """
+        with self._scanning:
+            self._scan()
+
+    def _scan(self):
+        start = time.perf_counter()
+        with self._lock:
+            self._listed = set()
+            self._replay = []
+        try:
+            direct = {}     # Directory -> [bytes, files] of its own entries
+            order = []
+            stack = ['/']
+            while stack:
+                vdir = stack.pop()
+                with self._lock:
+                    self._listed.add(vdir)
+                totals = direct[vdir] = [0, 0]
+                order.append(vdir)
+                try:
+                    with os.scandir(os.path.join(self.root, vdir[1:])) as entries:
+                        for entry in entries:
+                            try:
+                                if entry.is_dir(follow_symlinks=False):
+                                    stack.append(posixpath.join(vdir, entry.name))
+                                elif entry.is_file(follow_symlinks=False):
+                                    totals[0] += entry.stat(follow_symlinks=False).st_size
+                                else:
+                                    continue    # Symlinks and such take no space of ours
+                            except OSError:
+                                continue
+                            totals[1] += 1
+                except OSError:
+                    pass    # Removed meanwhile, or not readable
+
+            # Children come after their parent in 'order': add subtrees bottom-up
+            for vdir in reversed(order):
+                parent = _parent(vdir)
+                if parent is not None:
+                    direct[parent][0] += direct[vdir][0]
+                    direct[parent][1] += direct[vdir][1]
+            with self._lock:
+                for change in self._replay:
+                    self._add(direct, *change)
+                self._dirs = direct
+                self.scanned = time.time()
+        finally:
+            with self._lock:
+                self._listed = None
+                self._replay = []
+            SCAN.observe(time.perf_counter() - start)
+
+
+class Usage:
+    """
+    The UsageIndex of every root in use, their quotas and their rescans.
+    """
+    DEFAULT_RESCAN_INTERVAL = 3600  # Seconds
+
+    def __init__(self, quota_bytes=None, quota_files=None,
+                 rescan_interval=DEFAULT_RESCAN_INTERVAL):
+        self.quota_bytes = quota_bytes
+        self.quota_files = quota_files
+        self.rescan_interval = rescan_interval
+        self._indexes = {}  # Root -> UsageIndex
+        self._lock = threading.Lock()
+        self._rescans = None
+
+    def index(self, root):
+        """
+        UsageIndex of a root. The first call for a root starts walking it in
+        the background: the index is empty (not 'ready') until the walk ends.
+        """
+        index = self._indexes.get(root)
+        if index is not None:
+            return index
+        with self._lock:
+            index = self._indexes.get(root)
+            if index is None:
+                index = self._indexes[root] = UsageIndex(root)
+                threading.Thread(target=self._first_scan, args=(index,),
+                                 name='ftp-usage-index', daemon=True).start()
+            if self._rescans is None and self.rescan_interval:
+                self._rescans = threading.Thread(target=self._rescan, name='ftp-usage',
+                                                 daemon=True)
+                self._rescans.start()
+        return index
+
+    def ready(self, root):
+        """
+        True once the usage of a root is known (its first walk ended).
+        """
+        return self.index(root).scanned is not None
+
+    def _first_scan(self, index):
+        try:
+            index.scan()
+        except Exception:
+            log.exception('Indexing %s failed', index.root)
+            return
+        log.info('Indexed %s: %d bytes in %d files', index.root, *index.get())
+
+    def add(self, root, vdir, nbytes, files):
+        """
+        Accounts a change in directory 'vdir' of 'root', in its index and in
+        those of the roots holding it (a home inside nav/, for instance).
+        """
+        if not nbytes and not files:
+            return
+        path = os.path.join(root, vdir[1:]).rstrip(os.sep) or os.sep
+        rel = []
+        while True:
+            index = self._indexes.get(path)
+            if index is not None:
+                index.add('/' + '/'.join(reversed(rel)), nbytes, files)
+            path, name = os.path.split(path)
+            if not name:
+                return
+            rel.append(name)
+
+    def room(self, root):
+        """
+        Bytes a root can still take under its quota, None for no limit.
+        0 while its usage isn't known.
+        """
+        if self.quota_bytes is None:
+            return None
+        if not self.ready(root):
+            return 0
+        index = self.index(root)
+        return max(0, self.quota_bytes - index.get()[0] - index.reserved)
+
+    def reserve(self, root, nbytes):
+        """
+        Reserves room for 'nbytes' an upload just received, False if the
+        byte quota of the root has none left (or its usage isn't known).
+        The upload gives them back with 'release' once its file is
+        accounted with 'add'.
+        """
+        if self.quota_bytes is None:
+            return True
+        return self.ready(root) and self.index(root).reserve(nbytes, self.quota_bytes)
+
+    def release(self, root, nbytes):
+        if nbytes:
+            self.index(root).release(nbytes)
+
+    def files_left(self, root):
+        """
+        Files a root can still take under its quota, None for no limit.
+        0 while its usage isn't known.
+        """
+        if self.quota_files is None:
+            return None
+        if not self.ready(root):
+            return 0
+        return max(0, self.quota_files - self.index(root).get()[1])
+
+    def _rescan(self):
+        while True:
+            time.sleep(self.rescan_interval)
+            for index in list(self._indexes.values()):
+                try:
+                    index.scan()
+                except Exception:
+                    log.exception('Rescan of %s failed', index.root)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Session-scoped virtual filesystem.
+
+Every session sees the served folder as '/' and keeps its own working
+directory as a virtual path, so sessions never call 'os.chdir' (which is
+process-wide) and can run in parallel without sharing a cwd.
+
+Paths received from the client are normalised by 'virtual_path', which
+also rejects any attempt to climb above the root, and checked by 'resolve'
+against the symlink policy of the session (the root is a jail):
+ - FOLLOW: symlinks are followed wherever they point, the tree is trusted.
+ - INSIDE: symlinks are followed while they stay under the root (default).
+ - DENY:   paths through a symlink are refused.
+A path is resolved with 'os.path.realpath' at most every RESOLVE_TTL seconds;
+the results are cached per session, so the commands on the same files and
+directories cost a dict lookup.
+
+All filesystem calls are then made relative to a directory file descriptor
+of the root ('dir_fd'), the 'openat' family of calls. On platforms without
+'dir_fd' support the root's absolute path is prepended instead. The
+descriptor of a root is shared by all the sessions under it, so an idle
+session holds no file descriptor of its own.
+"""
+
+import os, stat, contextlib, threading, time
+
+_HAVE_DIR_FD = {os.open, os.stat, os.mkdir, os.rmdir, os.unlink, os.rename} <= os.supports_dir_fd \
+               and {os.listdir, os.scandir} <= os.supports_fd
+
+_O_DIRECTORY = getattr(os, 'O_DIRECTORY', 0)
+
+# Symlink policies
+FOLLOW, INSIDE, DENY = 'follow', 'inside', 'deny'
+SYMLINK_POLICIES = (FOLLOW, INSIDE, DENY)
+
+_root_fds = {}      # (st_dev, st_ino) of a root -> [dir fd, sessions using it]
+_root_fds_lock = threading.Lock()
+
+
+def _open_root(path):
+    """
+    (key, fd) of the directory fd of a root, shared with the other sessions
+    under it. Keyed by the directory itself rather than its path, so a root
+    replaced on disk gets a descriptor of its own.
+    """
+    st = os.stat(path)
+    key = (st.st_dev, st.st_ino)
+    with _root_fds_lock:
+        entry = _root_fds.get(key)
+        if entry is None:
+            entry = _root_fds[key] = [os.open(path, os.O_RDONLY | _O_DIRECTORY), 0]
+        entry[1] += 1
+        return key, entry[0]
+
+
+def _close_root(key):
+    with _root_fds_lock:
+        entry = _root_fds[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del _root_fds[key]
+            os.close(entry[0])
+
+
+class VirtualFS:
+    """
+    Resolves client paths against a session root and current directory.
+
+    Raises PermissionError when a path escapes the root, and the usual
+    OSError subclasses (FileNotFoundError, NotADirectoryError, ...) otherwise.
+    """
+    RESOLVE_TTL = 2         # Seconds a resolved path is trusted
+    MAX_RESOLVED = 1024     # Paths cached per session
+
+    def __init__(self, root_dir, symlinks=INSIDE):
+        if symlinks not in SYMLINK_POLICIES:
+            raise ValueError(f'Unknown symlink policy {symlinks}')
+        self.root_dir = os.path.abspath(root_dir)
+        self.symlinks = symlinks
+        self.cwd = '/'
+        self._real_root = os.path.realpath(self.root_dir)
+        self._resolved = {}     # Virtual path -> time until which it's trusted
+        self._root_key, self._root_fd = _open_root(self.root_dir) if _HAVE_DIR_FD else (None, None)
+
+    def close(self):
+        if self._root_fd is not None:
+            _close_root(self._root_key)
+            self._root_fd = None
+
+    def virtual_path(self, path):
+        """
+        Returns the normalised virtual path ('/a/b') for a client path,
+        which can be absolute (from the root) or relative to 'cwd'.
+        """
+        parts = [] if path.startswith('/') else [p for p in self.cwd.split('/') if p]
+        for item in path.split('/'):
+            if item in ('', '.'):
+                continue
+            if item == '..':
+                if not parts:
+                    raise PermissionError(f'{path}: outside of the root directory')
+                parts.pop()
+            else:
+                parts.append(item)
+        return '/' + '/'.join(parts)
+
+    def resolve(self, path):
+        """
+        'virtual_path', also checked against the symlink policy. Every
+        filesystem call of this class goes through it.
+        """
+        vpath = self.virtual_path(path)
+        if self.symlinks == FOLLOW:
+            return vpath
+        now = time.monotonic()
+        if self._resolved.get(vpath, 0) > now:
+            return vpath
+
+        lexical = os.path.join(self._real_root, vpath[1:]) if vpath != '/' else self._real_root
+        real = os.path.realpath(lexical)
+        if self.symlinks == DENY:
+            allowed = real == lexical
+        else:
+            allowed = real == self._real_root or real.startswith(self._real_root + os.sep)
+        if not allowed:
+            raise PermissionError(f'{path}: symlink out of the root directory')
+
+        if len(self._resolved) >= self.MAX_RESOLVED:
+            self._resolved.clear()
+        self._resolved[vpath] = now + self.RESOLVE_TTL
+        return vpath
+
+    def forget(self):
+        """
+        Drops the resolved paths, after the tree changed.
+        """
+        self._resolved.clear()
+
+    def real_path(self, path):
+        """
+        Absolute path in the host filesystem, for logging and such.
+        """
+        return os.path.join(self.root_dir, self.virtual_path(path)[1:])
+
+    def _at(self, path):
+        """
+        Returns (path, dir_fd) to give to the os.* functions.
+        """
+        rel = self.resolve(path)[1:] or '.'
+        if self._root_fd is not None:
+            return rel, self._root_fd
+        return os.path.join(self.root_dir, rel), None
+
+    def chdir(self, path):
+        vpath = self.resolve(path)
+        if not self.isdir(vpath):
+            raise NotADirectoryError(f'{path}: not a directory')
+        self.cwd = vpath
+
+    def stat(self, path):
+        p, fd = self._at(path)
+        return os.stat(p, dir_fd=fd)
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except OSError:
+            return False
+        return True
+
+    def isdir(self, path):
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def isfile(self, path):
+        try:
+            return stat.S_ISREG(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def open(self, path, mode='r', **kwargs):
+        """
+        Same as the builtin 'open', for a client path.
+        """
+        p, fd = self._at(path)
+        return open(p, mode, opener=lambda name, flags: os.open(name, flags, 0o666, dir_fd=fd), **kwargs)
+
+    def listdir(self, path='.'):
+        p, fd = self._at(path)
+        if fd is None:
+            return os.listdir(p)
+        dfd = os.open(p, os.O_RDONLY | _O_DIRECTORY, dir_fd=fd)
+        try:
+            return os.listdir(dfd)
+        finally:
+            os.close(dfd)
+
+    @contextlib.contextmanager
+    def scandir(self, path='.'):
+        """
+        Context manager yielding 'os.scandir' of a client path.
+        Entries' 'stat()' must be called inside the 'with' block.
+        """
+        p, fd = self._at(path)
+        if fd is None:
+            with os.scandir(p) as it:
+                yield it
+            return
+        dfd = os.open(p, os.O_RDONLY | _O_DIRECTORY, dir_fd=fd)
+        try:
+            with os.scandir(dfd) as it:
+                yield it
+        finally:
+            os.close(dfd)
+
+    def mkdir(self, path):
+        p, fd = self._at(path)
+        os.mkdir(p, dir_fd=fd)
+
+    def rmdir(self, path):
+        p, fd = self._at(path)
+        os.rmdir(p, dir_fd=fd)
+        self.forget()
+
+    def remove(self, path):
+        p, fd = self._at(path)
+        os.unlink(p, dir_fd=fd)
+        self.forget()
+
+    def rename(self, src, dst):
+        src, src_fd = self._at(src)
+        dst, dst_fd = self._at(dst)
+        os.rename(src, dst, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
+        self.forget()
@@ -1,74 +1,359 @@
-from ftplib import FTP
+from ftplib import FTP, error_reply, error_temp, error_perm, error_proto
+import calendar, collections, contextlib, posixpath, threading, time, uuid
 
-class API:
+# Errors after which the state of a control connection is unknown
+CONNECTION_ERRORS = (OSError, EOFError, error_reply, error_proto)
+
+class PoolTimeout(TimeoutError):
     """
-    API interface HTTP <-> FTP.
+    No FTP connection got free in time: the server is too busy.
+    """
+
+class FTPConnectionPool:
     """
-    
-    def __init__(self):
-        self.ftp = FTP()
-        self.ftp.set_pasv(val=False)
-        self.ftp.connect('localhost', 8887)
-        self.ftp.login('eps', 'eps')
+    Thread-safe pool of logged-in FTP control connections.
+
+    Each HTTP request borrows a connection with 'connection()', so parallel
+    requests don't share a socket (ftplib.FTP is not thread-safe).
+    Connections idle for 'check_after' seconds are checked with NOOP before
+    being handed out, broken ones are replaced by a new connection (and login),
+    and the ones idle for 'max_idle' seconds are closed, down to 'min_size'.
+    """
+
+    def __init__(self, host='localhost', port=8887, user='eps', passwd='eps',
+                 min_size=1, max_size=8, max_idle=60, check_after=5, timeout=30):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._idle = collections.deque()    # (FTP, last used), most recently used last
+        self._size = 0                      # Open connections, idle or borrowed
+
+        # Best effort, the pool fills up on demand if the server isn't there yet
+        try:
+            for _ in range(min_size):
+                with self._cond:
+                    self._size += 1
+                self.release(self._new_connection())
+        except CONNECTION_ERRORS + (error_perm, error_temp):
+            pass
 
-    def list_dir(self, dir=None, root=False):
+    def _new_connection(self):
         """
-        Gets all files/folders from current directory.
+        Opens a connection for a slot the caller reserved (counted in '_size'
+        under the lock, with the check against 'max_size'). The slot is given
+        back if the connection fails.
         """
+        try:
+            ftp = FTP(timeout=self.timeout)
+            ftp.set_pasv(val=True)
+            ftp.connect(self.host, self.port)
+            ftp.login(self.user, self.passwd)
+            return ftp
+        except:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _evict_idle(self):
+        """
+        Takes out the connections idle for too long. Called with the lock held,
+        the caller closes them.
+        """
+        evicted = []
+        now = time.monotonic()
+        while self._idle and self._size - len(evicted) > self.min_size \
+                and now - self._idle[0][1] > self.max_idle:
+            evicted.append(self._idle.popleft()[0])
+        self._size -= len(evicted)
+        return evicted
 
-        if not self.ftp:
+    def acquire(self, timeout=None):
+        """
+        Borrows a connection, waiting up to 'timeout' seconds (None: forever)
+        if 'max_size' of them are in use. Raises PoolTimeout otherwise.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                evicted = self._evict_idle()
+                while not self._idle and self._size >= self.max_size:
+                    left = None if deadline is None else deadline - time.monotonic()
+                    if left is not None and left <= 0:
+                        raise PoolTimeout('No FTP connection available')
+                    self._cond.wait(left)
+                if self._idle:
+                    item = self._idle.pop()
+                else:
+                    item = None
+                    self._size += 1     # Reserved here, so no other thread takes the slot
+            for ftp in evicted:
+                self._close(ftp, quit=True)
+
+            if item is None:
+                return self._new_connection()
+
+            ftp, last_used = item
+            if time.monotonic() - last_used < self.check_after:
+                return ftp
+            try:
+                ftp.voidcmd('NOOP')
+                return ftp
+            except CONNECTION_ERRORS + (error_perm, error_temp):
+                self.release(ftp, discard=True)     # Dead, try the next one
+
+    def release(self, ftp, discard=False):
+        """
+        Gives a connection back, or closes it with 'discard' (e.g. after an error
+        that leaves it in an unknown state).
+        """
+        if discard:
+            self._close(ftp)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
             return
-        
-        directory = []
+        with self._cond:
+            self._idle.append((ftp, time.monotonic()))
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        'with pool.connection() as ftp:' borrows a connection for the block.
+        """
+        ftp = self.acquire(timeout)
         try:
-            if dir:
-                self.ftp.cwd(dir)
-                self.ftp.retrlines('LIST', lambda a: directory.append(a))
-            elif root is True:
-                self.ftp.cwd('/')
-                self.ftp.retrlines('LIST', lambda a: directory.append(a))
-            else:
-                self.ftp.retrlines('LIST', lambda a: directory.append(a))
+            yield ftp
+        except CONNECTION_ERRORS:
+            self.release(ftp, discard=True)
+            raise
         except:
-            self.ftp.cwd('/')
-            self.ftp.retrlines('LIST', lambda a: directory.append(a))
-        
+            self.release(ftp)
+            raise
+        else:
+            self.release(ftp)
+
+    @staticmethod
+    def _close(ftp, quit=False):
+        try:
+            if quit:
+                ftp.quit()
+                return
+        except Exception:
+            pass
+        ftp.close()
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, collections.deque()
+            self._size -= len(idle)
+        for ftp, _ in idle:
+            self._close(ftp, quit=True)
+
+class API:
+    """
+    API interface HTTP <-> FTP.
+    Paths are absolute, as a connection doesn't keep a cwd between requests.
+    """
+
+    BLOCK_SIZE = 64 * 1024  # Bytes read from the data connection at a time
+    ACQUIRE_TIMEOUT = 10    # Seconds a request waits for a connection
+    FREE_CONNECTIONS = 2    # Kept out of reach of the downloads, for the listings
+
+    def __init__(self, pool=None, acquire_timeout=ACQUIRE_TIMEOUT, max_downloads=None):
+        """
+        A streamed download holds its connection as long as the HTTP client
+        takes to read it: at most 'max_downloads' run at once (by default
+        all the pool but FREE_CONNECTIONS), so slow ones can't hold up the
+        listings. Requests wait 'acquire_timeout' seconds at most for a
+        connection or a download slot, then raise PoolTimeout.
+        """
+        self.pool = pool if pool is not None else FTPConnectionPool()
+        self.acquire_timeout = acquire_timeout
+        if max_downloads is None:
+            max_downloads = max(1, self.pool.max_size - self.FREE_CONNECTIONS)
+        self._downloads = threading.BoundedSemaphore(max_downloads)
+
+    def list_dir(self, dir='/'):
+        """
+        Gets all files/folders from a directory.
+        """
+        with self.pool.connection(self.acquire_timeout) as ftp:
+            try:
+                directory = list(ftp.mlsd(dir))
+            except (error_perm, error_temp):
+                directory = list(ftp.mlsd('/'))
+
         ret = []
-        for item in directory:
-            """
-            [4]: Size
-            [5]: Month
-            [6]: Day
-            [7]: HH:MM
-            [8]: Title.ext
-            """
-            item_info = item.split(' ')
+        dates = {}      # Formatted once per distinct 'modify' fact
+        for name, facts in directory:
+            modify = facts['modify'][:14]
+            date = dates.get(modify)
+            if date is None:
+                modified = time.strptime(modify, '%Y%m%d%H%M%S')
+                date = dates[modify] = time.strftime('%H:%M, %d/%b', modified)
             ret.append(
                 {
-                    'title': item_info[8],
-                    'date': item_info[7] + ', ' + item_info[6] + '/' + item_info[5],
-                    'size': item_info[4] + 'KB'
+                    'title': name,
+                    'type': facts['type'],
+                    'date': date,
+                    'size': facts['size'] + 'KB'
                 }
             )
         return ret
-    
-    def get_file_content(self, title):
+
+    def get_file_size(self, path):
+        """
+        Size in bytes of a given file, None if it can't be known.
+        """
+        try:
+            with self.pool.connection(self.acquire_timeout) as ftp:
+                ftp.voidcmd('TYPE I')
+                return ftp.size(path)
+        except PoolTimeout:
+            raise
+        except:
+            return None
+
+    def stat_file(self, path):
+        """
+        (size in bytes, modification time as a timestamp) of a given file,
+        None if it can't be known.
+        """
+        try:
+            with self.pool.connection(self.acquire_timeout) as ftp:
+                ftp.voidcmd('TYPE I')
+                size = ftp.size(path)
+                mdtm = ftp.voidcmd('MDTM ' + path).split()[1]
+        except PoolTimeout:
+            raise
+        except:
+            return None
+        return size, calendar.timegm(time.strptime(mdtm[:14], '%Y%m%d%H%M%S'))
+
+    def open_file(self, path, start=0, length=None):
+        """
+        Starts the download of a file. Returns (file size, blocks), 'blocks'
+        yielding 'length' bytes (up to the end by default) from 'start' on.
+        Raises the FTP error if the file can't be retrieved.
+
+        Blocks are received from the data connection only as they are
+        consumed, so memory stays at one block whatever the file size, and
+        a slow HTTP client slows down the FTP transfer (TCP backpressure).
+        REST makes the FTP server seek to 'start', so nothing before it is sent.
+        """
+        blocks = self._retrieve(path, start, length)
+        return next(blocks), blocks
+
+    def _retrieve(self, path, start, length):
+        """
+        Generator behind 'open_file', first yields the file size. The borrowed
+        connection and download slot are given back when the generator ends
+        or is closed.
+        """
+        if not self._downloads.acquire(timeout=self.acquire_timeout):
+            raise PoolTimeout('Too many downloads going on')
+        try:
+            ftp = self.pool.acquire(self.acquire_timeout)
+        except:
+            self._downloads.release()
+            raise
+        conn = None
+        finished = False
+        try:
+            ftp.voidcmd('TYPE I')
+            size = ftp.size(path)
+            conn = ftp.transfercmd('RETR ' + path, rest=start or None)
+            left = size - start if length is None else length
+            yield size
+
+            while left > 0:
+                data = conn.recv(min(left, self.BLOCK_SIZE))
+                if not data:
+                    break
+                left -= len(data)
+                yield data
+            finished = True
+        except (error_perm, error_temp):
+            finished = conn is None     # Refused before the transfer, no reply pending
+            raise
+        finally:
+            if conn is not None:
+                conn.close()
+            self._end_transfer(ftp, finished and conn is not None, finished)
+            self._downloads.release()
+
+    def _end_transfer(self, ftp, wait_reply, reusable):
         """
-        Get's the content of a given file.
+        Gives the connection of a download back to the pool. If the download
+        was abandoned (HTTP client gone) the transfer reply is still
+        to come at some point, so the connection isn't reused.
         """
-        if '.' in title:
-            content = []
+        if wait_reply:
+            # The server may complain about the transfer being cut short, that's expected
             try:
-                a = self.ftp.retrbinary('RETR ' + title, lambda a: content.append(a))
-            except:
+                ftp.voidresp()
+            except (error_temp, error_perm):
                 pass
-            return 'file', content
-        else:
-            return 'directory', self.list_dir(dir=title)
-    
-    def store_file(self, file):
+            except CONNECTION_ERRORS:
+                reusable = False
+        self.pool.release(ftp, discard=not reusable)
+
+    def store_stream(self, path, blocks, start=0):
+        """
+        Stores the blocks of bytes of an iterable as they come, so the FTP
+        transfer goes along with the upload instead of after it. With 'start'
+        (REST) the data is written from that offset on, leaving the rest of
+        the file untouched, e.g. for a chunk of a bigger upload.
+        Returns the bytes stored. Raises the FTP error if it fails.
+        """
+        written = 0
+        with self.pool.connection(self.acquire_timeout) as ftp:
+            ftp.voidcmd('TYPE I')
+            conn = ftp.transfercmd('STOR ' + path, rest=start or None)
+            try:
+                for block in blocks:
+                    conn.sendall(block)
+                    written += len(block)
+            except:
+                # Upload cut short, still read the transfer reply so the
+                # connection can be reused
+                conn.close()
+                try:
+                    ftp.voidresp()
+                except (error_temp, error_perm):
+                    pass
+                raise
+            conn.close()
+            ftp.voidresp()
+        return written
+
+    def replace_stream(self, path, blocks):
+        """
+        Stores a whole file like 'store_stream', under a temporary name that
+        is renamed over 'path' once the upload is complete. An upload cut
+        short leaves neither a partial file nor a truncated previous one.
+        Returns the bytes stored. Raises the FTP error if it fails.
+        """
+        dir, name = posixpath.split(path)
+        part = posixpath.join(dir, f'.{name}.{uuid.uuid4().hex[:8]}.part')
         try:
-            self.ftp.storbinary('STOR '+file.filename, file)
+            written = self.store_stream(part, blocks)
+            with self.pool.connection(self.acquire_timeout) as ftp:
+                ftp.rename(part, path)
+            return written
         except:
-            return 'Something went wrong. Can\'t upload file.'
-        return 'File uploaded succesfully.'
\ No newline at end of file
+            try:
+                with self.pool.connection(self.acquire_timeout) as ftp:
+                    ftp.delete(part)
+            except CONNECTION_ERRORS + (error_perm, error_temp):
+                pass    # Never created, or the server is gone
+            raise
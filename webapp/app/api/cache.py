@@ -0,0 +1,174 @@
+"""
+On-disk cache of downloaded files.
+
+A download that misses the cache is streamed to the HTTP client as usual and,
+at the same time, written to a local file and hashed. Files are stored once
+per content (named after their SHA-256, which is also their strong ETag), and
+each FTP path points to one of them along with the SIZE/MDTM it had.
+
+An entry is served without asking the FTP server for 'ttl' seconds after it
+was last validated; later, it is only served if SIZE/MDTM still match.
+Uploads through the webapp invalidate their path at once. Eviction is LRU,
+bounded by the bytes held.
+
+The web app may run as several processes sharing the cache directory: each
+cache keeps its files in a folder of its own, named after its process.
+"""
+
+import collections, hashlib, os, shutil, tempfile, threading, time, weakref
+
+# 'file' is the local copy, 'etag' its SHA-256, 'checked' when SIZE/MDTM were last verified
+CachedFile = collections.namedtuple('CachedFile', 'size mtime etag file checked')
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass    # Not ours to signal, but it exists
+    return True
+
+class DownloadCache:
+    DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+    DEFAULT_TTL = 5     # Seconds
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, max_file_bytes=None,
+                 ttl=DEFAULT_TTL):
+        """
+        Files over 'max_file_bytes' (by default a quarter of 'max_bytes')
+        are never cached, so a single download can't flush the whole cache.
+        """
+        self.root = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes if max_file_bytes is not None else max_bytes // 4
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._finalizer = None
+        self._reset()
+
+    def _reset(self):
+        """
+        Starts empty in a new folder, '<pid>-<random>' under 'root'. Folders
+        left by processes that are gone are removed (other processes' are
+        theirs). Also called in a process forked with the cache, which
+        must not share the files of its parent. Called with the lock held.
+        """
+        if self._finalizer is not None:
+            self._finalizer.detach()    # The parent's folder, not ours to remove
+        self._pid = os.getpid()
+        self.size = 0       # Bytes held
+        self._paths = collections.OrderedDict()     # FTP path -> CachedFile, in LRU order
+        self._blobs = {}    # etag -> FTP paths pointing to it
+
+        os.makedirs(self.root, exist_ok=True)
+        for name in os.listdir(self.root):
+            pid = name.partition('-')[0]
+            if pid.isdigit() and not _running(int(pid)):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+        self.directory = tempfile.mkdtemp(prefix=f'{self._pid}-', dir=self.root)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, True)
+
+    def _check_process(self):
+        """
+        Called with the lock held before touching the entries.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+    def fresh(self, path):
+        """
+        The entry of 'path' if it was validated less than 'ttl' seconds ago, or None.
+        """
+        with self._lock:
+            self._check_process()
+            entry = self._paths.get(path)
+            if entry is None or time.monotonic() - entry.checked > self.ttl:
+                return None
+            self._paths.move_to_end(path)
+            return entry
+
+    def lookup(self, path, size, mtime):
+        """
+        The entry of 'path' if it still has the given SIZE/MDTM, or None
+        (dropping it if the file changed).
+        """
+        with self._lock:
+            self._check_process()
+            entry = self._paths.get(path)
+            if entry is None:
+                return None
+            if (entry.size, entry.mtime) != (size, mtime):
+                self._drop(path)
+                return None
+            entry = self._paths[path] = entry._replace(checked=time.monotonic())
+            self._paths.move_to_end(path)
+            return entry
+
+    def fill(self, path, size, mtime, blocks):
+        """
+        Wraps the blocks of a download so they are also stored in the cache.
+        The entry is only added if the download is complete.
+        """
+        if size > self.max_file_bytes:
+            return blocks
+        return self._fill(path, size, mtime, blocks)
+
+    def _fill(self, path, size, mtime, blocks):
+        with self._lock:
+            self._check_process()
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        digest = hashlib.sha256()
+        written = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in blocks:
+                    f.write(block)
+                    digest.update(block)
+                    written += len(block)
+                    yield block
+        finally:
+            if written == size:
+                self._add(path, size, mtime, digest.hexdigest(), tmp)
+            else:
+                os.remove(tmp)  # Download abandoned or cut short
+
+    def _add(self, path, size, mtime, etag, tmp):
+        with self._lock:
+            self._check_process()
+            blob = os.path.join(self.directory, etag)
+            self._drop(path)
+            if etag in self._blobs:
+                os.remove(tmp)  # Same content already stored for another path
+            else:
+                os.replace(tmp, blob)
+                self._blobs[etag] = set()
+                self.size += size
+            self._blobs[etag].add(path)
+            self._paths[path] = CachedFile(size, mtime, etag, blob, time.monotonic())
+
+            while self.size > self.max_bytes and self._paths:
+                self._drop(next(iter(self._paths)))
+
+    def invalidate(self, path):
+        with self._lock:
+            self._check_process()
+            self._drop(path)
+
+    def _drop(self, path):
+        """
+        Forgets 'path', and its local file if no other path has the same content.
+        Called with the lock held.
+        """
+        entry = self._paths.pop(path, None)
+        if entry is None:
+            return
+        paths = self._blobs[entry.etag]
+        paths.discard(path)
+        if not paths:
+            del self._blobs[entry.etag]
+            self.size -= entry.size
+            try:
+                os.remove(entry.file)
+            except OSError:
+                pass
@@ -0,0 +1,61 @@
+"""
+Per-session cache of directory listings.
+
+Browsing back and forth (or refreshing) shows the same few directories over
+and over, so each session keeps the listings it has seen for 'ttl' seconds.
+Only the session id is in the Flask session, the listings stay in memory
+here. Uploads invalidate the directory for every session.
+"""
+
+import collections, threading, time
+
+class SessionListings:
+    DEFAULT_TTL = 10    # Seconds
+    DEFAULT_MAX_SESSIONS = 1024
+    DEFAULT_MAX_DIRS = 32   # Per session
+
+    def __init__(self, ttl=DEFAULT_TTL, max_sessions=DEFAULT_MAX_SESSIONS,
+                 max_dirs=DEFAULT_MAX_DIRS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_dirs = max_dirs
+        self._lock = threading.Lock()
+        # Session id -> {dir: (created, listing)} in LRU order, sessions too
+        self._sessions = collections.OrderedDict()
+
+    def get(self, sid, dir, load):
+        """
+        Listing of 'dir' for the session, calling 'load(dir)' if it isn't
+        cached or it's older than 'ttl'.
+        """
+        now = time.monotonic()
+        with self._lock:
+            dirs = self._sessions.get(sid)
+            entry = dirs.get(dir) if dirs is not None else None
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._sessions.move_to_end(sid)
+                dirs.move_to_end(dir)
+                return entry[1]
+
+        listing = load(dir)
+        with self._lock:
+            dirs = self._sessions.setdefault(sid, collections.OrderedDict())
+            self._sessions.move_to_end(sid)
+            dirs[dir] = (now, listing)
+            dirs.move_to_end(dir)
+            if len(dirs) > self.max_dirs:
+                dirs.popitem(last=False)
+            if len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return listing
+
+    def invalidate(self, dir, sid=None):
+        """
+        Forgets the listing of 'dir' in every session, or in session 'sid' only.
+        """
+        with self._lock:
+            if sid is not None:
+                self._sessions.get(sid, {}).pop(dir, None)
+                return
+            for dirs in self._sessions.values():
+                dirs.pop(dir, None)
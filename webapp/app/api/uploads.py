@@ -0,0 +1,64 @@
+"""
+Reading of multipart/form-data uploads as the body arrives.
+
+Werkzeug's form parsing ('request.files') spools every file to memory or a
+temp file before the view runs. Here the body is fed block by block to
+werkzeug's incremental multipart decoder instead, and the data of each file
+is handed over as it is decoded, so it can go straight to STOR.
+"""
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
+
+BLOCK_SIZE = 64 * 1024      # Bytes read from the request body at a time
+
+def _events(stream, decoder):
+    """
+    Decoder events of the whole body, reading it only when more data is needed.
+    """
+    ended = False
+    while True:
+        event = decoder.next_event()
+        if isinstance(event, NeedData):
+            if ended:
+                raise ValueError('Upload ended before the multipart body')
+            block = stream.read(BLOCK_SIZE)
+            ended = not block
+            decoder.receive_data(block or None)
+        elif isinstance(event, Epilogue):
+            return
+        else:
+            yield event
+
+def iter_files(stream, boundary, max_field_size=64 * 1024):
+    """
+    Yields (fields, name, filename, blocks) for every file in the body, where
+    'fields' holds the form fields sent before the file (e.g. Dropzone chunk
+    parameters) and 'blocks' yields the file data. Whatever is not consumed
+    of 'blocks' is skipped when asking for the next file.
+    """
+    # The decoder limit is on its buffer: a part's headers plus the block being read
+    decoder = MultipartDecoder(boundary.encode(), max_field_size + BLOCK_SIZE)
+    events = _events(stream, decoder)
+    fields = {}
+
+    def data_blocks():
+        for event in events:
+            if event.data:
+                yield event.data
+            if not event.more_data:
+                return
+
+    for event in events:
+        if isinstance(event, Field):
+            value = b''.join(data_blocks())
+            if len(value) > max_field_size:
+                raise RequestEntityTooLarge()
+            fields[event.name] = value.decode(errors='replace')
+        elif isinstance(event, File):
+            blocks = data_blocks()
+            yield fields, event.name, event.filename, blocks
+            for _ in blocks:
+                pass
+        elif isinstance(event, Data):
+            continue    # Data of a part already handled
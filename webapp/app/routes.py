@@ -2,15 +2,102 @@
 # -*- coding: utf-8 -*-
 
 from app import app
-from flask import render_template, request, url_for, redirect, session, send_file, send_from_directory
-from app.api.api import API
+from flask import render_template, request, url_for, redirect, session, send_file, send_from_directory, Response, jsonify
+from app.api.api import API, PoolTimeout
+from app.api.uploads import iter_files
+from app.api.cache import DownloadCache
+from app.api.listings import SessionListings
+from ftplib import error_perm, error_temp
 from werkzeug.utils import secure_filename
+from werkzeug.http import http_date
 from flask_dropzone import Dropzone
+import bisect
+import ftplib
+import operator
 import os
+import posixpath
 import tempfile
+import uuid
 
-cmd = API()
-curr_path = []
+cmd = API()     # Backed by a pool of FTP connections, safe to share between requests
+downloads = DownloadCache(os.path.join(app.root_path, 'temp', 'downloads'))
+listings = SessionListings()
+PAGE_SIZE = 200         # Entries rendered with the page, the rest come from /api/list
+MAX_PAGE_SIZE = 1000
+RETRY_AFTER = 5         # Seconds, when all the FTP connections are busy
+
+@app.errorhandler(PoolTimeout)
+def busy(e):
+    """
+    Every FTP connection (or download slot) stayed busy: tell the client to come back.
+    """
+    app.logger.warning('FTP server busy: %s', e)
+    return Response('The server is busy, try again later.', status=503,
+                    headers={'Retry-After': str(RETRY_AFTER)})
+
+def current_path():
+    """
+    Directories the user went into, e.g. ['/photos', '/2022'], kept in the session.
+    """
+    return session.get('path', [])
+
+def current_dir():
+    return ''.join(current_path()) or '/'
+
+def load_dir(dir):
+    return sorted(cmd.list_dir(dir), key=operator.itemgetter('title'))
+
+def list_dir(dir):
+    """
+    Listing of a directory sorted by name, cached for a few seconds per session.
+    """
+    sid = session.setdefault('sid', uuid.uuid4().hex)
+    return listings.get(sid, dir, load_dir)
+
+def list_page(dir, cursor=None, limit=PAGE_SIZE):
+    """
+    Up to 'limit' entries of a directory following the 'cursor' name, and the
+    cursor of the next page (None after the last one). Names are a stable
+    cursor even if the cached listing is reloaded between pages.
+    """
+    items = list_dir(dir)
+    start = 0
+    if cursor is not None:
+        start = bisect.bisect_right(items, cursor, key=operator.itemgetter('title'))
+    page = items[start:start + limit]
+    next_cursor = page[-1]['title'] if start + limit < len(items) else None
+    return page, next_cursor, len(items)
+
+def find_entry(dir, title):
+    """
+    Entry named 'title' in the listing of 'dir', None if there's none. The
+    cached listing is loaded again if it hasn't got it (it may be older).
+    """
+    for reload in (False, True):
+        if reload:
+            listings.invalidate(dir, session.get('sid'))
+        items = list_dir(dir)
+        i = bisect.bisect_left(items, title, key=operator.itemgetter('title'))
+        if i < len(items) and items[i]['title'] == title:
+            return items[i]
+    return None
+
+def render_dir():
+    dir = current_dir()
+    data, next_cursor, _ = list_page(dir)
+    return render_template('index.html', title="MyCloud", items=data, path=current_path(),
+                           dir=dir, next_cursor=next_cursor, page_size=PAGE_SIZE)
+
+@app.route('/api/list', methods=['GET'])
+def api_list():
+    """
+    A page of a directory listing as JSON, see 'list_page'. Defaults to
+    the current directory of the user.
+    """
+    dir = posixpath.normpath(posixpath.join('/', request.args.get('path', current_dir())))
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    items, next_cursor, total = list_page(dir, request.args.get('cursor'), limit)
+    return jsonify(path=dir, items=items, next_cursor=next_cursor, total=total)
 
 @app.route('/')
 @app.route('/index/', methods=['GET'])
@@ -18,12 +105,16 @@ def index():
     # For testing only
     #return render_template('prueba.html')
 
-    data = cmd.list_dir(root=True)
-    
-    while curr_path:
-        curr_path.pop()
+    session['path'] = []
+    return render_dir()
 
-    return render_template('index.html', title="MyCloud", items=data)
+@app.route('/files/', methods=['GET'])
+def browse():
+    """
+    Current directory of the user. Navigation redirects here, so a refresh
+    doesn't repeat it.
+    """
+    return render_dir()
 
 # This helps to include Script files into Jinja2 templates
 @app.template_global()
@@ -31,45 +122,97 @@ def static_include(filename):
     with open(os.path.join(app.root_path, 'static/'+filename), 'r') as f:
         return f.read()
 
+def stream_file(title, blocks, length, status=200, headers=None):
+    """
+    Response sending the blocks of a download as they come from the FTP server.
+    """
+    headers = dict(headers or {})
+    headers.update({
+        'Content-Length': str(length),
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': f'attachment; filename="{title}"'
+    })
+    return Response(blocks, status=status, mimetype='application/octet-stream',
+                    headers=headers, direct_passthrough=True)
+
+def file_range(path, title, size):
+    """
+    Serves an HTTP 'Range' request by fetching only that part of the file (FTP REST).
+    """
+    if request.range.units != 'bytes' or len(request.range.ranges) != 1:
+        return None     # Multipart ranges are served as the whole file
+    byte_range = request.range.range_for_length(size)
+    if byte_range is None:
+        return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+
+    start, stop = byte_range
+    _, blocks = cmd.open_file(path, start, stop - start)
+    return stream_file(title, blocks, stop - start, status=206,
+                       headers={'Content-Range': f'bytes {start}-{stop - 1}/{size}'})
+
+def download(path, title):
+    """
+    Serves a file from the download cache when it's still valid (send_file
+    answers If-None-Match/If-Modified-Since with 304, and Range requests),
+    otherwise streams it from the FTP server, filling the cache on the way.
+    Returns None if the file can't be retrieved.
+    """
+    cached = downloads.fresh(path)
+    info = None
+    if cached is None:
+        info = cmd.stat_file(path)
+        if info is None:
+            return None
+        cached = downloads.lookup(path, *info)
+    if cached is not None:
+        return send_file(cached.file, mimetype='application/octet-stream', as_attachment=True,
+                         download_name=title, etag=cached.etag, last_modified=cached.mtime,
+                         conditional=True, max_age=0)
+
+    size, mtime = info
+    headers = {'Last-Modified': http_date(mtime)}
+    if request.range:
+        response = file_range(path, title, size)
+        if response is not None:
+            response.headers.update(headers)
+            return response
+
+    try:
+        size, blocks = cmd.open_file(path)
+    except (error_perm, error_temp):
+        return None
+    return stream_file(title, downloads.fill(path, size, mtime, blocks), size, headers=headers)
+
 @app.route('/files/<title>', methods=['GET', 'POST'])
 def file(title):
-    type, content = cmd.get_file_content(title)
-    if type == 'error':
-        if not curr_path:
-            data = cmd.list_dir(root=True)
-        else:
-            data = cmd.list_dir(dir=''.join(curr_path))
-        return render_template('index.html', title="MyCloud", items=data, path=curr_path)
-    
-    # File
-    elif type == 'file':
-        with open('app/temp/'+title, "wb") as f:
-            for c in content:
-                f.write(c)
-        return send_file('temp/'+title, as_attachment=True)
-    
+    path = posixpath.join(current_dir(), title)
+
+    # The MLSD 'type' fact tells files from directories, whatever their names
+    entry = find_entry(current_dir(), title)
+    if entry is None:
+        return render_dir()
+
     # Directory
-    else:
-        curr_path.append('/'+title)
-        return render_template('index.html', title="MyCloud", items=content, path=curr_path)
+    if entry['type'] == 'dir':
+        session['path'] = current_path() + ['/'+title]
+        return redirect(url_for('browse'))
+
+    # File, streamed (no temp file, nor the whole file in memory)
+    response = download(path, title)
+    if response is not None:
+        return response
+    return render_dir()
 
 
 @app.route('/files/undo', methods=['GET'])
 def undo():
-    try:
-        curr_path.pop()
-        if not curr_path:
-            data = cmd.list_dir(root=True)
-        else:
-            data = cmd.list_dir(dir=''.join(curr_path))
-    except:
-        data = cmd.list_dir(root=True)
-    return render_template('index.html', title="MyCloud", items=data, path=curr_path)
+    session['path'] = current_path()[:-1]
+    return redirect(url_for('browse'))
 
 
 app.config.update(
     DROPZONE_UPLOAD_ON_CLICK=True,
-    DROPZONE_REDIRECT_VIEW="index",
+    DROPZONE_REDIRECT_VIEW="browse",
     DROPZONE_INPUT_NAME="file",
     DROPZONE_DEFAULT_MESSAGE="Either drag or click to upload files"
 
@@ -77,15 +220,36 @@ app.config.update(
 dropzone = Dropzone(app)
 @app.route('/upload_file', methods=['POST'])
 def upload_file():
-    for key, f in request.files.items():
-        if key.startswith('file'):
-            cmd.store_file(f)
-    
-    if not curr_path:
-        data = cmd.list_dir(root=True)
-    else:
-        data = cmd.list_dir(dir=''.join(curr_path))
-    return render_template('index.html', title="MyCloud", items=data, path=curr_path)
+    """
+    Files are piped to STOR while they are uploaded, without 'request.files'
+    (which would spool them first). Dropzone chunks are written at their
+    offset (REST), so a file is put back together on the FTP server.
+    """
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return Response('Expected a multipart/form-data upload.', status=400)
+
+    try:
+        for fields, key, filename, blocks in iter_files(request.stream, boundary):
+            if key.startswith('file') and filename:
+                path = posixpath.join(current_dir(), posixpath.basename(filename))
+                # Also after storing, in case it was downloaded (and cached) half-way
+                downloads.invalidate(path)
+                try:
+                    if 'dzchunkbyteoffset' in fields:
+                        cmd.store_stream(path, blocks, int(fields['dzchunkbyteoffset']))
+                    else:
+                        cmd.replace_stream(path, blocks)
+                finally:
+                    downloads.invalidate(path)
+    except PoolTimeout:
+        raise
+    except (ftplib.all_errors + (ValueError,)) as e:
+        app.logger.warning('Upload failed: %r', e)
+        return Response('Something went wrong. Can\'t upload file.', status=502)
+    finally:
+        listings.invalidate(current_dir())
+    return render_dir()
 
 
 
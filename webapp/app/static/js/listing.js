@@ -0,0 +1,76 @@
+// Incremental rendering of big directories: the page comes with the first
+// entries only, the rest is fetched from /api/list a page at a time when
+// the end of the table gets close to the viewport.
+(function () {
+    const table = document.querySelector(".myTable");
+    const sentinel = document.getElementById("listing-more");
+    if (!table || !sentinel) {
+        return;
+    }
+    const rows = table.tBodies[0] || table;
+    let cursor = table.dataset.cursor;
+    let loading = false;
+
+    // Same markup as the rows rendered by index.html
+    function cell(className, child) {
+        const td = document.createElement("td");
+        td.className = className;
+        td.appendChild(child);
+        return td;
+    }
+
+    function createRow(item) {
+        const isDir = item.type === "dir";
+        const link = document.createElement("a");
+        link.href = table.dataset.files + encodeURIComponent(item.title);
+        link.className = isDir ? "myTable-item-title-hover-a" : "myTable-item-title-a";
+        link.textContent = item.title;
+        if (!isDir) {
+            link.setAttribute("download", "");
+        }
+
+        const tr = document.createElement("tr");
+        tr.className = "myTable-item";
+        tr.appendChild(cell(isDir ? "myTable-item-title-hover" : "myTable-item-title", link));
+        tr.appendChild(cell("myTable-item-date", document.createTextNode(item.date)));
+        tr.appendChild(cell("myTable-item-size", document.createTextNode(item.size)));
+        return tr;
+    }
+
+    function loadMore() {
+        if (loading || !cursor) {
+            return;
+        }
+        loading = true;
+        const params = new URLSearchParams({
+            path: table.dataset.path,
+            cursor: cursor,
+            limit: table.dataset.limit
+        });
+        fetch(table.dataset.source + "?" + params)
+            .then(function (response) { return response.json(); })
+            .then(function (data) {
+                const fragment = document.createDocumentFragment();
+                data.items.forEach(function (item) { fragment.appendChild(createRow(item)); });
+                rows.appendChild(fragment);
+                cursor = data.next_cursor;
+                loading = false;
+                if (!cursor) {
+                    observer.disconnect();
+                    sentinel.remove();
+                } else {
+                    // Still in view (tall window): observing again fires the callback
+                    observer.unobserve(sentinel);
+                    observer.observe(sentinel);
+                }
+            })
+            .catch(function () { loading = false; });
+    }
+
+    const observer = new IntersectionObserver(function (entries) {
+        if (entries.some(function (entry) { return entry.isIntersecting; })) {
+            loadMore();
+        }
+    }, { rootMargin: "400px" });
+    observer.observe(sentinel);
+})();